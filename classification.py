@@ -0,0 +1,107 @@
+import numpy as np
+
+# 数値列の区分（自然分類・分位数・等間隔）
+# Streamlit に依存しないため、大きな列はジョブ（jobs.py）としてワーカープロセスで分類できる
+
+# 自然分類で厳密に計算するユニーク値の上限（超える場合は等幅ビンに集約して計算）
+CKMEANS_MAX_POINTS = 2048
+
+def ckmeans_breaks(x, w, k, progress=None):
+    # 昇順の値 x（重み w）を k クラスに分ける最適な1次元分割（Ckmeans 動的計画法）
+    # 各クラスの最後の要素の添字を返す。分割位置の単調性を使った分割統治で各段を埋める
+    n = len(x)
+    cw = np.concatenate([[0.0], np.cumsum(w)])
+    cs1 = np.concatenate([[0.0], np.cumsum(w * x)])
+    cs2 = np.concatenate([[0.0], np.cumsum(w * x * x)])
+
+    def cost(j, i):
+        # 区間 [j, i]（両端含む）の重み付き平方和
+        sw = cw[i + 1] - cw[j]
+        s1 = cs1[i + 1] - cs1[j]
+        return np.maximum(cs2[i + 1] - cs2[j] - s1 * s1 / sw, 0.0)
+
+    D = np.full((k, n), np.inf)
+    B = np.zeros((k, n), dtype=np.intp)
+    D[0] = cost(np.zeros(n, dtype=np.intp), np.arange(n))
+
+    def fill(q, imin, imax, jmin, jmax):
+        if imin > imax:
+            return
+        i = (imin + imax) // 2
+        lo = max(q, jmin)
+        hi = min(i, jmax)
+        j = np.arange(lo, hi + 1)
+        total = D[q - 1][j - 1] + cost(j, np.full(len(j), i))
+        best = int(np.argmin(total))
+        D[q][i] = total[best]
+        B[q][i] = j[best]
+        fill(q, imin, i - 1, jmin, j[best])
+        fill(q, i + 1, imax, j[best], jmax)
+
+    for q in range(1, k):
+        fill(q, q, n - 1, q, n - 1)
+        if progress:
+            progress(q, k - 1)
+    # 最終クラスから順に区切り位置をたどる
+    ends = []
+    i = n - 1
+    for q in range(k - 1, -1, -1):
+        ends.append(i)
+        i = B[q][i] - 1
+    return ends[::-1]
+
+def classify_values(values, k, method="jenks", progress=None):
+    # 数値列を k 区分に分類し、区分番号（欠損は -1）を返す
+    valid = np.isfinite(values)
+    x = values[valid]
+    if method == "quantile":
+        thresholds = np.unique(np.quantile(x, np.linspace(0, 1, k + 1)[1:-1]))
+    elif method == "equal":
+        thresholds = np.linspace(x.min(), x.max(), k + 1)[1:-1]
+    else:
+        unique_values, counts = np.unique(x, return_counts=True)
+        if len(unique_values) > CKMEANS_MAX_POINTS:
+            # ユニーク値が多い場合は等幅ビンの重み付き平均値に集約してから分割する
+            edges = np.linspace(unique_values[0], unique_values[-1], CKMEANS_MAX_POINTS + 1)
+            bins = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, CKMEANS_MAX_POINTS - 1)
+            weights = np.bincount(bins, minlength=CKMEANS_MAX_POINTS).astype(np.float64)
+            sums = np.bincount(bins, weights=x, minlength=CKMEANS_MAX_POINTS)
+            nonempty = weights > 0
+            points = sums[nonempty] / weights[nonempty]
+            weights = weights[nonempty]
+            uppers = edges[1:][nonempty]
+        else:
+            points = unique_values.astype(np.float64)
+            weights = counts.astype(np.float64)
+            uppers = points
+        k = min(k, len(points))
+        ends = ckmeans_breaks(points, weights, k, progress)
+        thresholds = uppers[ends[:-1]]
+    codes = np.full(len(values), -1, dtype=np.int16)
+    codes[valid] = np.searchsorted(thresholds, x, side="left")
+    return codes
+
+def classify_numeric(values, k, method="jenks", progress=None):
+    # 数値の配列を区分番号（欠損は -1）と区分名（各区分の最小値～最大値）に分類する
+    if not np.isfinite(values).any():
+        return np.full(len(values), -1, dtype=np.int16), []
+    codes = classify_values(values, k, method, progress)
+    # 空の区分を除いて番号を詰め、各区分の最小値・最大値を区分名にする
+    valid = codes >= 0
+    n_classes = int(codes[valid].max()) + 1
+    counts = np.bincount(codes[valid], minlength=n_classes)
+    class_min = np.full(n_classes, np.inf)
+    class_max = np.full(n_classes, -np.inf)
+    np.minimum.at(class_min, codes[valid], values[valid])
+    np.maximum.at(class_max, codes[valid], values[valid])
+    kept = np.flatnonzero(counts > 0)
+    remap = np.full(n_classes, -1, dtype=np.int16)
+    remap[kept] = np.arange(len(kept))
+    codes[valid] = remap[codes[valid]]
+    labels = []
+    for c in kept:
+        label = f"{class_min[c]:.2f} ~ {class_max[c]:.2f}"
+        while label in labels:
+            label += " "
+        labels.append(label)
+    return codes, labels
@@ -0,0 +1,134 @@
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# 重い処理（数値列の分類・大きな GeoJSON の読み込み・ゾーン統計など）をプロセスプールで実行する
+# ・同じキーのジョブが実行中なら新たに実行せず、そのジョブの完了を待つ（セッションをまたいで1つのジョブを共有する）
+# ・ワーカーは progress(処理済み, 全体) で共有の辞書に進捗を書き、画面側はそれを読んで進捗バーを更新する
+# ・呼び出し元（セッションと用途の組）ごとに最新のジョブだけを待ち、置き換えられて誰も待たなくなったジョブは取り消す
+#   （開始前なら Future.cancel、実行中なら次の progress 呼び出しで JobCancelled を送出して止める）
+# ・完了した結果はキーごとに LRU で少数保持し、後から同じ計算を求めたセッションにもそのまま返す
+# ジョブの関数はワーカーから import できるモジュールの関数であること（Streamlit アプリのスクリプト内の関数は不可）
+
+# ワーカーが進捗を書き込む（取り消しを確認する）最小の間隔（秒）
+PROGRESS_INTERVAL = 0.1
+
+class JobCancelled(Exception):
+    pass
+
+def run_job(func, args, kwargs, job_id, state, report_progress):
+    # ワーカープロセスで関数を実行する（進捗の書き込みと取り消しの確認は state のジョブ番号の項目を通して行う）
+    last = [0.0]
+
+    def progress(done, total=None):
+        now = time.monotonic()
+        if now - last[0] < PROGRESS_INTERVAL and (total is None or done < total):
+            return
+        last[0] = now
+        if state.get(("cancel", job_id)):
+            raise JobCancelled(f"ジョブ {job_id} は取り消されました")
+        state[job_id] = (done, total)
+
+    if report_progress:
+        return func(*args, progress=progress, **kwargs)
+    return func(*args, **kwargs)
+
+class JobExecutor:
+    def __init__(self, max_workers=None, max_results=32):
+        # fork ではサーバーのスレッドの状態（ロックなど）を引き継ぐため、spawn でワーカーを起動する
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        self.manager = context.Manager()
+        self.state = self.manager.dict()
+        self.lock = threading.RLock()
+        # 実行中のジョブ（キー -> Future。Future.job_id が state の項目の番号）と、それを待っている呼び出し元
+        # 取り消したジョブはここから外すため、同じキーを再び求められたときは新しいジョブを実行する
+        self.jobs = {}
+        self.owners = {}
+        # 呼び出し元ごとの最新のジョブのキー
+        self.latest = {}
+        self.results = OrderedDict()
+        self.max_results = max_results
+        self.submitted = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+
+    def submit(self, key, func, *args, owner=None, keep_result=True, report_progress=True, **kwargs):
+        # ジョブを登録して Future を返す。同じキーのジョブが実行中ならその Future を、完了済みの結果があれば完了した Future を返す
+        # owner（セッションと用途の組など）が前に待っていた別のキーのジョブは、他に待つ呼び出し元がいなければ取り消す
+        # keep_result=False の結果は保持しない（呼び出し側で別のキャッシュに入れる場合）
+        # report_progress=True なら func を progress= 付きで呼ぶ
+        with self.lock:
+            if owner is not None:
+                previous = self.latest.get(owner)
+                self.latest[owner] = key
+                if previous is not None and previous != key:
+                    self.release(previous, owner)
+            if key in self.results:
+                self.results.move_to_end(key)
+                future = Future()
+                future.set_result(self.results[key])
+                return future
+            future = self.jobs.get(key)
+            if future is None:
+                job_id = self.submitted
+                self.state[job_id] = (0, None)
+                future = self.executor.submit(run_job, func, args, kwargs, job_id, self.state, report_progress)
+                future.job_id = job_id
+                self.jobs[key] = future
+                self.owners[key] = set()
+                self.submitted += 1
+                future.add_done_callback(lambda f: self.finish(key, f, keep_result))
+            else:
+                self.deduplicated += 1
+            if owner is not None:
+                self.owners[key].add(owner)
+            return future
+
+    def release(self, key, owner):
+        # owner がジョブを待つのをやめる。誰も待たなくなった実行中のジョブは取り消し、実行中のジョブの一覧から外す
+        with self.lock:
+            owners = self.owners.get(key)
+            if owners is None:
+                return
+            owners.discard(owner)
+            if not owners:
+                future = self.jobs.pop(key)
+                del self.owners[key]
+                if not future.cancel():
+                    self.state[("cancel", future.job_id)] = True
+                self.cancelled += 1
+
+    def finish(self, key, future, keep_result):
+        with self.lock:
+            if self.jobs.get(key) is future:
+                del self.jobs[key]
+                self.owners.pop(key, None)
+            self.state.pop(future.job_id, None)
+            self.state.pop(("cancel", future.job_id), None)
+            if keep_result and not future.cancelled() and future.exception() is None:
+                self.results[key] = future.result()
+                self.results.move_to_end(key)
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+
+    def progress(self, key):
+        # 実行中のジョブの進捗（処理済み, 全体または None）
+        with self.lock:
+            future = self.jobs.get(key)
+        if future is None:
+            return (0, None)
+        return self.state.get(future.job_id, (0, None))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": len(self.jobs), "results": len(self.results), "submitted": self.submitted,
+                "deduplicated": self.deduplicated, "cancelled": self.cancelled,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
@@ -0,0 +1,194 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+# 時系列のラスタ（時刻ごとのバンドを持つ GeoTIFF、または1時刻1ファイル）をフレーム単位で読む
+# ・フレームは (パス, バンド)。選択中のフレームだけを表示解像度（表示範囲があればその範囲）で読み込む
+# ・前後のフレームは裏のスレッドで先読みし、読み込んだフレームは少数だけ LRU で保持する（スタック全体はメモリに載せない）
+
+FRAME_MAX_SIZE = 1024
+# 説明・タグ・ファイル名に含まれる日時（2024-08-01T13:00, 20240801_13, 2024080113 など）
+TIMESTAMP_PATTERN = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})[T_ ]?(\d{2})(?::?(\d{2}))?")
+TIMESTAMP_TAGS = ("TIME", "DATETIME", "valid_time", "GRIB_VALID_TIME")
+
+def empty_frame(bounds):
+    # 表示範囲がラスタと重ならない場合のフレーム（値はすべて欠損）
+    left, bottom, right, top = bounds
+    return {"img_array": np.full((1, 1), np.nan, dtype=np.float32), "bounds": [[left, bottom], [right, top]]}
+
+def clip_window(window, width, height):
+    # ウィンドウを画素の格子に合わせてラスタの範囲に切り詰める（重ならなければ None）
+    try:
+        window = window.round_offsets().round_lengths().intersection(Window(0, 0, width, height))
+    except WindowError:
+        return None
+    return window if window.width >= 1 and window.height >= 1 else None
+
+def read_frame(src, band, max_size=FRAME_MAX_SIZE, view_bounds=None):
+    # 指定バンドのみを、表示範囲（経緯度, 省略時は全体）に絞って表示解像度で読み込む
+    # 縮小読み込みでは GeoTIFF 内部のオーバービューが自動的に使われる
+    # 経緯度以外の座標系は、全解像度で再投影してから縮小するのではなく、表示解像度の格子へ直接再投影する
+    # 表示範囲がラスタと重ならなければ、値がすべて欠損のフレームを返す
+    to_lonlat = bool(src.crs) and src.crs.to_epsg() != 4326
+    if to_lonlat:
+        transform, width, height = calculate_default_transform(src.crs, "EPSG:4326", src.width, src.height, *src.bounds)
+    else:
+        transform, width, height = src.transform, src.width, src.height
+    window = Window(0, 0, width, height)
+    if view_bounds is not None:
+        window = clip_window(from_bounds(*view_bounds, transform=transform), width, height)
+        if window is None:
+            return empty_frame(view_bounds)
+    scale = min(1.0, max_size / max(window.width, window.height))
+    out_shape = (max(1, int(round(window.height * scale))), max(1, int(round(window.width * scale))))
+    if not to_lonlat:
+        data = src.read(band, window=window, out_shape=out_shape, resampling=Resampling.average, masked=True)
+        left, bottom, right, top = src.window_bounds(window)
+        return {"img_array": data.astype(np.float32).filled(np.nan), "bounds": [[left, bottom], [right, top]]}
+    out_transform = window_transform(window, transform) * Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+    left, top = out_transform * (0, 0)
+    right, bottom = out_transform * (out_shape[1], out_shape[0])
+    # 表示範囲に対応する元のラスタの範囲の指定バンドだけを表示解像度程度に縮小して読み、メモリ上で再投影する
+    # （WarpedVRT は全バンドを再投影するため、バンド数の多い時系列では使わない）
+    src_bounds = transform_bounds("EPSG:4326", src.crs, left, bottom, right, top)
+    src_window = clip_window(from_bounds(*src_bounds, transform=src.transform), src.width, src.height)
+    if src_window is None:
+        return empty_frame((left, bottom, right, top))
+    src_scale = min(1.0, max_size / max(src_window.width, src_window.height))
+    src_shape = (max(1, int(round(src_window.height * src_scale))), max(1, int(round(src_window.width * src_scale))))
+    source = src.read(band, window=src_window, out_shape=src_shape, resampling=Resampling.average, masked=True)
+    src_transform = window_transform(src_window, src.transform) * Affine.scale(src_window.width / src_shape[1], src_window.height / src_shape[0])
+    img_array = np.full(out_shape, np.nan, dtype=np.float32)
+    reproject(
+        source.astype(np.float32).filled(np.nan), img_array, src_transform=src_transform, src_crs=src.crs, src_nodata=np.nan,
+        dst_transform=out_transform, dst_crs="EPSG:4326", dst_nodata=np.nan, resampling=Resampling.bilinear,
+    )
+    return {"img_array": img_array, "bounds": [[left, bottom], [right, top]]}
+
+def file_version(path):
+    # ファイルの更新時刻とサイズ（同じパスのファイルが置き換えられたときにキャッシュを使い分ける）
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def parse_timestamp(text):
+    # 文字列に含まれる日時（見つからなければ None）
+    match = TIMESTAMP_PATTERN.search(str(text or ""))
+    if not match:
+        return None
+    year, month, day, hour, minute = match.groups()
+    try:
+        return pd.Timestamp(int(year), int(month), int(day), int(hour), int(minute or 0))
+    except ValueError:
+        return None
+
+def band_timestamps(src):
+    # バンドごとの日時（バンドの説明、なければバンドのタグから読む）
+    timestamps = []
+    for band, description in zip(range(1, src.count + 1), src.descriptions):
+        timestamp = parse_timestamp(description)
+        if timestamp is None:
+            tags = src.tags(band)
+            timestamp = next((parse_timestamp(tags[key]) for key in TIMESTAMP_TAGS if key in tags), None)
+        timestamps.append(timestamp)
+    return timestamps
+
+def value_range(frames, sample_size=64):
+    # 全フレームを小さく（オーバービューから）読んだ値の範囲。時刻を変えても色の対応が変わらないようにする
+    lo, hi = np.inf, -np.inf
+    handles = {}
+    try:
+        for path, band in frames:
+            if path not in handles:
+                handles[path] = rasterio.open(path)
+            src = handles[path]
+            scale = min(1.0, sample_size / max(src.width, src.height))
+            out_shape = (max(1, int(src.height * scale)), max(1, int(src.width * scale)))
+            data = src.read(band, out_shape=out_shape, resampling=Resampling.average, masked=True)
+            values = data.astype(np.float64).filled(np.nan)
+            if np.isfinite(values).any():
+                lo = min(lo, float(np.nanmin(values)))
+                hi = max(hi, float(np.nanmax(values)))
+    finally:
+        for src in handles.values():
+            src.close()
+    return (lo, hi) if lo <= hi else (np.nan, np.nan)
+
+class FrameCache:
+    # 読み込んだフレームの LRU キャッシュと、前後のフレームの先読み
+    def __init__(self, max_frames=12, max_size=FRAME_MAX_SIZE, prefetch_workers=1):
+        self.max_frames = max_frames
+        self.max_size = max_size
+        self.frames = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="raster-prefetch")
+        # rasterio のハンドルはスレッド間で共有しない
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def _open(self, path, version):
+        handles = getattr(self.local, "handles", None)
+        if handles is None:
+            handles = self.local.handles = {}
+        if (path, version) not in handles:
+            # 置き換えられたファイルの古いハンドルは閉じる
+            for old in [k for k in handles if k[0] == path]:
+                handles.pop(old).close()
+            handles[(path, version)] = rasterio.open(path)
+        return handles[(path, version)]
+
+    def _load(self, key):
+        path, version, band, view_bounds = key
+        try:
+            frame = read_frame(self._open(path, version), band, self.max_size, view_bounds)
+            with self.lock:
+                self.frames[key] = frame
+                self.frames.move_to_end(key)
+                while len(self.frames) > self.max_frames:
+                    self.frames.popitem(last=False)
+            return frame
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def get(self, path, band, view_bounds=None):
+        # フレームを返す（先読み中ならその完了を待つ）。キーにはファイルの更新時刻とサイズを含める
+        key = (path, file_version(path), band, view_bounds)
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return self.frames[key]
+            self.misses += 1
+            future = self.pending.get(key)
+        if future is not None:
+            return future.result()
+        return self._load(key)
+
+    def prefetch(self, frames, view_bounds=None):
+        # (パス, バンド) の一覧を、まだ読み込んでいないものだけ裏で読み込む
+        for path, band in frames:
+            key = (path, file_version(path), band, view_bounds)
+            with self.lock:
+                if key in self.frames or key in self.pending:
+                    continue
+                self.pending[key] = self.executor.submit(self._load, key)
+
+    def stats(self):
+        with self.lock:
+            return {"frames": len(self.frames), "hits": self.hits, "misses": self.misses}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,34 +1,742 @@
 import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
 import streamlit as st
 import pandas as pd
 import geopandas as gpd
-import requests
+import shapely
 import rasterio
-from rasterio.io import MemoryFile
+import rasterio.warp
+import tempfile
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
-import matplotlib.colors as mcolors
 import folium
 from streamlit_folium import st_folium
-from io import StringIO
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import json
 import plotly.express as px
 import plotly.graph_objects as go
 import pydeck as pdk
+from pydeck.bindings.json_tools import default_serialize
 import numpy as np
 import base64
+from functools import lru_cache
 from io import BytesIO
 from PIL import Image
+from urllib.parse import urlparse
 import pyarrow as pa
-from sklearn.cluster import KMeans
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from sklearn.neighbors import KDTree
+from classification import classify_numeric
+from jobs import JobExecutor
+from tile_server import VectorGeometry, VectorTileSource, apply_lut, simplify_coverage, start_tile_server
+from raster_stack import FrameCache, band_timestamps, file_version, parse_timestamp, read_frame, value_range
+from url_ingest import UrlDownloader
+from zonal_stats import zonal_statistics
 
 st.set_page_config(layout="wide")
 st.image("header.png", use_container_width=True)
 
+# 読み込み済みデータセットのメモリ上限（MB）。環境変数 INGEST_CACHE_MAX_MB で変更可能
+INGEST_CACHE_MAX_MB = int(os.environ.get("INGEST_CACHE_MAX_MB", "2048"))
+# 上限を超えたときに参照中のデータセットを退避するディレクトリ（環境変数 DATASET_SPILL_DIR で変更可能）
+DATASET_SPILL_DIR = os.environ.get("DATASET_SPILL_DIR", os.path.join(tempfile.gettempdir(), "wbgt_dataset_spill"))
+
+@st.cache_resource
+def get_dataset_registry():
+    # 全セッション共通のデータセット置き場（キー -> エントリ、LRU順）
+    # エントリ: value（メモリ上のデータ。ディスクに退避中は None）, nbytes, spill_path, name, sessions（参照中のセッションID）
+    # セッションの file_info にはキー（cache_key）と読み込み方法だけを持たせ、データ本体はここで共有する
+    return {"entries": OrderedDict(), "nbytes": 0, "lock": threading.Lock()}
+
+def estimate_nbytes(obj):
+    # DataFrame/GeoDataFrame はメモリ使用量（ジオメトリは座標数から）、TIFFプレビューは配列サイズで見積もる
+    if isinstance(obj, gpd.GeoDataFrame):
+        geometry = obj.geometry.values
+        return int(obj.drop(columns=obj.geometry.name).memory_usage(deep=True).sum()
+                   + shapely.get_num_coordinates(geometry).sum() * 16 + len(geometry) * 64)
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, dict):
+        return sum(v.nbytes for v in obj.values() if isinstance(v, np.ndarray))
+    if isinstance(obj, tuple):
+        return sum(estimate_nbytes(v) for v in obj)
+    return 0
+
+@lru_cache(maxsize=1024)
+def content_hash_for_file(path, mtime_ns, size):
+    # ファイルの内容のハッシュ（パス・更新時刻・サイズが同じなら計算し直さない）
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def ingest_key_for_path(path):
+    # フォルダ・URLのファイルも内容のハッシュで識別する（同じ内容なら入力元が違っても共有）
+    stat = os.stat(path)
+    return f"sha256:{content_hash_for_file(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)}"
+
+def ingest_key_for_bytes(data):
+    # アップロードのファイルは内容のハッシュで識別
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+def session_is_active(session_id):
+    # サーバー上で動いていない場合（bare モード）はすべて有効とみなす
+    if not st.runtime.exists():
+        return True
+    return st.runtime.get_instance().is_active_session(session_id)
+
+def spill_path_for_key(key):
+    return os.path.join(DATASET_SPILL_DIR, f"{hashlib.sha256(key.encode()).hexdigest()}.pkl")
+
+def release_unreferenced_datasets(registry, drop_all_unreferenced=False):
+    # 終了したセッションの参照を外し、参照のないデータセットを削除する（ロック取得済みで呼ぶ）
+    # drop_all_unreferenced=False の場合、メモリ上のデータは LRU で追い出されるまで残す
+    for key in list(registry["entries"]):
+        entry = registry["entries"][key]
+        entry["sessions"] = {sid for sid in entry["sessions"] if session_is_active(sid)}
+        if entry["sessions"]:
+            continue
+        if entry["value"] is None or drop_all_unreferenced:
+            registry["nbytes"] -= entry["nbytes"] if entry["value"] is not None else 0
+            del registry["entries"][key]
+            if entry["spill_path"] and os.path.exists(entry["spill_path"]):
+                os.remove(entry["spill_path"])
+
+def evict_over_budget(registry, keep):
+    # 上限を超えた分を古いものから追い出す（ロック取得済みで呼ぶ）
+    # 参照中のデータセットはディスクに退避し、参照のないものは削除する。戻り値は退避するデータの一覧
+    release_unreferenced_datasets(registry)
+    budget = INGEST_CACHE_MAX_MB * 1024 * 1024
+    to_spill = []
+    for key in list(registry["entries"]):
+        if registry["nbytes"] <= budget:
+            break
+        entry = registry["entries"][key]
+        if key == keep or entry["value"] is None:
+            continue
+        registry["nbytes"] -= entry["nbytes"]
+        if entry["sessions"]:
+            to_spill.append((key, entry["value"]))
+            entry["value"] = None
+        else:
+            del registry["entries"][key]
+            if entry["spill_path"] and os.path.exists(entry["spill_path"]):
+                os.remove(entry["spill_path"])
+    return to_spill
+
+def spill_datasets(registry, to_spill):
+    # 追い出したデータセットを pickle でディスクに書き出す（ロックの外で呼ぶ）
+    os.makedirs(DATASET_SPILL_DIR, exist_ok=True)
+    for key, value in to_spill:
+        path = spill_path_for_key(key)
+        if not os.path.exists(path):
+            with open(f"{path}.part", "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.part", path)
+        with registry["lock"]:
+            entry = registry["entries"].get(key)
+            if entry is not None:
+                entry["spill_path"] = path
+            elif os.path.exists(path):
+                # 書き出している間に削除されたデータセットのファイルは残さない
+                os.remove(path)
+
+def cached_ingest(key, loader, name=None):
+    # 登録済みならメモリから（退避済みならディスクから）再利用し、なければ loader() で読み込んで登録する
+    # 呼び出したセッションをデータセットの参照元として記録する
+    registry = get_dataset_registry()
+    session_id = current_session_id()
+    spill_path = None
+    with registry["lock"]:
+        entry = registry["entries"].get(key)
+        if entry is not None:
+            registry["entries"].move_to_end(key)
+            if session_id:
+                entry["sessions"].add(session_id)
+            if entry["value"] is not None:
+                return entry["value"]
+            spill_path = entry["spill_path"]
+    value = None
+    if spill_path and os.path.exists(spill_path):
+        with open(spill_path, "rb") as f:
+            value = pickle.load(f)
+    if value is None:
+        value = loader()
+    nbytes = estimate_nbytes(value)
+    with registry["lock"]:
+        entry = registry["entries"].setdefault(
+            key, {"value": None, "nbytes": 0, "spill_path": None, "name": name or key, "sessions": set()}
+        )
+        if entry["value"] is None:
+            entry["value"] = value
+            entry["nbytes"] = nbytes
+            registry["nbytes"] += nbytes
+        value = entry["value"]
+        if name:
+            entry["name"] = name
+        if session_id:
+            entry["sessions"].add(session_id)
+        registry["entries"].move_to_end(key)
+        to_spill = evict_over_budget(registry, keep=key)
+    spill_datasets(registry, to_spill)
+    return value
+
+def load_dataset(file_info):
+    # file_info（キーと読み込み方法のみ）から共有データセットを取得し、なければ読み込んで登録する
+    ext = os.path.splitext(file_info["name"])[1].lower()
+    if file_info.get("source") != "folder":
+        # アップロード・URLのファイルは表示中はディスクキャッシュから削除されないようにする
+        touch_cache_file(file_info.get("dataset_path"))
+    return cached_ingest(
+        file_info["cache_key"],
+        lambda: compact_dataset(parse_input_file(ext, file_info["dataset_path"], file_info.get("sidecar_key"))),
+        file_info["name"],
+    )
+
+def dataset_preview(file_info):
+    # 読み込み済みのファイルのデータセット（読み込みに失敗したファイルは None）
+    if not file_info.get("loaded") or "cache_key" not in file_info:
+        return None
+    dataset = load_dataset(file_info)
+    if file_info.get("derived") and isinstance(dataset, gpd.GeoDataFrame):
+        # このセッションで計算したゾーン統計・空間結合の結果を属性列として加える（共有データセット自体は変更しない）
+        # 前に計算した列も後の計算（ポイント1件あたりの値など）で使えるよう、順に加える
+        for spec in file_info["derived"]:
+            result = load_derived_columns(file_info, spec, dataset)
+            dataset = pd.concat([dataset.drop(columns=[col for col in result.columns if col in dataset.columns]), result], axis=1)
+    return dataset
+
+def dataset_key(file_info):
+    # データセットの内容を表すキー（計算して加えた列の設定を含む。レイヤー・グラフのキャッシュのキーに使う）
+    key = file_info.get("cache_key", file_info.get("name", ""))
+    return "|".join([key] + [spec["key"] for spec in file_info.get("derived", [])])
+
+def dataset_admin_panel():
+    # 共有データセットのメモリ使用量・退避状況・参照セッション数を表示する
+    registry = get_dataset_registry()
+    with st.expander("データセットの使用状況（管理者用）"):
+        with registry["lock"]:
+            release_unreferenced_datasets(registry)
+            rows = [
+                {
+                    "名前": entry["name"],
+                    "状態": "メモリ" if entry["value"] is not None else "ディスク",
+                    "サイズ(MB)": round(entry["nbytes"] / 1024 / 1024, 2),
+                    "参照セッション数": len(entry["sessions"]),
+                    "キー": key[:24],
+                }
+                for key, entry in reversed(registry["entries"].items())
+            ]
+            total = registry["nbytes"]
+        st.write(f"メモリ使用量: {total / 1024 / 1024:,.1f} MB / {INGEST_CACHE_MAX_MB:,} MB")
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True)
+        if st.button("参照のないデータセットを解放", key="release_datasets"):
+            with registry["lock"]:
+                release_unreferenced_datasets(registry, drop_all_unreferenced=True)
+            st.rerun()
+        stats = get_job_executor().stats()
+        st.caption(
+            f"ジョブ: 実行中 {stats['running']}・保持中の結果 {stats['results']}・実行 {stats['submitted']}・"
+            f"実行中のジョブを共有 {stats['deduplicated']}・取り消し {stats['cancelled']}"
+        )
+
+# 重い処理を実行するワーカープロセスの数（0 ならスクリプトのスレッドで直接実行）と、保持するジョブの結果の数
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+JOB_RESULT_CACHE_SIZE = int(os.environ.get("JOB_RESULT_CACHE_SIZE", "32"))
+# ジョブとして実行する大きさの目安（分類する列の行数、GeoJSON のファイルサイズ）
+JOB_MIN_ROWS = int(os.environ.get("JOB_MIN_ROWS", "500000"))
+JOB_MIN_GEOJSON_MB = int(os.environ.get("JOB_MIN_GEOJSON_MB", "20"))
+
+@st.cache_resource
+def get_job_executor():
+    # 全セッション共通のジョブ実行（プロセスプールと実行中のジョブ・結果を共有する）
+    return JobExecutor(max_workers=max(JOB_MAX_WORKERS, 1), max_results=JOB_RESULT_CACHE_SIZE)
+
+def run_job(key, func, *args, label, slot, keep_result=True, report_progress=True, **kwargs):
+    # func をジョブとして実行し、進捗バーを更新しながら完了を待って結果を返す
+    # slot は用途（同じセッション・同じ slot の前のジョブは、新しいジョブに置き換えられると取り消される）
+    # 同じ key のジョブが実行中なら（別のセッションのものでも）それを待つ
+    bar = None
+    if JOB_MAX_WORKERS <= 0:
+        if report_progress:
+            bar = st.progress(0.0, text=label)
+            kwargs["progress"] = lambda done, total=None: bar.progress(min(done / total, 1.0) if total else 0.0, text=label)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if bar is not None:
+                bar.empty()
+    executor = get_job_executor()
+    future = executor.submit(
+        key, func, *args, owner=f"{current_session_id()}:{slot}", keep_result=keep_result, report_progress=report_progress, **kwargs
+    )
+    start = time.perf_counter()
+    while not future.done():
+        if bar is None:
+            bar = st.progress(0.0, text=label)
+        done, total = executor.progress(key)
+        elapsed = time.perf_counter() - start
+        if total:
+            bar.progress(min(done / total, 1.0), text=f"{label}（{done:,} / {total:,}・{elapsed:,.0f} 秒）")
+        else:
+            bar.progress(0.0, text=f"{label}（{elapsed:,.0f} 秒）")
+        time.sleep(0.2)
+    if bar is not None:
+        bar.empty()
+    return future.result()
+
+# 対応する入力形式
+SUPPORTED_EXTS = [".csv", ".geojson", ".parquet", ".arrow", ".feather", ".tiff", ".tif"]
+# 表形式（ジオメトリ列を持たない場合は緯度経度カラムで表示）として読み込む拡張子と形式
+TABLE_FORMATS = {".csv": "csv", ".parquet": "parquet", ".arrow": "ipc", ".feather": "ipc"}
+# アップロード・URLのファイルを置くディレクトリ（環境変数 INPUT_CACHE_DIR で変更可能）
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_input_cache"))
+# CSV/GeoJSONを変換したGeoParquetキャッシュの置き場（環境変数 SIDECAR_CACHE_DIR で変更可能）
+SIDECAR_CACHE_DIR = os.environ.get("SIDECAR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_parquet_cache"))
+# 各ディスクキャッシュの合計サイズの上限（MB）。超えたら最後に使われた時刻の古いものから削除する
+INPUT_CACHE_MAX_MB = int(os.environ.get("INPUT_CACHE_MAX_MB", "4096"))
+SIDECAR_CACHE_MAX_MB = int(os.environ.get("SIDECAR_CACHE_MAX_MB", "4096"))
+# この時間（秒）以内に使われた・書き込まれたファイルは上限を超えていても削除しない（書き込み中・表示中のファイルを残す）
+DISK_CACHE_MIN_AGE_S = int(os.environ.get("DISK_CACHE_MIN_AGE_S", "3600"))
+# CSVを逐次読み込むときの1チャンクのサイズ（バイト）。プレビューは最初のチャンクのみ
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+CSV_PREVIEW_BLOCK_SIZE = 1024 * 1024
+# Parquetを逐次読み込むときの1チャンクの行数とプレビューの行数
+PARQUET_BATCH_ROWS = 1024 * 1024
+PARQUET_PREVIEW_ROWS = 10000
+
+def touch_cache_file(path):
+    # ディスクキャッシュのファイルの最後に使われた時刻（atime）を更新する
+    # 更新時刻（mtime）はファイルの版（file_version）として使うため変えない
+    try:
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except (FileNotFoundError, TypeError):
+        pass
+
+def prune_cache_dir(cache_dir, max_mb, keep=()):
+    # ディスクキャッシュの合計が上限を超えたら、最後に使われた時刻の古いものから削除する（keep と最近使われたものは残す）
+    # 同じ名前（最初の "." より前）のファイル（本文と .part・.json など）はまとめて扱う
+    try:
+        entries = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return
+    groups = {}
+    for entry in entries:
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        group = groups.setdefault(entry.name.split(".")[0], {"used": 0, "size": 0, "paths": []})
+        group["used"] = max(group["used"], stat.st_atime_ns, stat.st_mtime_ns)
+        group["size"] += stat.st_size
+        group["paths"].append(entry.path)
+    total = sum(group["size"] for group in groups.values())
+    budget = max_mb * 1024 * 1024
+    keep_names = {os.path.basename(path).split(".")[0] for path in keep}
+    cutoff = time.time_ns() - DISK_CACHE_MIN_AGE_S * 1_000_000_000
+    for name, group in sorted(groups.items(), key=lambda item: item[1]["used"]):
+        if total <= budget:
+            break
+        if name in keep_names or group["used"] > cutoff:
+            continue
+        for path in group["paths"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= group["size"]
+
+def materialize_input(source, suffix, cache_dir, max_mb=INPUT_CACHE_MAX_MB):
+    # ファイルライクオブジェクトは内容のハッシュ名でディスクに保存し、パスを返す
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    source.seek(0)
+    data = source.read()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{hashlib.sha256(data).hexdigest()}{suffix}")
+    if os.path.exists(path):
+        touch_cache_file(path)
+    else:
+        tmp_path = f"{path}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        prune_cache_dir(cache_dir, max_mb, keep=[path])
+    return path
+
+def is_point_table(preview):
+    # 緯度経度カラムで表示する表データか（GeoDataFrame・ラスタは除く）
+    return isinstance(preview, pd.DataFrame) and not isinstance(preview, gpd.GeoDataFrame)
+
+def open_ipc(path):
+    # Arrow IPC（Feather v2）をメモリマップで開く（列データはコピーせずに参照する）
+    return pa.ipc.open_file(pa.memory_map(path, "r"))
+
+def read_table_schema(path, fmt):
+    # Parquet/IPC のスキーマ（ジオメトリ列の有無は "geo" メタデータで判定する）
+    if fmt == "parquet":
+        return pq.read_schema(path, memory_map=True)
+    return open_ipc(path).schema
+
+def read_geo_table(path, fmt):
+    # GeoParquet / ジオメトリ付き Feather を GeoDataFrame として読み込む（地図用に WGS84 に変換）
+    gdf = gpd.read_parquet(path) if fmt == "parquet" else gpd.read_feather(path)
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    return gdf
+
+def read_table_head(path, fmt):
+    # ヘッダーと最初のチャンクだけを読み込む（列一覧・型の確認とプレビュー用）
+    if fmt == "csv":
+        reader = pa_csv.open_csv(path, read_options=pa_csv.ReadOptions(block_size=CSV_PREVIEW_BLOCK_SIZE))
+        schema = reader.schema
+        first = next(iter(reader), None)
+    elif fmt == "parquet":
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        schema = parquet_file.schema_arrow
+        first = next(parquet_file.iter_batches(batch_size=PARQUET_PREVIEW_ROWS), None)
+    else:
+        reader = open_ipc(path)
+        schema = reader.schema
+        first = reader.get_batch(0) if reader.num_record_batches > 0 else None
+    head = first.to_pandas() if first is not None else schema.empty_table().to_pandas()
+    head.attrs["path"] = path
+    head.attrs["format"] = fmt
+    return head
+
+def iter_table_batches(path, fmt, columns):
+    # 指定列のレコードバッチを順に返す（CSV・Parquetは逐次読み込み、IPCはメモリマップから参照）
+    if fmt == "csv":
+        yield from pa_csv.open_csv(
+            path,
+            read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(include_columns=list(columns)),
+        )
+    elif fmt == "parquet":
+        yield from pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=list(columns))
+    else:
+        reader = open_ipc(path)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).select(list(columns))
+
+def float32_is_safe(values):
+    # float32 に変換しても値が変わらないか（整数値のみの列は 2**24 以下、小数を含む列は相対誤差 1e-6 以内で戻るか）
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return True
+    if np.all(finite == np.round(finite)):
+        return np.abs(finite).max() <= 2 ** 24
+    with np.errstate(over="ignore"):
+        return np.allclose(values.astype(np.float32), values, rtol=1e-6, equal_nan=True)
+
+def numeric_code_strings(series):
+    # 数字だけの文字列（先頭が0のものを除く）からなる列か（コード列を整数に変換できるか）
+    values = series.dropna()
+    return len(values) > 0 and bool(values.astype(str).str.fullmatch(r"0|[1-9][0-9]{0,17}").all())
+
+def compact_frame(df, keep_float64=()):
+    # 属性列の型を小さくする（ジオメトリ列と keep_float64 の列はそのまま）
+    # ・小数は精度が保てる場合 float32、整数は最小の型に変換
+    # ・数字だけのコード文字列は整数、重複の多い文字列はカテゴリに変換
+    geometry_name = df.geometry.name if isinstance(df, gpd.GeoDataFrame) else None
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        if name == geometry_name or name in keep_float64 or isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            downcast = pd.to_numeric(series, downcast="integer")
+            if downcast.dtype != series.dtype:
+                columns[name] = downcast
+        elif pd.api.types.is_float_dtype(series):
+            if series.dtype != np.float32 and float32_is_safe(series.to_numpy(dtype=np.float64)):
+                columns[name] = series.astype(np.float32)
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            if numeric_code_strings(series):
+                codes = pd.to_numeric(series.astype(str).where(series.notna()))
+                if series.isna().any():
+                    columns[name] = codes.astype("Int64" if codes.max() > np.iinfo(np.int32).max else "Int32")
+                else:
+                    columns[name] = pd.to_numeric(codes.astype(np.int64), downcast="integer")
+            elif series.nunique(dropna=True) * 2 <= len(series):
+                columns[name] = series.astype("category")
+    if not columns:
+        return df
+    compacted = df.copy(deep=False)
+    for name, values in columns.items():
+        compacted[name] = values
+    compacted.attrs = dict(df.attrs)
+    return compacted
+
+def compact_dataset(value):
+    # 読み込み直後のデータの型を小さくし、変換前後のメモリ使用量を attrs["memory_report"] に記録する
+    if not isinstance(value, pd.DataFrame):
+        return value
+    before = estimate_nbytes(value)
+    compacted = compact_frame(value)
+    compacted.attrs["memory_report"] = (before, estimate_nbytes(compacted))
+    return compacted
+
+def format_nbytes(nbytes):
+    if nbytes >= 1024 * 1024:
+        return f"{nbytes / 1024 / 1024:,.1f} MB"
+    return f"{nbytes / 1024:,.1f} KB"
+
+def show_memory_report(data):
+    # 型の変換前後のメモリ使用量を表示する（表形式のファイルは読み込んだ先頭チャンク分）
+    report = data.attrs.get("memory_report") if isinstance(data, pd.DataFrame) else None
+    if not report:
+        return
+    before, after = report
+    scope = f"（先頭 {len(data):,} 行）" if "format" in data.attrs else ""
+    reduction = (1 - after / before) * 100 if before else 0.0
+    st.caption(f"メモリ使用量{scope}: {format_nbytes(before)} → {format_nbytes(after)}（{reduction:.0f}% 削減）")
+
+def compact_table_frame(table, keep_float64=()):
+    # 重複の多い文字列は辞書型（カテゴリ）に変換してから DataFrame にし、残りの列は compact_frame で小さくする
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            encoded = column.dictionary_encode()
+            if sum(len(chunk.dictionary) for chunk in encoded.chunks) * 2 <= len(column):
+                column = encoded
+        columns[name] = column
+    return compact_frame(pa.table(columns).to_pandas(), keep_float64)
+
+def update_column_stats(stats, name, values):
+    # 数値列の件数・平均・分散（M2）・最小・最大をチャンクごとに更新する（Chan らの方法で結合）
+    values = values[np.isfinite(values)]
+    n = values.size
+    if n == 0:
+        return
+    mean = float(values.mean())
+    m2 = float(((values - mean) ** 2).sum())
+    entry = stats.setdefault(name, {"count": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf})
+    total = entry["count"] + n
+    delta = mean - entry["mean"]
+    entry["m2"] += m2 + delta * delta * entry["count"] * n / total
+    entry["mean"] += delta * n / total
+    entry["count"] = total
+    entry["min"] = min(entry["min"], float(values.min()))
+    entry["max"] = max(entry["max"], float(values.max()))
+
+def column_stats_frame(stats):
+    # 集計結果を describe() と同じ並びの表にする
+    rows = {}
+    for name, entry in stats.items():
+        std = np.sqrt(entry["m2"] / (entry["count"] - 1)) if entry["count"] > 1 else np.nan
+        rows[name] = {"count": entry["count"], "mean": entry["mean"], "std": std, "min": entry["min"], "max": entry["max"]}
+    return pd.DataFrame(rows, index=["count", "mean", "std", "min", "max"])
+
+def read_table_columns(path, fmt, columns, keep_float64=()):
+    # 必要な列だけをチャンクごとに読み込み、統計量も同時に集計する
+    stats = {}
+    batches = []
+    try:
+        for batch in iter_table_batches(path, fmt, columns):
+            for name, column in zip(batch.schema.names, batch.columns):
+                if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+                    update_column_stats(stats, name, column.to_numpy(zero_copy_only=False).astype(np.float64))
+            batches.append(batch)
+    except pa.ArrowInvalid:
+        if fmt != "csv":
+            raise
+        # 先頭チャンクから推定した型と合わない行がある場合は一括で読み直す
+        df = pd.read_csv(path, usecols=list(columns), engine="pyarrow")
+        stats = {}
+        for name in df.columns:
+            if pd.api.types.is_numeric_dtype(df[name]):
+                update_column_stats(stats, name, df[name].to_numpy(dtype=np.float64, na_value=np.nan))
+        return compact_table_frame(pa.Table.from_pandas(df, preserve_index=False), keep_float64), column_stats_frame(stats)
+    if batches:
+        table = pa.Table.from_batches(batches)
+    else:
+        table = read_table_schema(path, fmt).empty_table().select(list(columns)) if fmt != "csv" else pa.table({c: [] for c in columns})
+    return compact_table_frame(table, keep_float64), column_stats_frame(stats)
+
+def load_table_columns(file_info, columns, keep_float64=()):
+    # 表データの指定列を読み込む（ファイルと列の組み合わせごとに読み込みキャッシュを使う）
+    head = dataset_preview(file_info)
+    columns = [c for c in dict.fromkeys(columns) if c is not None and c in head.columns]
+    path = head.attrs["path"]
+    # float64 のまま残す列によって読み込み結果が変わるため、キーに含める
+    keep_float64 = sorted(c for c in set(keep_float64) if c in columns)
+    key = f"{file_info.get('cache_key', path)}|columns:{json.dumps(columns, ensure_ascii=False)}|float64:{json.dumps(keep_float64, ensure_ascii=False)}"
+    return cached_ingest(
+        key, lambda: read_table_columns(path, head.attrs["format"], columns, keep_float64), f"{file_info['name']} ({', '.join(columns)})"
+    )
+
+def file_frame(file_info, columns):
+    # グラフなどで使う表データ（表形式のファイルは指定列のみ読み込む）
+    preview = dataset_preview(file_info)
+    if is_point_table(preview) and "format" in preview.attrs:
+        return load_table_columns(file_info, columns)[0]
+    return preview
+
+def sidecar_path(cache_key):
+    # 読み込みキャッシュのキー（パス・更新時刻・サイズ、または内容のハッシュ）ごとのGeoParquetキャッシュ
+    return os.path.join(SIDECAR_CACHE_DIR, f"{hashlib.sha256(cache_key.encode()).hexdigest()}.parquet")
+
+def write_csv_sidecar(source_path, path):
+    # CSVをチャンクごとにParquetへ書き出す（型が途中で合わない場合は一括で読み直す）
+    tmp_path = f"{path}.part"
+    try:
+        reader = pa_csv.open_csv(source_path, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE))
+        with pq.ParquetWriter(tmp_path, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+    except pa.ArrowInvalid:
+        pq.write_table(pa.Table.from_pandas(pd.read_csv(source_path, engine="pyarrow"), preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+def read_geojson(source):
+    # 大きな GeoJSON はワーカープロセスで読み込む（同じファイルを同時に読み込むセッションは1つのジョブを待つ）
+    # 読み込んだ結果は共有データセットとして保持するため、ジョブの結果としては保持しない
+    path = materialize_input(source, ".geojson", INPUT_CACHE_DIR)
+    stat = os.stat(path)
+    if stat.st_size < JOB_MIN_GEOJSON_MB * 1024 * 1024:
+        return gpd.read_file(path)
+    return run_job(
+        ("read_geojson", path, stat.st_mtime_ns, stat.st_size), gpd.read_file, path,
+        label=f"{os.path.basename(path)}（{stat.st_size / 1e6:,.0f} MB）を読み込み中", slot=f"read:{path}",
+        keep_result=False, report_progress=False,
+    )
+
+def parse_input_file(ext, source, sidecar_key=None):
+    # 拡張子ごとにファイルを読み込む（source はパスまたはファイルライクオブジェクト）
+    # 表形式はヘッダーと最初のチャンクのみ読み、必要な列は表示時に load_table_columns で読み込む
+    # sidecar_key を指定すると、CSV/GeoJSONをGeoParquetに変換して保存し、次回からはそちらを読む
+    if sidecar_key and ext in [".csv", ".geojson"]:
+        path = sidecar_path(sidecar_key)
+        if os.path.exists(path):
+            touch_cache_file(path)
+            return parse_input_file(".parquet", path)
+        os.makedirs(SIDECAR_CACHE_DIR, exist_ok=True)
+        if ext == ".csv":
+            try:
+                write_csv_sidecar(materialize_input(source, ext, INPUT_CACHE_DIR), path)
+                prune_cache_dir(SIDECAR_CACHE_DIR, SIDECAR_CACHE_MAX_MB, keep=[path])
+                return parse_input_file(".parquet", path)
+            except (pa.ArrowException, OSError):
+                # 変換できない場合はそのままCSVとして読み込む
+                pass
+        else:
+            gdf = read_geojson(source)
+            try:
+                gdf.to_parquet(f"{path}.part")
+                os.replace(f"{path}.part", path)
+                prune_cache_dir(SIDECAR_CACHE_DIR, SIDECAR_CACHE_MAX_MB, keep=[path])
+            except (ValueError, pa.ArrowException, OSError):
+                pass
+            return gdf
+    if ext in TABLE_FORMATS:
+        path = materialize_input(source, ext, INPUT_CACHE_DIR)
+        fmt = TABLE_FORMATS[ext]
+        if fmt != "csv" and (read_table_schema(path, fmt).metadata or {}).get(b"geo"):
+            return read_geo_table(path, fmt)
+        return read_table_head(path, fmt)
+    elif ext == ".geojson":
+        return read_geojson(source)
+    elif ext in [".tiff", ".tif"]:
+        return load_tiff_preview_as_array(source)
+    raise ValueError(f"対応していない拡張子です: {ext}")
+
+# URLから取得したファイルのキャッシュ（環境変数 URL_CACHE_DIR で変更可能）と同時に取得するURLの数
+URL_CACHE_DIR = os.environ.get("URL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_url_cache"))
+URL_CACHE_MAX_MB = int(os.environ.get("URL_CACHE_MAX_MB", "4096"))
+URL_MAX_WORKERS = int(os.environ.get("URL_MAX_WORKERS", "4"))
+URL_STATUS_LABELS = {"downloaded": "取得", "resumed": "途中から再開して取得", "revalidated": "変更なし・キャッシュを使用", "cached": "接続できないためキャッシュを使用"}
+
+@st.cache_resource
+def get_url_downloader():
+    # 全セッション共通のダウンローダー（スレッドプールと接続を共有する）
+    return UrlDownloader(URL_CACHE_DIR, max_workers=URL_MAX_WORKERS)
+
+def download_urls(urls):
+    # URLを並行に取得し、進捗バーを更新しながら完了を待つ（URL -> DownloadResult または例外）
+    downloader = get_url_downloader()
+    progress = {url: (0, None) for url in urls}
+    bars = {url: st.progress(0, text=f"{url.split('/')[-1]} を読み込み中...") for url in urls}
+    futures = {
+        url: downloader.submit(url, lambda done, total, url=url: progress.__setitem__(url, (done, total)))
+        for url in urls
+    }
+    while True:
+        finished = all(future.done() for future in futures.values())
+        for url, bar in bars.items():
+            done, total = progress[url]
+            if total:
+                bar.progress(min(done / total, 1.0), text=f"{url.split('/')[-1]}: {done / 1e6:,.1f} / {total / 1e6:,.1f} MB")
+            else:
+                # ファイルサイズが不明な場合は取得済みのサイズのみ表示
+                bar.progress(1.0 if futures[url].done() else 0, text=f"{url.split('/')[-1]}: {done / 1e6:,.1f} MB")
+        if finished:
+            break
+        time.sleep(0.2)
+    results = {}
+    for url, future in futures.items():
+        try:
+            results[url] = future.result()
+        except Exception as e:
+            results[url] = e
+    return results
+
+def load_url_entries(jobs, use_sidecar):
+    # jobs: [(url_entries のインデックス, URL)]。並行に取得してから順に読み込み、すべて成功したら True
+    for _, url in jobs:
+        ext = os.path.splitext(url.split("/")[-1])[1].lower()
+        if ext not in SUPPORTED_EXTS:
+            st.error(f"対応していない拡張子です: {ext}")
+            return False
+    results = download_urls([url for _, url in jobs])
+    paths = [result.path for result in results.values() if not isinstance(result, Exception)]
+    for path in paths:
+        touch_cache_file(path)
+    prune_cache_dir(URL_CACHE_DIR, URL_CACHE_MAX_MB, keep=paths)
+    all_loaded = True
+    for i, url in jobs:
+        file_name = url.split("/")[-1]
+        ext = os.path.splitext(file_name)[1].lower()
+        st.session_state["url_entries"][i]["name"] = file_name
+        result = results[url]
+        try:
+            if isinstance(result, Exception):
+                raise result
+            st.success(f"{file_name} へのアクセス成功（{URL_STATUS_LABELS[result.status]}）")
+            # 取得したファイルをそのまま読み込む（同じファイルは読み込みキャッシュを再利用）
+            entry = st.session_state["url_entries"][i]
+            entry["cache_key"] = ingest_key_for_path(result.path)
+            entry["dataset_path"] = result.path
+            entry["sidecar_key"] = entry["cache_key"] if use_sidecar else None
+            load_dataset(entry)
+            # ロード完了フラグ
+            entry["loaded"] = True
+        except Exception as e:
+            all_loaded = False
+            st.error(f"ファイル読み込みエラー ({file_name}): {e}")
+    return all_loaded
+
 def file_selection_screen():
     # 全体の再読み込みボタン
     if st.button("ページのリロード"):
         st.rerun()
+    # CSV/GeoJSONは初回読み込み時にGeoParquetへ変換して保存し、次回以降はそちらを読み込む
+    use_sidecar = st.checkbox("CSV/GeoJSONをGeoParquetキャッシュに変換して次回以降の読み込みを高速化する", value=True, key="use_sidecar_cache")
 
     # 1. Inputフォルダからの選択
     # セッション変数 "folder_entries" の初期化（もし存在しなければ）
@@ -39,10 +747,12 @@ def file_selection_screen():
     input_folder = "input"
     if os.path.isdir(input_folder):
         folder_files = os.listdir(input_folder)
-        supported_exts = ['.csv', '.geojson', '.tiff', '.tif']
-        folder_files = [f for f in folder_files if any(f.lower().endswith(ext) for ext in supported_exts)]
+        folder_files = [f for f in folder_files if any(f.lower().endswith(ext) for ext in SUPPORTED_EXTS)]
         folder_selected = st.multiselect("Inputフォルダ内のファイル", folder_files)
         for file_name in folder_selected:
+            # 読み込み済みのファイルは再読み込みしない
+            if any(entry['name'] == file_name for entry in st.session_state["folder_entries"]):
+                continue
             # 各要素の初期値を file_info にまとめて設定
             file_info = {
                 "source": "folder",
@@ -52,38 +762,21 @@ def file_selection_screen():
                 "lat_col": st.session_state.get(f"lat_column_{file_name}", "lat"),
                 "lon_col": st.session_state.get(f"lon_column_{file_name}", "lon"),
                 "band": st.session_state.get(f"band_folder_{file_name}", 1),
-                "preview": None,
             }
             ext = os.path.splitext(file_name)[1].lower()
-            if ext == ".csv":
-                try:
-                    df = pd.read_csv(file_info["path"])
-                    file_info["preview"] = df
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"CSVプレビュー読み込みエラー ({file_name}): {e}")
-                # テキスト入力でユーザーが変更した値を反映（セッションの初期値として利用）
-                # file_info['lat_col'] = st.text_input(f"{file_name} の緯度カラム", value=file_info["lat_col"], key=f"lat_column_{file_name}")
-                # st.success(f"{file_name} の緯度カラムを{file_info['lat_col']} に設定しました。")
-                # file_info['lon_col'] = st.text_input(f"{file_name} の経度カラム", value=file_info["lon_col"], key=f"lon_column_{file_name}")
-                # st.success(f"{file_name} の経度カラムを{file_info['lon_col']} に設定しました。")
-            elif ext == ".geojson":
-                try:
-                    gdf = gpd.read_file(file_info["path"])
-                    file_info["preview"] = gdf
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"GeoJSONプレビュー読み込みエラー ({file_name}): {e}")
-            elif ext in [".tiff", ".tif"]:
-                try:
-                    file_info["preview"] = load_tiff_preview_as_array(file_info["path"])
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"TIFFメタデータ読み込みエラー ({file_name}): {e}")
+            error_labels = {".csv": "CSVプレビュー読み込みエラー", ".geojson": "GeoJSONプレビュー読み込みエラー", ".parquet": "Parquetプレビュー読み込みエラー", ".arrow": "Arrowプレビュー読み込みエラー", ".feather": "Arrowプレビュー読み込みエラー", ".tiff": "TIFFメタデータ読み込みエラー", ".tif": "TIFFメタデータ読み込みエラー"}
+            try:
+                file_info["cache_key"] = ingest_key_for_path(file_info["path"])
+                file_info["dataset_path"] = file_info["path"]
+                file_info["sidecar_key"] = file_info["cache_key"] if use_sidecar else None
+                # データ本体は共有の置き場に登録し、セッションにはキーのみ保持する
+                load_dataset(file_info)
+                file_info["loaded"] = True
+            except Exception as e:
+                st.error(f"{error_labels.get(ext, 'ファイル読み込みエラー')} ({file_name}): {e}")
 
             # file_infoを追加
-            if not any(entry['name'] == file_info['name'] for entry in st.session_state["folder_entries"]):
-                st.session_state["folder_entries"].append(file_info)
+            st.session_state["folder_entries"].append(file_info)
 
         # プレビューとカラムの設定
         for i, file_info in enumerate(st.session_state["folder_entries"]):
@@ -91,15 +784,16 @@ def file_selection_screen():
                 file_name = file_info["name"]
                 ext = os.path.splitext(file_name)[1].lower()
                 st.write(f"**{file_name} プレビュー:**")
-                preview_data = file_info["preview"]
+                preview_data = dataset_preview(file_info)
                 if isinstance(preview_data, pd.DataFrame):
                     st.dataframe(preview_data.head())
                 elif isinstance(preview_data, gpd.GeoDataFrame):
                     st.dataframe(preview_data.head())
                 else:
                     st.json(preview_data)
+                show_memory_report(preview_data)
                 # CSVの場合は緯度経度カラム、TIFFの場合はバンドなどを入力
-                if ext == ".csv":
+                if is_point_table(preview_data):
                     lat_col_key = f"lat_column_{file_name}"
                     lon_col_key = f"lon_column_{file_name}"
                     lat_default = st.session_state.get(f"lat_column_{file_name}", "lat")
@@ -129,7 +823,7 @@ def file_selection_screen():
     # 1_セッションステートの初期化
     if "url_entries" not in st.session_state:
         # loaded: ロード済かどうか (bool)
-        # preview: 読み込んだDataFrame/GeoDataFrame/メタデータなど
+        # cache_key, dataset_path: 共有データセットのキーと読み込み元（データ本体は dataset_preview で取得）
         # lat_col, lon_col, band: カラム設定用（必要に応じて初期値を入れておく）
         st.session_state["url_entries"] = [
             {
@@ -140,7 +834,6 @@ def file_selection_screen():
                 "lat_col": "lat",
                 "lon_col": "lon",
                 "band": 1,
-                "preview": None,
             }
         ]
     # 2_URL入力欄とファイル読み込みのロジック # url_entriesリストを順番に処理する
@@ -161,83 +854,24 @@ def file_selection_screen():
         if not entry["loaded"] and st.button("読み込み", key=f"load_url_{i}"):
             # URLをセッションステートにも反映
             st.session_state["url_entries"][i]["url"] = url_input
-            if url_input:
-                file_name = url_input.split("/")[-1]
-                st.session_state["url_entries"][i]["name"] = file_name
-                ext = os.path.splitext(file_name)[1].lower()
-                # 2-1_ファイルの種類毎に読み込み
-                try:
-                    with st.spinner(f"{file_name} を読み込み中..."):
-                        response = requests.get(url_input, stream=True)
-                        # ステータスコードチェック
-                        if response.status_code == 200:
-                            st.success(f"{file_name} へのアクセス成功（Status: {response.status_code}）")
-                        else:
-                            st.error(f"{file_name} へのアクセス拒否（Status: {response.status_code}）")
-                        response.raise_for_status()
-                        # ダウンロード進捗
-                        total_size = int(response.headers.get("content-length", 0))
-                        data_chunks = []
-                        bytes_downloaded = 0
-                        chunk_size = 1024
-                        # ファイルサイズが不明かどうかで処理を分ける
-                        if total_size == 0:
-                            st.warning("ファイルサイズが不明なため、進捗表示はスキップします。")
-                            data_chunks.append(response.content)
-                        else:
-                            progress_bar = st.progress(0)
-                            for chunk in response.iter_content(chunk_size=chunk_size):
-                                if chunk:
-                                    data_chunks.append(chunk)
-                                    bytes_downloaded += len(chunk)
-                                    progress = int(min(bytes_downloaded / total_size, 1.0) * 100)
-                                    progress_bar.progress(progress)
-                        # 2-2. 取得データの読み込み処理
-                        if ext == ".csv":
-                            csv_data = b"".join(data_chunks).decode("utf-8")
-                            df = pd.read_csv(StringIO(csv_data))
-                            st.success(f"{file_name} の読み込みが完了しました。")
-                            st.session_state["url_entries"][i]["preview"] = df
-                        elif ext == ".geojson":
-                            geojson_data = b"".join(data_chunks).decode("utf-8")
-                            geojson_dict = json.loads(geojson_data)
-                            gdf = gpd.GeoDataFrame.from_features(geojson_dict["features"])
-                            st.success(f"{file_name} の読み込みが完了しました。")
-                            st.session_state["url_entries"][i]["preview"] = gdf
-                        elif ext in [".tiff", ".tif"]:
-                            tiff_data = b"".join(data_chunks)
-                            with MemoryFile(tiff_data) as memfile:
-                                with memfile.open() as src:
-                                    bounds = src.bounds  # left, bottom, right, top
-                                    image_data = src.read()  # shape: (bands, height, width)
-                                    gray = image_data[0]
-                                    preview = {"img_array": gray, "bounds": [[bounds.left, bounds.bottom], [bounds.right, bounds.top]]}
-                            st.success(f"{file_name} の読み込みが完了しました。")
-                            st.session_state["url_entries"][i]["preview"] = preview
-                        else:
-                            st.error(f"対応していない拡張子です: {ext}")
-                            st.stop()
-                    # ロード完了フラグ
-                    st.session_state["url_entries"][i]["loaded"] = True
-                    # URL入力欄をマスク
-                    st.rerun()
-
-                except Exception as e:
-                    st.error(f"ファイル読み込みエラー ({file_name}): {e}")
+            # 取得と読み込みが成功したらURL入力欄をマスク
+            if url_input and load_url_entries([(i, url_input)], use_sidecar):
+                st.rerun()
         # 3_既に読み込み済みならプレビュー表示 & カラム指定表示
         if entry["loaded"]:
             file_name = entry["url"].split("/")[-1]
             ext = os.path.splitext(file_name)[1].lower()
             st.write(f"**{file_name} のプレビュー:**")
-            preview_data = st.session_state["url_entries"][i]["preview"]
+            preview_data = dataset_preview(entry)
             if isinstance(preview_data, pd.DataFrame):
                 st.dataframe(preview_data.head())
             elif isinstance(preview_data, gpd.GeoDataFrame):
                 st.dataframe(preview_data.head())
             else:
                 st.json(preview_data)
+            show_memory_report(preview_data)
             # CSVの場合は緯度経度カラム、TIFFの場合はバンドなどを入力
-            if ext == ".csv":
+            if is_point_table(preview_data):
                 lat_col_key = f"lat_column_{file_name}"
                 lon_col_key = f"lon_column_{file_name}"
                 lat_default = st.session_state.get(f"lat_column_{file_name}", "lat")
@@ -258,6 +892,34 @@ def file_selection_screen():
                     f"{file_name} の色分け用バンド", value=band_default, key=band_key
                 )
                 st.success(f"{file_name} の色分け用バンドを{band_default} に設定しました。")
+    # 複数のURLをまとめて（並行に）読み込む
+    bulk_urls = st.text_area("複数のURLをまとめて読み込む（1行に1つ）", key="bulk_url_input")
+    if st.button("まとめて読み込み", key="load_bulk_urls"):
+        jobs = []
+        for url in dict.fromkeys(line.strip() for line in bulk_urls.splitlines() if line.strip()):
+            if url in [ent["url"] for ent in st.session_state["url_entries"]]:
+                st.warning(f"同じURLが既に入力されています: {url}")
+                continue
+            # 未入力の欄があれば使い、なければ欄を追加する
+            index = next((j for j, ent in enumerate(st.session_state["url_entries"]) if ent["url"] == "" and not ent["loaded"]), None)
+            if index is None:
+                st.session_state["url_entries"].append(
+                    {
+                        "source": "url",
+                        "name": "",
+                        "url": "",
+                        "loaded": False,
+                        "lat_col": "lat",
+                        "lon_col": "lon",
+                        "band": 1,
+                    }
+                )
+                index = len(st.session_state["url_entries"]) - 1
+            st.session_state["url_entries"][index]["url"] = url
+            jobs.append((index, url))
+        if jobs and load_url_entries(jobs, use_sidecar):
+            st.rerun()
+
     # 4_“次のファイル入力”の自動追加
     #    最後のエントリがloaded=Trueになったら、新規URL入力欄を追加する
     last_index = len(st.session_state["url_entries"]) - 1
@@ -278,7 +940,6 @@ def file_selection_screen():
                     "lat_col": "lat",
                     "lon_col": "lon",
                     "band": 1,
-                    "preview": None,
                 }
             )
             st.rerun()
@@ -289,10 +950,13 @@ def file_selection_screen():
         st.session_state["upload_entries"] = []
 
     st.subheader("3. ファイルをアップロードして入力")
-    uploaded_files = st.file_uploader("ファイルをアップロード", type=["csv", "geojson", "tiff", "tif"], accept_multiple_files=True, key="file_uploader")
+    uploaded_files = st.file_uploader("ファイルをアップロード", type=[ext.lstrip(".") for ext in SUPPORTED_EXTS], accept_multiple_files=True, key="file_uploader")
     if uploaded_files:
         for uploaded_file in uploaded_files:
             file_name = uploaded_file.name
+            # 読み込み済みのファイルは再読み込みしない
+            if any(entry['name'] == file_name for entry in st.session_state["upload_entries"]):
+                continue
             # 各要素の初期値を設定して file_info を作成
             file_info = {
                 "source": "upload",
@@ -302,36 +966,22 @@ def file_selection_screen():
                 "lat_col": st.session_state.get(f"lat_column_{file_name}", "lat"),
                 "lon_col": st.session_state.get(f"lon_column_{file_name}", "lon"),
                 "band": st.session_state.get(f"band_upload_{file_name}", 1),
-                "preview": None,
             }
             ext = os.path.splitext(file_name)[1].lower()
-            if ext == ".csv":
-                try:
-                    uploaded_file.seek(0)
-                    df = pd.read_csv(uploaded_file)
-                    file_info["preview"] = df
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"アップロードCSVプレビュー読み込みエラー ({file_name}): {e}")
-            elif ext == ".geojson":
-                try:
-                    uploaded_file.seek(0)
-                    gdf = gpd.read_file(uploaded_file)
-                    file_info["preview"] = gdf
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"アップロードGeoJSONプレビュー読み込みエラー ({file_name}): {e}")
-            elif ext in [".tiff", ".tif"]:
-                try:
-                    uploaded_file.seek(0)
-                    file_info["preview"] = load_tiff_preview_as_array(uploaded_file)
-                    file_info["loaded"] = True
-                except Exception as e:
-                    st.error(f"TIFFメタデータ読み込みエラー ({file_name}): {e}")
+            error_labels = {".csv": "アップロードCSVプレビュー読み込みエラー", ".geojson": "アップロードGeoJSONプレビュー読み込みエラー", ".parquet": "アップロードParquetプレビュー読み込みエラー", ".arrow": "アップロードArrowプレビュー読み込みエラー", ".feather": "アップロードArrowプレビュー読み込みエラー", ".tiff": "TIFFメタデータ読み込みエラー", ".tif": "TIFFメタデータ読み込みエラー"}
+            try:
+                body = uploaded_file.getvalue()
+                file_info["cache_key"] = ingest_key_for_bytes(body)
+                # 別のセッションからも読み直せるようにディスクに保存する
+                file_info["dataset_path"] = materialize_input(BytesIO(body), ext, INPUT_CACHE_DIR)
+                file_info["sidecar_key"] = file_info["cache_key"] if use_sidecar else None
+                load_dataset(file_info)
+                file_info["loaded"] = True
+            except Exception as e:
+                st.error(f"{error_labels.get(ext, 'ファイル読み込みエラー')} ({file_name}): {e}")
 
             # file_infoを追加
-            if not any(entry['name'] == file_info['name'] for entry in st.session_state["upload_entries"]):
-                st.session_state["upload_entries"].append(file_info)
+            st.session_state["upload_entries"].append(file_info)
 
         # プレビューとカラムの設定
         for i, file_info in enumerate(st.session_state["upload_entries"]):
@@ -339,15 +989,16 @@ def file_selection_screen():
                 file_name = file_info["name"]
                 ext = os.path.splitext(file_name)[1].lower()
                 st.write(f"**{file_name} プレビュー:**")
-                preview_data = file_info["preview"]
+                preview_data = dataset_preview(file_info)
                 if isinstance(preview_data, pd.DataFrame):
                     st.dataframe(preview_data.head())
                 elif isinstance(preview_data, gpd.GeoDataFrame):
                     st.dataframe(preview_data.head())
                 else:
                     st.json(preview_data)
+                show_memory_report(preview_data)
                 # CSVの場合は緯度経度カラム、TIFFの場合はバンドなどを入力
-                if ext == ".csv":
+                if is_point_table(preview_data):
                     lat_col_key = f"lat_column_{file_name}"
                     lon_col_key = f"lon_column_{file_name}"
                     lat_default = st.session_state.get(f"lat_column_{file_name}", "lat")
@@ -384,61 +1035,1089 @@ def file_selection_screen():
             st.success(f"{file_info.get('name', 'error:name')} ({file_info.get('source', 'error:source')})")
             # st.write(f"file_info: {file_info}")
 
-def load_tiff_preview_as_array(file_path): # 単一バンドのみに対応
-    with rasterio.open(file_path) as src:
-        bounds = src.bounds  # left, bottom, right, top
-        image_data = src.read()  # shape: (bands, height, width)
-        gray = image_data[0]
-    return {"img_array": gray, "bounds": [[bounds.left, bounds.bottom], [bounds.right, bounds.top]]}
+    # 全セッションで共有しているデータセットの使用状況
+    dataset_admin_panel()
+
+# アップロード・URLのラスタを置くディレクトリ（環境変数 RASTER_CACHE_DIR で変更可能）
+RASTER_CACHE_DIR = os.environ.get("RASTER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_raster_cache"))
+RASTER_CACHE_MAX_MB = int(os.environ.get("RASTER_CACHE_MAX_MB", "4096"))
+# 表示用に読み込むラスタの最大辺（ピクセル）
+RASTER_DISPLAY_MAX_SIZE = 1024
+
+def materialize_raster(source):
+    # ファイルライクオブジェクトは内容のハッシュ名でディスクに保存し、パスを返す
+    return materialize_input(source, ".tif", RASTER_CACHE_DIR, RASTER_CACHE_MAX_MB)
+
+@st.cache_resource(max_entries=32)
+def open_raster(path, version=None):
+    # 全解像度のラスタは開いたままにして、必要な範囲だけを読み出す（同時アクセスはロックで保護）
+    # version（file_version の更新時刻とサイズ）ごとに開き直し、置き換えられたファイルの古い画素を使わない
+    return {"src": rasterio.open(path), "lock": threading.Lock()}
+
+def load_tiff_preview_as_array(file_path):
+    # ラスタのメタデータのみを読み込む（画素値は read_raster_band で表示解像度に間引いて読む）
+    path = materialize_raster(file_path)
+    handle = open_raster(path, file_version(path))
+    with handle["lock"]:
+        src = handle["src"]
+        left, bottom, right, top = src.bounds
+        if src.crs and src.crs.to_epsg() != 4326:
+            left, bottom, right, top = rasterio.warp.transform_bounds(src.crs, "EPSG:4326", left, bottom, right, top)
+        return {
+            "path": path,
+            "band_count": src.count,
+            "width": src.width,
+            "height": src.height,
+            "crs": src.crs.to_string() if src.crs else None,
+            "bounds": [[left, bottom], [right, top]],
+        }
+
+# ゾーン統計のラベル格子の保存先と、選べるパーセンタイル
+ZONAL_CACHE_DIR = os.environ.get("ZONAL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_zonal_labels"))
+ZONAL_CACHE_MAX_MB = int(os.environ.get("ZONAL_CACHE_MAX_MB", "2048"))
+ZONAL_PERCENTILES = [10, 25, 50, 75, 90, 95, 99]
+
+def load_zonal_statistics(file_info, spec):
+    # ポリゴンごとのゾーン統計（spec の設定ごとに共有データセットとして保持する）
+    def compute():
+        zones = load_dataset(file_info)
+        weight_zones = weight_values = weight_key = None
+        if spec["weight"]:
+            mesh = load_dataset(spec["weight"])
+            weight_zones = mesh.geometry
+            weight_values = mesh[spec["weight_col"]]
+            weight_key = spec["weight"]["cache_key"]
+        # ラスタの大きさに比例して時間がかかるため、ジョブとして実行する（結果は共有データセットとして保持する）
+        result = run_job(
+            ("zonal", spec["key"]), zonal_statistics,
+            spec["raster_path"], spec["band"], zones.geometry, file_info["cache_key"], spec["percentiles"],
+            weight_zones, weight_values, weight_key, cache_dir=ZONAL_CACHE_DIR,
+            label=f"{file_info['name']} のゾーン統計を計算中", slot="zonal", keep_result=False,
+        )
+        prune_cache_dir(ZONAL_CACHE_DIR, ZONAL_CACHE_MAX_MB)
+        result = result.rename(columns={"weighted_mean": "pop_weighted_mean", "weight_sum": spec["weight_col"]})
+        result.columns = [f"{spec['prefix']}_{col}" for col in result.columns]
+        result.index = zones.index
+        return result
+    return cached_ingest(spec["key"], compute, f"{file_info['name']} (ゾーン統計 {spec['prefix']})")
+
+def polygon_layers(datasets):
+    # 読み込み済みのデータセットのうちポリゴンのレイヤー（名前 → (file_info, データセット)）
+    return {
+        fi["name"]: (fi, ds) for fi, ds in datasets
+        if isinstance(ds, gpd.GeoDataFrame) and len(ds) and ds.geometry.geom_type.iloc[0] in ("Polygon", "MultiPolygon")
+    }
+
+def point_layers(datasets):
+    # ポイントのレイヤー（名前 → (file_info, データセット, 位置を表すカラム)）：緯度経度の列がある表と、ポイントの GeoDataFrame
+    points = {}
+    for fi, ds in datasets:
+        if is_point_table(ds) and fi.get("lat_col", "lat") in ds.columns and fi.get("lon_col", "lon") in ds.columns:
+            points[fi["name"]] = (fi, ds, (fi.get("lat_col", "lat"), fi.get("lon_col", "lon")))
+        elif isinstance(ds, gpd.GeoDataFrame) and len(ds) and ds.geometry.geom_type.iloc[0] == "Point":
+            points[fi["name"]] = (fi, ds, (ds.geometry.name,))
+    return points
+
+def zonal_statistics_controls(entries):
+    # 読み込み済みのポリゴンと GeoTIFF から、ポリゴンごとの統計量を計算して属性列に加える
+    datasets = [(fi, dataset_preview(fi)) for fi in entries]
+    polygons = polygon_layers(datasets)
+    rasters = {fi["name"]: (fi, ds) for fi, ds in datasets if isinstance(ds, dict) and "band_count" in ds}
+    if not polygons or not rasters:
+        return
+    with st.sidebar.expander("ゾーン統計（ラスタ × ポリゴン）"):
+        zone_name = st.selectbox("集計するポリゴン", list(polygons), key="zonal_zones")
+        raster_name = st.selectbox("集計するラスタ", list(rasters), key="zonal_raster")
+        zone_info, _ = polygons[zone_name]
+        raster_info, raster = rasters[raster_name]
+        band = st.number_input("バンド", 1, raster["band_count"], 1, key="zonal_band")
+        percentiles = st.multiselect("パーセンタイル", ZONAL_PERCENTILES, default=[50, 90], key="zonal_percentiles")
+        # 人口メッシュの人口をメッシュ内の画素に等分し、人口で重み付けした平均とポリゴン内の人口を求める
+        weight_name = st.selectbox(
+            "人口メッシュで重み付け", [None] + [name for name in polygons if name != zone_name],
+            format_func=lambda x: "なし" if x is None else x, key="zonal_weight",
+        )
+        weight_info = weight_col = None
+        if weight_name:
+            weight_info, mesh = polygons[weight_name]
+            numeric_cols = [col for col in mesh.columns if col != mesh.geometry.name and pd.api.types.is_numeric_dtype(mesh[col])]
+            weight_col = st.selectbox("人口のカラム", numeric_cols, key=f"zonal_weight_col_{weight_name}")
+        prefix = st.text_input("追加する列名の接頭辞", value=os.path.splitext(raster_name)[0][:16], key=f"zonal_prefix_{raster_name}").strip()
+        if st.button("ゾーン統計を計算", key="zonal_run"):
+            spec = {
+                "kind": "zonal",
+                "raster_path": raster["path"],
+                "band": int(band),
+                "percentiles": sorted(percentiles),
+                "weight": None if weight_info is None else {k: weight_info[k] for k in ("name", "cache_key", "dataset_path", "sidecar_key") if k in weight_info},
+                "weight_col": weight_col,
+                "prefix": prefix or "zonal",
+            }
+            spec["key"] = f"{zone_info['cache_key']}|zonal:" + json.dumps(
+                [raster_info["cache_key"], spec["band"], spec["percentiles"], weight_info and weight_info["cache_key"], weight_col, spec["prefix"]],
+                ensure_ascii=False,
+            )
+            try:
+                start = time.perf_counter()
+                with st.spinner("ゾーン統計を計算中..."):
+                    result = load_zonal_statistics(zone_info, spec)
+                add_derived_columns(zone_info, spec)
+                st.success(f"{zone_name} に {len(result.columns)} 列を追加しました（{time.perf_counter() - start:.1f} 秒）")
+                st.caption("、".join(result.columns))
+            except Exception as e:
+                st.error(f"ゾーン統計の計算エラー: {e}")
+
+def add_derived_columns(file_info, spec):
+    # 計算した列の設定をセッションのファイル情報に記録する（同じ接頭辞の結果は置き換える）
+    file_info["derived"] = [s for s in file_info.get("derived", []) if s["prefix"] != spec["prefix"]] + [spec]
+
+def load_derived_columns(file_info, spec, dataset):
+    if spec["kind"] == "join":
+        return load_spatial_join(file_info, spec, dataset)
+    if spec["kind"] == "access":
+        return load_accessibility(file_info, spec)
+    return load_zonal_statistics(file_info, spec)
+
+# 空間結合で一度に作る Point の数（100万点の Point は数百MBになるため分けて問い合わせる）
+JOIN_CHUNK_POINTS = 200000
+
+def points_in_polygons(lon, lat, tree, chunk_size=JOIN_CHUNK_POINTS):
+    # 各ポイントを含むポリゴンの番号（含まれなければ -1）を STRtree への一括問い合わせで求める
+    lon = pd.to_numeric(pd.Series(lon), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(pd.Series(lat), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    assignment = np.full(len(lon), -1, dtype=np.int64)
+    valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    for start in range(0, len(valid), chunk_size):
+        rows = valid[start:start + chunk_size]
+        point_idx, polygon_idx = tree.query(shapely.points(lon[rows], lat[rows]), predicate="intersects")
+        # 境界上などで複数のポリゴンに含まれる場合は番号の小さいポリゴンに割り当てる
+        order = np.lexsort((polygon_idx, point_idx))
+        point_idx = point_idx[order]
+        polygon_idx = polygon_idx[order]
+        first = np.r_[True, point_idx[1:] != point_idx[:-1]] if len(point_idx) else np.zeros(0, dtype=bool)
+        assignment[rows[point_idx[first]]] = polygon_idx[first]
+    return assignment
+
+def spatial_join_statistics(assignment, n_polygons, values):
+    # ポリゴンごとのポイント数と、ポイントの属性の合計・平均・最大
+    matched = assignment >= 0
+    polygon_idx = assignment[matched]
+    result = pd.DataFrame({"count": np.bincount(polygon_idx, minlength=n_polygons)})
+    for col in values.columns:
+        vals = pd.to_numeric(values[col], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)[matched]
+        has_val = np.isfinite(vals)
+        val_count = np.bincount(polygon_idx[has_val], minlength=n_polygons)
+        val_sum = np.bincount(polygon_idx[has_val], weights=vals[has_val], minlength=n_polygons)
+        val_max = np.full(n_polygons, -np.inf)
+        np.maximum.at(val_max, polygon_idx[has_val], vals[has_val])
+        result[f"{col}_sum"] = val_sum
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[f"{col}_mean"] = np.where(val_count > 0, val_sum / val_count, np.nan)
+        result[f"{col}_max"] = np.where(val_count > 0, val_max, np.nan)
+    return result
+
+def point_layer_columns(file_info, columns):
+    # ポイントのレイヤーの経度・緯度と属性列（表は必要な列だけを読み込む）
+    dataset = load_dataset(file_info)
+    if isinstance(dataset, gpd.GeoDataFrame):
+        return dataset.geometry.x, dataset.geometry.y, dataset[list(columns)]
+    lat_col = file_info.get("lat_col", "lat")
+    lon_col = file_info.get("lon_col", "lon")
+    positions, _ = load_table_columns(file_info, [lon_col, lat_col], keep_float64=(lon_col, lat_col))
+    attrs = load_table_columns(file_info, columns)[0] if columns else pd.DataFrame(index=positions.index)
+    return positions[lon_col], positions[lat_col], attrs
+
+def load_spatial_join(file_info, spec, polygons):
+    # ポイントを含むポリゴンに割り当て、ポリゴンごとに集計する（集計結果は共有データセットとして保持する）
+    def compute():
+        zones = load_dataset(file_info)
+        lon, lat, values = point_layer_columns(spec["points"], spec["value_cols"])
+        index = geometry_index(file_info["cache_key"], zones.geometry.values)
+        result = spatial_join_statistics(points_in_polygons(lon, lat, index["tree"]), len(zones), values)
+        result.index = zones.index
+        return result
+    counts = cached_ingest(spec["key"], compute, f"{file_info['name']} (空間結合 {spec['prefix']})")
+    result = counts.copy()
+    # ポリゴンの属性をポイント1件あたりにした値（例：避難所1か所あたりの人口）
+    for col in spec["ratio_cols"]:
+        if col in polygons.columns:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result[f"{col}_per_point"] = np.where(counts["count"] > 0, pd.to_numeric(polygons[col], errors="coerce") / counts["count"], np.nan)
+    result.columns = [f"{spec['prefix']}_{col}" for col in result.columns]
+    return result
+
+# 最寄り施設の距離で選べる k と、半径内の施設数を数える半径（m）の既定値
+ACCESS_MAX_K = 5
+ACCESS_DEFAULT_RADIUS_M = 500
+
+@st.cache_resource(max_entries=16)
+def facility_tree(file_key, lon_col, lat_col, crs, _xy):
+    # 施設のポイント（投影座標, m）の KD木を施設レイヤー・位置の列・座標系ごとに一度だけ作る
+    return KDTree(_xy)
+
+def facility_points(file_info, id_col, crs):
+    # 施設の投影座標（m）と施設ID（ID列がなければ行番号）
+    lon, lat, attrs = point_layer_columns(file_info, [id_col] if id_col else [])
+    lon = pd.to_numeric(pd.Series(lon), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(pd.Series(lat), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    points = gpd.GeoSeries(gpd.points_from_xy(lon[valid], lat[valid]), crs="EPSG:4326").to_crs(crs)
+    ids = attrs[id_col].to_numpy()[valid] if id_col else valid
+    return np.column_stack([points.x.to_numpy(), points.y.to_numpy()]), ids
+
+def load_accessibility(file_info, spec):
+    # メッシュの各セルの重心から最寄り施設までの距離（m）・施設ID・半径内の施設数（施設レイヤーとメッシュの組み合わせごとに保持する）
+    def compute():
+        zones = load_dataset(file_info)
+        # メッシュの範囲に合わせた UTM 座標系（m）で距離を求める
+        crs = zones.estimate_utm_crs()
+        xy, ids = facility_points(spec["points"], spec["id_col"], crs)
+        if len(xy) == 0:
+            raise ValueError("施設のポイントがありません。")
+        points = spec["points"]
+        tree = facility_tree(points["cache_key"], points.get("lon_col", "lon"), points.get("lat_col", "lat"), crs.to_string(), xy)
+        centroids = zones.geometry.to_crs(crs).centroid
+        queries = np.column_stack([centroids.x.to_numpy(), centroids.y.to_numpy()])
+        k = min(spec["k"], len(xy))
+        dist, ind = tree.query(queries, k=k)
+        result = pd.DataFrame({"dist_m": dist[:, 0], "id": ids[ind[:, 0]]}, index=zones.index)
+        if k > 1:
+            result[f"dist_k{k}_m"] = dist[:, k - 1]
+        if spec["radius"]:
+            result[f"within_{spec['radius']:g}m"] = tree.query_radius(queries, r=spec["radius"], count_only=True)
+        result.columns = [f"{spec['prefix']}_{col}" for col in result.columns]
+        return result
+    return cached_ingest(spec["key"], compute, f"{file_info['name']} (最寄り施設 {spec['prefix']})")
+
+def accessibility_summary(result, spec, zones, population_cols):
+    # 人口で重み付けした最寄り施設までの平均距離と、半径内に施設がある人口の割合
+    dist = result[f"{spec['prefix']}_dist_m"].to_numpy()
+    rows = []
+    for col in population_cols:
+        pop = np.nan_to_num(pd.to_numeric(zones[col], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan))
+        total = pop.sum()
+        row = {"人口のカラム": col, "人口": total, "人口加重平均距離(m)": (pop * dist).sum() / total if total > 0 else np.nan}
+        if spec["radius"]:
+            within = result[f"{spec['prefix']}_within_{spec['radius']:g}m"].to_numpy() > 0
+            row[f"半径{spec['radius']:g}m以内に施設がある割合(%)"] = pop[within].sum() / total * 100 if total > 0 else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def accessibility_controls(entries):
+    # メッシュの各セルから最寄りの施設（ポイントのレイヤー）までの距離を求めて属性列に加える
+    datasets = [(fi, dataset_preview(fi)) for fi in entries]
+    polygons = polygon_layers(datasets)
+    points = point_layers(datasets)
+    if not points or not polygons:
+        return
+    with st.sidebar.expander("最寄り施設までの距離"):
+        point_name = st.selectbox("施設（ポイント）", list(points), key="access_points")
+        polygon_name = st.selectbox("距離を求めるメッシュ（ポリゴン）", list(polygons), key="access_polygons")
+        point_info, point_data, position_cols = points[point_name]
+        polygon_info, polygon_data = polygons[polygon_name]
+        id_col = st.selectbox(
+            "施設IDのカラム", [None] + [col for col in point_data.columns if col not in position_cols],
+            format_func=lambda x: "行番号" if x is None else x, key=f"access_id_{point_name}",
+        )
+        k_nearest = st.slider("k番目に近い施設までの距離も求める", 1, ACCESS_MAX_K, 1, key="access_k")
+        radius = st.number_input("半径内の施設数を数える半径（m, 0で省略）", 0, 50000, ACCESS_DEFAULT_RADIUS_M, step=100, key="access_radius")
+        population_cols = st.multiselect(
+            "人口で重み付けして集計するカラム",
+            [col for col in polygon_data.columns if col != polygon_data.geometry.name and pd.api.types.is_numeric_dtype(polygon_data[col])],
+            key=f"access_population_{polygon_name}",
+        )
+        prefix = st.text_input("追加する列名の接頭辞", value=f"near_{os.path.splitext(point_name)[0][:11]}", key=f"access_prefix_{point_name}").strip()
+        if st.button("最寄り施設までの距離を計算", key="access_run"):
+            spec = {
+                "kind": "access",
+                "points": {k: point_info[k] for k in ("name", "cache_key", "dataset_path", "sidecar_key", "lat_col", "lon_col", "loaded") if k in point_info},
+                "id_col": id_col,
+                "k": int(k_nearest),
+                "radius": float(radius),
+                "prefix": prefix or "near",
+            }
+            spec["key"] = f"{polygon_info['cache_key']}|access:" + json.dumps(
+                [point_info["cache_key"], position_cols, id_col, spec["k"], spec["radius"], spec["prefix"]], ensure_ascii=False
+            )
+            try:
+                start = time.perf_counter()
+                with st.spinner("最寄り施設までの距離を計算中..."):
+                    result = load_accessibility(polygon_info, spec)
+                add_derived_columns(polygon_info, spec)
+                st.success(f"{polygon_name} に {len(result.columns)} 列を追加しました（{time.perf_counter() - start:.1f} 秒）")
+                st.caption("、".join(result.columns))
+                if population_cols:
+                    st.dataframe(accessibility_summary(result, spec, polygon_data, population_cols).round(1), hide_index=True)
+            except Exception as e:
+                st.error(f"最寄り施設までの距離の計算エラー: {e}")
+
+def spatial_join_controls(entries):
+    # ポイントのレイヤーを、ポリゴンのレイヤーのどのポリゴンに含まれるかで集計して属性列に加える
+    datasets = [(fi, dataset_preview(fi)) for fi in entries]
+    polygons = polygon_layers(datasets)
+    points = point_layers(datasets)
+    if not points or not polygons:
+        return
+    with st.sidebar.expander("空間結合（ポイント × ポリゴン）"):
+        point_name = st.selectbox("集計するポイント", list(points), key="join_points")
+        polygon_name = st.selectbox("集計先のポリゴン", list(polygons), key="join_polygons")
+        point_info, point_data, position_cols = points[point_name]
+        polygon_info, polygon_data = polygons[polygon_name]
+        value_cols = st.multiselect(
+            "合計・平均・最大を求めるポイントの属性",
+            [col for col in point_data.columns if col not in position_cols and pd.api.types.is_numeric_dtype(point_data[col])],
+            key=f"join_values_{point_name}",
+        )
+        ratio_cols = st.multiselect(
+            "ポイント1件あたりにするポリゴンの属性（人口など）",
+            [col for col in polygon_data.columns if col != polygon_data.geometry.name and pd.api.types.is_numeric_dtype(polygon_data[col])],
+            key=f"join_ratio_{polygon_name}",
+        )
+        prefix = st.text_input("追加する列名の接頭辞", value=os.path.splitext(point_name)[0][:16], key=f"join_prefix_{point_name}").strip()
+        if st.button("空間結合を計算", key="join_run"):
+            spec = {
+                "kind": "join",
+                "points": {k: point_info[k] for k in ("name", "cache_key", "dataset_path", "sidecar_key", "lat_col", "lon_col", "loaded") if k in point_info},
+                "value_cols": value_cols,
+                "ratio_cols": ratio_cols,
+                "prefix": prefix or "join",
+            }
+            spec["key"] = f"{polygon_info['cache_key']}|join:" + json.dumps(
+                [point_info["cache_key"], position_cols, value_cols, spec["prefix"]], ensure_ascii=False
+            )
+            try:
+                start = time.perf_counter()
+                with st.spinner("空間結合を計算中..."):
+                    result = load_spatial_join(polygon_info, spec, polygon_data)
+                add_derived_columns(polygon_info, spec)
+                st.success(
+                    f"{int(result[spec['prefix'] + '_count'].sum()):,} 点を {polygon_name} のポリゴンに割り当て、"
+                    f"{len(result.columns)} 列を追加しました（{time.perf_counter() - start:.1f} 秒）"
+                )
+                st.caption("、".join(result.columns))
+            except Exception as e:
+                st.error(f"空間結合の計算エラー: {e}")
+
+def parse_band(band, band_count):
+    # 入力されたバンド番号（1始まり）を検証する
+    try:
+        band = int(band)
+    except (TypeError, ValueError):
+        raise ValueError(f"バンド番号が不正です: {band}")
+    if not 1 <= band <= band_count:
+        raise ValueError(f"バンド番号は1～{band_count}で指定してください: {band}")
+    return band
 
-def numpy_array_to_data_uri(img_array):
-    img = Image.fromarray(img_array)
+@st.cache_data(max_entries=32)
+def read_raster_band(path, band=1, max_size=RASTER_DISPLAY_MAX_SIZE, view_bounds=None, version=None):
+    # 指定バンドのみを、表示範囲（経緯度, 省略時は全体）に絞って表示解像度で読み込む（version はファイルの更新時刻とサイズ）
+    handle = open_raster(path, version)
+    with handle["lock"]:
+        src = handle["src"]
+        return read_frame(src, parse_band(band, src.count), max_size, view_bounds)
+
+# この大きさ（バイト）を超える PNG はデータURIではなく静的ファイルとして配信する
+RASTER_DATA_URI_MAX_BYTES = 256 * 1024
+# Streamlit の静的ファイル配信（server.enableStaticServing）で公開するディレクトリとその URL
+STATIC_RASTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "raster")
+STATIC_RASTER_URL = "app/static/raster/"
+# 書き出した PNG の合計サイズの上限（MB）。超えたら最後に使われた時刻の古いものから削除する
+STATIC_RASTER_MAX_MB = int(os.environ.get("STATIC_RASTER_MAX_MB", "512"))
+static_raster_lock = threading.Lock()
+
+def raster_to_rgba(img_array, cmap_name, vmin, vmax, alpha=160):
+    # 値の範囲 [vmin, vmax] をカラーマップの参照テーブルで RGBA(uint8) に変換する（欠損値は透明）
+    return apply_lut(img_array, get_colormap_lut(cmap_name, alpha), vmin, vmax)
+
+@st.cache_data(max_entries=64)
+def raster_image_url(path, band, view_bounds, cmap_name, vmin, vmax, version=None):
+    # ファイル（と更新時刻・サイズ）・バンド・表示範囲・カラーマップ・値の範囲ごとに一度だけ PNG にエンコードする
+    raster = read_raster_band(path, band, view_bounds=view_bounds, version=version)
+    return rgba_image_url(raster_to_rgba(raster["img_array"], cmap_name, vmin, vmax))
+
+@st.cache_data(max_entries=64)
+def frame_image_url(path, version, band, view_bounds, cmap_name, vmin, vmax, _img_array):
+    # 時系列のフレームの画像（フレーム・カラーマップ・値の範囲ごとに一度だけエンコードする）
+    return rgba_image_url(raster_to_rgba(_img_array, cmap_name, vmin, vmax))
+
+def rgba_image_url(rgba):
+    # 大きな画像は静的ファイルとして書き出し、WebSocket で base64 を送らずに済ませる
     buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{encoded}"
-
-def group_by_range(series, max_categories=8):
-    # 数値データでない場合は、各値をそのまま返す
-    if not pd.api.types.is_numeric_dtype(series):
-        group_range_labels = series.astype(str)
-        return pd.Categorical(group_range_labels), group_range_labels
-
-    # 欠損値のあるサンプルを除外
-    clean_series = series.dropna()
-    if clean_series.empty:
-        # clean_series が空の場合はそのまま返す
-        return pd.Categorical(clean_series.astype(str)), clean_series.astype(str)
-
-    # 1次元のデータを2次元に変換（KMeans の入力として必要）
-    X = clean_series.values.reshape(-1, 1)
-    
-    # クラスタ数は、max_categories とユニーク値数の小さい方にする
-    unique_values = np.unique(clean_series.values)
-    n_clusters = min(max_categories, len(unique_values))
-    
-    # k-means クラスタリングの実行
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    labels = kmeans.fit_predict(X)
-    
-    # 各クラスタごとに最小値・最大値の範囲を計算し、文字列として保存
-    cluster_ranges = {}
-    for label in np.unique(labels):
-        cluster_values = clean_series[labels == label]
-        cluster_min = cluster_values.min()
-        cluster_max = cluster_values.max()
-        cluster_ranges[label] = f"{cluster_min:.2f} ~ {cluster_max:.2f}"
-    
-    # 元の (dropna後の) series の各要素に対応するクラスタの範囲の文字列を生成
-    group_range_labels = pd.Series([cluster_ranges[label] for label in labels], index=clean_series.index)
-    
-    # クラスタ中心値の昇順で並べ替え
-    cluster_centers = kmeans.cluster_centers_.flatten()
-    sorted_order = np.argsort(cluster_centers)
-    unique_range_labels = [cluster_ranges[label] for label in sorted_order]
-    grouped_series = pd.Categorical(group_range_labels, categories=unique_range_labels, ordered=True)
-    
-    return grouped_series, group_range_labels
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG")
+    png = buffer.getvalue()
+    if len(png) <= RASTER_DATA_URI_MAX_BYTES:
+        return f"data:image/png;base64,{base64.b64encode(png).decode('utf-8')}"
+    os.makedirs(STATIC_RASTER_DIR, exist_ok=True)
+    file_name = f"{hashlib.sha256(png).hexdigest()}.png"
+    file_path = os.path.join(STATIC_RASTER_DIR, file_name)
+    with static_raster_lock:
+        if not os.path.exists(file_path):
+            tmp_path = f"{file_path}.{threading.get_ident()}.part"
+            with open(tmp_path, "wb") as f:
+                f.write(png)
+            os.replace(tmp_path, file_path)
+            prune_static_rasters(file_name)
+    return f"{STATIC_RASTER_URL}{file_name}"
+
+def prune_static_rasters(keep):
+    # 書き出した PNG の合計が上限を超えたら、最後に使われた（更新時刻の）古いものから削除する（keep は残す）
+    entries = []
+    for entry in os.scandir(STATIC_RASTER_DIR):
+        if entry.name.endswith(".png") and entry.name != keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries) + os.path.getsize(os.path.join(STATIC_RASTER_DIR, keep))
+    budget = STATIC_RASTER_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def touch_image_url(url):
+    # 静的ファイルの画像の最後に使われた時刻を更新する。削除済みなら False（データURIは常に True）
+    if not url.startswith(STATIC_RASTER_URL):
+        return True
+    try:
+        os.utime(os.path.join(STATIC_RASTER_DIR, url[len(STATIC_RASTER_URL):]))
+        return True
+    except FileNotFoundError:
+        return False
+
+# 時系列ラスタで保持する読み込み済みフレームの数
+RASTER_FRAME_CACHE_SIZE = int(os.environ.get("RASTER_FRAME_CACHE_SIZE", "12"))
+
+@st.cache_resource
+def get_frame_cache():
+    # 時系列ラスタのフレームキャッシュ（先読みスレッドを含めて全セッションで共有する）
+    return FrameCache(max_frames=RASTER_FRAME_CACHE_SIZE, max_size=RASTER_DISPLAY_MAX_SIZE)
+
+@st.cache_data(max_entries=32)
+def raster_band_timestamps(path, version=None):
+    # バンドごとの日時（バンドの説明・タグから読めないバンドは None）
+    handle = open_raster(path, version)
+    with handle["lock"]:
+        return band_timestamps(handle["src"])
+
+@st.cache_data(max_entries=32)
+def stack_value_range(frames, versions):
+    # 時系列の全フレームを通した値の範囲（時刻を変えても色の対応が変わらないようにする。versions は各ファイルの更新時刻とサイズ）
+    return value_range(frames)
+
+def raster_stack_controls(entries):
+    # 1時刻1ファイルの GeoTIFF をまとめて時系列として表示する（ファイル名の日時の順に並べる）
+    rasters = []
+    for fi in entries:
+        preview = dataset_preview(fi)
+        if isinstance(preview, dict) and "band_count" in preview:
+            rasters.append(fi["name"])
+    if len(rasters) < 2:
+        return []
+    names = st.sidebar.multiselect("時系列としてまとめるTIFF（1時刻1ファイル）", rasters, key="raster_stack_files")
+    if len(names) < 2:
+        return []
+    return sorted(names, key=lambda name: (parse_timestamp(name) is None, parse_timestamp(name) or pd.Timestamp(0), name))
+
+def time_series_frame(file_name, frames, labels, view_bounds=None):
+    # 時刻スライダーで選んだフレームだけを読み込み、前後のフレームは裏で先読みする
+    index = st.sidebar.select_slider(
+        "時刻", options=list(range(len(frames))), format_func=lambda i: labels[i], key=f"time_{file_name}"
+    )
+    cache = get_frame_cache()
+    path, band = frames[index]
+    frame = cache.get(path, band, view_bounds)
+    cache.prefetch([frames[i] for i in (index + 1, index + 2, index - 1) if 0 <= i < len(frames)], view_bounds)
+    stats = cache.stats()
+    st.sidebar.caption(
+        f"{labels[index]}（{index + 1}/{len(frames)}）・読み込み済みフレーム {stats['frames']}・"
+        f"キャッシュ ヒット {stats['hits']} / ミス {stats['misses']}"
+    )
+    return path, band, frame
+
+# ラスタタイルサーバーの設定（TILE_SERVER_URL はブラウザから見たサーバーの公開URL）
+# リモートや https で公開する場合は、リバースプロキシなどでブラウザから届く URL を TILE_SERVER_URL に設定する
+TILE_SERVER_HOST = os.environ.get("TILE_SERVER_HOST", "127.0.0.1")
+TILE_SERVER_PORT = int(os.environ.get("TILE_SERVER_PORT", "8765"))
+TILE_SERVER_URL = os.environ.get("TILE_SERVER_URL", "").rstrip("/")
+TILE_CACHE_MAX_TILES = int(os.environ.get("TILE_CACHE_MAX_TILES", "4096"))
+TILE_CACHE_DIR = os.environ.get("TILE_CACHE_DIR") or None
+# Terrarium 形式の標高タイルのデコード設定
+TERRARIUM_DECODER = {"rScaler": 256, "gScaler": 1, "bScaler": 1 / 256, "offset": -32768}
+
+@st.cache_resource
+def get_tile_renderer():
+    # タイルサーバーをプロセスに1つだけ起動し、ラスタ登録用のレンダラーを返す
+    _, renderer = start_tile_server(TILE_SERVER_HOST, TILE_SERVER_PORT, TILE_CACHE_MAX_TILES, TILE_CACHE_DIR)
+    return renderer
+
+def tile_server_url():
+    # ブラウザから見たタイルサーバーのURL（タイル表示が使えない場合は None）
+    # TILE_SERVER_URL が未設定なら、アプリを localhost で開いているときだけローカルのタイルサーバーを使う
+    if TILE_SERVER_URL:
+        return TILE_SERVER_URL
+    host = urlparse(f"//{st.context.headers.get('Host') or ''}").hostname
+    if host in ("localhost", "127.0.0.1"):
+        return f"http://{host}:{TILE_SERVER_PORT}"
+    return None
+
+def raster_tile_layer(tile_url, path, band, cmap_name, vmin, vmax, bounds):
+    # タイルサーバーにラスタを登録し、XYZタイルを TerrainLayer（TileLayer の派生）のテクスチャとして表示する
+    # 標高は常に0mの平坦なタイルを使う
+    renderer = get_tile_renderer()
+    layer_id = renderer.register(path, band, get_colormap_lut(cmap_name), vmin, vmax, cmap_name)
+    (left, bottom), (right, top) = bounds
+    return pdk.Layer(
+        "TerrainLayer",
+        elevation_decoder=TERRARIUM_DECODER,
+        elevation_data=pdk.types.String(f"{tile_url}/terrain/{{z}}/{{x}}/{{y}}.png"),
+        texture=pdk.types.String(f"{tile_url}/tiles/{layer_id}/{{z}}/{{x}}/{{y}}.png"),
+        extent=[left, bottom, right, top],
+    )
+
+# ベクタータイル（MVT）の設定（MBTiles の保存先は環境変数 VECTOR_TILE_DIR で変更可能）
+VECTOR_TILE_DIR = os.environ.get("VECTOR_TILE_DIR", os.path.join(tempfile.gettempdir(), "wbgt_vector_tiles"))
+VECTOR_TILE_CACHE_MAX_MB = int(os.environ.get("VECTOR_TILE_CACHE_MAX_MB", "1024"))
+VECTOR_TILE_MAX_ZOOM = 14
+VECTOR_TILE_DETAIL_ZOOM = 12
+
+# 最初の表示範囲について事前に生成するタイルの上限
+VECTOR_TILE_PRECOMPUTE_MAX_TILES = 256
+
+@st.cache_resource(max_entries=4)
+def get_vector_geometry(file_key, _gdf):
+    # データセット（内容のキー）ごとに Web メルカトルへの変換とズームごとの簡略化を一度だけ行い、色分けが変わっても使い回す
+    return VectorGeometry(_gdf, detail_zoom=VECTOR_TILE_DETAIL_ZOOM)
+
+def release_vector_tile_source(source_id):
+    # キャッシュから外れたタイル生成元はタイルサーバーからも外す
+    get_tile_renderer().unregister_vector_source(source_id)
+
+@st.cache_resource(max_entries=16, on_release=release_vector_tile_source)
+def get_vector_tile_source(source_id, file_key, _gdf, _build_colors, tooltip_cols, _view_box, _zoom):
+    # 設定ごとにタイル生成元を1つ作ってタイルサーバーに登録し、最初の表示範囲と前後のズームのタイルを裏で生成しておく
+    geometry = get_vector_geometry(file_key, _gdf)
+    mbtiles_path = os.path.join(VECTOR_TILE_DIR, f"{source_id}.mbtiles")
+    prune_cache_dir(VECTOR_TILE_DIR, VECTOR_TILE_CACHE_MAX_MB, keep=[mbtiles_path])
+    source = VectorTileSource(geometry, _build_colors(), tooltip_cols, mbtiles_path=mbtiles_path)
+    get_tile_renderer().register_vector_source(source_id, source)
+    zoom = int(_zoom)
+    zooms = range(max(0, zoom - 1), min(VECTOR_TILE_MAX_ZOOM, zoom + 1) + 1)
+    threading.Thread(
+        target=source.precompute, args=(*(_view_box or geometry.bounds), zooms, VECTOR_TILE_PRECOMPUTE_MAX_TILES),
+        name="mvt-precompute", daemon=True,
+    ).start()
+    return source_id
+
+def vector_tile_source_id(file_key, gdf, build_colors, color_key, tooltip_cols, view_box, zoom):
+    # タイル生成元を（なければ作って）タイルサーバーに登録し、その ID を返す。色は生成元を作るときだけ計算する
+    # レイヤーをメモ化していても、生成元がキャッシュから外れていれば登録し直すため毎回呼ぶ
+    key = f"{file_key}|{color_key}|{','.join(tooltip_cols)}"
+    source_id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return get_vector_tile_source(source_id, file_key, gdf, build_colors, tuple(tooltip_cols), view_box, zoom)
+
+def vector_tile_layer(tile_url, source_id):
+    # 登録済みの生成元の MVT を、表示範囲のタイルだけ MVTLayer で読み込む
+    return pdk.Layer(
+        "MVTLayer",
+        data=pdk.types.String(f"{tile_url}/mvt/{source_id}/{{z}}/{{x}}/{{y}}.pbf"),
+        max_zoom=VECTOR_TILE_MAX_ZOOM,
+        get_fill_color="[properties.r, properties.g, properties.b, properties.a]",
+        get_line_color=[80, 80, 80, 160],
+        line_width_min_pixels=0.5,
+        pickable=True,
+        auto_highlight=True,
+    )
+
+# 区分方法の選択肢
+CLASSIFY_METHODS = {"自然分類(Jenks)": "jenks", "分位数": "quantile", "等間隔": "equal"}
+def series_fingerprint(series):
+    # 列の内容からキャッシュ用の指紋を作る（値のハッシュをまとめてハッシュ化）
+    hashes = pd.util.hash_pandas_object(series, index=False).to_numpy()
+    return f"{series.dtype}:{len(series)}:{hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()}"
+
+@st.cache_data(max_entries=128)
+def cached_classification(fingerprint, k, method, _series):
+    # 列の指紋・区分数・区分方法ごとに分類結果（区分番号と区分名）を使い回す
+    series = _series
+    if not pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        # 数値データでない場合は、各値をそのまま区分にする
+        codes, categories = pd.factorize(series, sort=True)
+        return codes.astype(np.int32), [str(c) for c in categories]
+    return classify_numeric(series.to_numpy(dtype=np.float64, na_value=np.nan), k, method)
+
+def classify_series(series, max_categories=8, method="jenks", role="chart"):
+    # 列を区分番号（欠損は -1）と区分名の一覧に分類する
+    # 行数の多い数値列はジョブとして分類する。role（グラフの1つ目・2つ目のカラムなど）ごとに最新の分類だけを待ち、
+    # カラムを変えると同じ role の前のカラムの分類は取り消される
+    fingerprint = series_fingerprint(series)
+    if len(series) >= JOB_MIN_ROWS and pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return run_job(
+            ("classify", fingerprint, max_categories, method), classify_numeric,
+            series.to_numpy(dtype=np.float64, na_value=np.nan), max_categories, method,
+            label=f"{series.name} を区分中", slot=f"classify:{role}",
+        )
+    return cached_classification(fingerprint, max_categories, method, series)
+
+# グラフに表示する区分の上限（超えた分は「その他」にまとめる）と欠損値の区分名
+CHART_MAX_CATEGORIES = 20
+OTHER_LABEL = "その他"
+MISSING_LABEL = "欠損値"
+
+def chart_categories(series, max_categories=5, method="jenks", role="chart"):
+    # グラフ用に列を区分番号（0始まり）と区分名に変換する
+    # 数値以外の列で区分が多すぎる場合は件数の少ないものを「その他」に、欠損値は「欠損値」にまとめる
+    codes, labels = classify_series(series, max_categories, method, role)
+    codes = codes.astype(np.int64)
+    labels = list(labels)
+    if len(labels) > CHART_MAX_CATEGORIES:
+        counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+        top = np.sort(np.argsort(counts, kind="stable")[::-1][:CHART_MAX_CATEGORIES - 1])
+        remap = np.full(len(labels), len(top), dtype=np.int64)
+        remap[top] = np.arange(len(top))
+        codes = np.where(codes >= 0, remap[np.clip(codes, 0, None)], -1)
+        labels = [labels[i] for i in top] + [OTHER_LABEL]
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(labels), codes)
+        labels.append(MISSING_LABEL)
+    return codes, labels
+
+def count_table(codes1, n1, codes2=None, n2=1):
+    # 区分番号の件数（codes2 を指定するとクロス集計表）を np.bincount で求める
+    if codes2 is None:
+        return np.bincount(codes1, minlength=n1)
+    return np.bincount(codes1 * n2 + codes2, minlength=n1 * n2).reshape(n1, n2)
+
+def pie_chart(labels, counts, title):
+    # 集計済みの件数から円グラフを作る
+    fig = go.Figure(data=[go.Pie(labels=labels, values=counts, sort=False)])
+    fig.update_layout(title=title)
+    return fig
+
+# 散布図を密度表示に切り替える行数（表示範囲内の点がこれ以下なら点で描画）と密度表示の分割数
+SCATTER_DENSITY_THRESHOLD = int(os.environ.get("SCATTER_DENSITY_THRESHOLD", "50000"))
+SCATTER_DENSITY_BINS = 200
+
+def finite_range(values):
+    # 有限値の最小・最大（有限値がなければ None）
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return None
+    return float(finite.min()), float(finite.max())
+
+def density_grid(x, y, x_range, y_range, bins=SCATTER_DENSITY_BINS, weights=None):
+    # 表示範囲を bins x bins に分割し、各セルの件数（weights 指定時は合計）を np.bincount で求める
+    (x0, x1), (y0, y1) = x_range, y_range
+    valid = np.isfinite(x) & np.isfinite(y) & (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    if weights is not None:
+        valid &= np.isfinite(weights)
+    ix = np.minimum(((x[valid] - x0) / ((x1 - x0) or 1.0) * bins).astype(np.int64), bins - 1)
+    iy = np.minimum(((y[valid] - y0) / ((y1 - y0) or 1.0) * bins).astype(np.int64), bins - 1)
+    grid = np.bincount(iy * bins + ix, weights=None if weights is None else weights[valid], minlength=bins * bins)
+    return grid.reshape(bins, bins), int(valid.sum())
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def cached_density_grid(file_key, col_x, col_y, col_w, x_range, y_range, bins, _x, _y, _w):
+    # ファイル・カラム・表示範囲が同じなら密度グリッドを再計算しない
+    return density_grid(_x, _y, x_range, y_range, bins, _w)
+
+def density_scatter_figure(x, y, x_range, y_range, title, grid, log_scale=False, weight_label=None):
+    # 密度グリッドをヒートマップとして描画する（図のサイズは行数によらず bins x bins で一定）
+    bins = grid.shape[0]
+    z = grid.astype(np.float32)
+    z[grid == 0] = np.nan
+    if log_scale:
+        z = np.log10(z, where=z > 0, out=np.full_like(z, np.nan))
+    x_edges = np.linspace(x_range[0], x_range[1], bins + 1)
+    y_edges = np.linspace(y_range[0], y_range[1], bins + 1)
+    colorbar_title = weight_label or "件数"
+    if log_scale:
+        colorbar_title = f"log10({colorbar_title})"
+    fig = go.Figure(data=[go.Heatmap(
+        z=z,
+        x=((x_edges[:-1] + x_edges[1:]) / 2).astype(np.float32),
+        y=((y_edges[:-1] + y_edges[1:]) / 2).astype(np.float32),
+        colorscale="Viridis",
+        colorbar=dict(title=colorbar_title),
+        hoverongaps=False,
+    )])
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return fig
+
+# 欠損値に割り当てる色（既定色と同じ）
+NAN_COLOR = [200, 30, 0, 160]
+
+@lru_cache(maxsize=None)
+def get_colormap_lut(cmap_name, alpha=160):
+    # カラーマップを256段階のRGBA(uint8)参照テーブルに変換して使い回す
+    cmap = plt.get_cmap(cmap_name, 256)
+    lut = (cmap(np.arange(256)) * 255).astype(np.uint8)
+    lut[:, 3] = alpha
+    lut.setflags(write=False)
+    return lut
+
+def map_values_to_colors(values, cmap_name, alpha=160, nan_color=NAN_COLOR):
+    # 列全体を一括で色に変換し、(N, 4) の uint8 配列を返す
+    values = pd.Series(values)
+    lut = get_colormap_lut(cmap_name, alpha)
+    colors = np.empty((len(values), 4), dtype=np.uint8)
+    colors[:] = nan_color
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        arr = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = np.isfinite(arr)
+        if valid.any():
+            vmin = arr[valid].min()
+            vmax = arr[valid].max()
+            scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+            idx = np.clip(((arr[valid] - vmin) * scale).round(), 0, 255).astype(np.intp)
+            if vmax == vmin:
+                idx[:] = 128
+            colors[valid] = lut[idx]
+    else:
+        # カテゴリ値は並べ替えた順にカラーマップ上へ等間隔に割り当てる
+        codes, categories = pd.factorize(values, sort=True)
+        valid = codes >= 0
+        n = len(categories)
+        positions = np.linspace(0, 255, n).round().astype(np.intp) if n > 1 else np.array([128], dtype=np.intp)
+        if n:
+            colors[valid] = lut[positions[codes[valid]]]
+    return colors
+
+def tooltip_values(series):
+    # ツールチップ用の値（欠損値は JSON の null にする）
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def point_layer_frame(lon, lat, colors=None, tooltip_df=None, decimals=6):
+    # 描画に必要な列（経度・緯度・色・ツールチップ）だけを持つ DataFrame を作る
+    # 座標は小数点以下 decimals 桁（約0.1m）に丸め、色は uint8 の配列から作る
+    lon = pd.to_numeric(pd.Series(lon), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(pd.Series(lat), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    frame = pd.DataFrame({
+        "lon": np.round(lon[valid], decimals),
+        "lat": np.round(lat[valid], decimals),
+    })
+    if colors is not None:
+        frame["color"] = colors[valid].tolist()
+    if tooltip_df is not None:
+        for col in tooltip_df.columns:
+            frame[col] = tooltip_values(tooltip_df[col][valid])
+    return frame
+
+def compact_json(obj):
+    # 改行・インデントなしで JSON 化する
+    return json.dumps(obj, sort_keys=True, default=default_serialize, separators=(",", ":"))
+
+class CompactDeck(pdk.Deck):
+    # pydeck 標準の to_json はインデント付きで冗長なため、詰めた JSON を送信する
+    # layer_json（memoized_layer で作成時に JSON 化したもの）を渡すと、レイヤーは JSON 化し直さず Deck の設定だけを JSON 化する
+    def __init__(self, *args, layer_json=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layer_json = layer_json
+
+    def to_json(self):
+        if self.layer_json is None:
+            return compact_json(self)
+        attrs = default_serialize(self)
+        attrs.pop("layers", None)
+        attrs.pop("layerJson", None)
+        return '{"layers":[' + ",".join(self.layer_json) + "]," + compact_json(attrs)[1:]
+
+# 作成済みレイヤーの JSON を保持するメモリ上限（MB）。環境変数 LAYER_JSON_CACHE_MAX_MB で変更可能
+LAYER_JSON_CACHE_MAX_MB = int(os.environ.get("LAYER_JSON_CACHE_MAX_MB", "256"))
+
+@st.cache_resource
+def get_layer_json_cache():
+    # 全セッション共通のレイヤー JSON 置き場（キー -> JSON 文字列、LRU順）
+    # Layer 本体（DataFrame などを持つ）は残さず、送信する JSON だけを文字列の長さで上限管理する
+    return {"entries": OrderedDict(), "nbytes": 0, "lock": threading.Lock()}
+
+def memoized_layer(layer_key, build):
+    # レイヤーを入力（データセット・表示範囲・色分けカラム・カラーマップ・半径など）ごとに一度だけ作り、JSON 化も一度だけ行う
+    # 他のレイヤーの設定やグラフを変更しても、変更のないレイヤーの色の計算・JSON 化をやり直さない
+    cache = get_layer_json_cache()
+    with cache["lock"]:
+        layer_json = cache["entries"].get(layer_key)
+        if layer_json is not None:
+            cache["entries"].move_to_end(layer_key)
+            return layer_json
+    layer_json = compact_json(build())
+    budget = LAYER_JSON_CACHE_MAX_MB * 1024 * 1024
+    with cache["lock"]:
+        previous = cache["entries"].pop(layer_key, None)
+        cache["nbytes"] -= len(previous) if previous is not None else 0
+        cache["entries"][layer_key] = layer_json
+        cache["nbytes"] += len(layer_json)
+        # 上限を超えた分を古いものから追い出す（今作ったものは残す）
+        while cache["nbytes"] > budget and len(cache["entries"]) > 1:
+            _, evicted = cache["entries"].popitem(last=False)
+            cache["nbytes"] -= len(evicted)
+    return layer_json
+
+def tooltip_spec(columns):
+    # 各レイヤーで選択されたツールチップ用カラムから Deck のツールチップを作る
+    if not columns:
+        return None
+    html = "<br/>".join(f"<b>{col}</b>: {{{col}}}" for col in columns)
+    return {"html": html}
+
+def polygon_layer_records(gdf, colors, tooltip_cols=(), decimals=6, geometry=None):
+    # GeoDataFrame のジオメトリ列から PolygonLayer 用のレコードを直接組み立てる
+    # （MultiPolygon はパーツごとに1レコード、座標は小数点以下 decimals 桁に丸める）
+    # geometry を渡すと、ジオメトリ列の代わりにそれ（簡略化したジオメトリなど）を使う
+    geometry = gdf.geometry.values if geometry is None else geometry
+    parts, part_feature = shapely.get_parts(np.asarray(geometry), return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    coords = np.round(coords, decimals).tolist()
+    ring_offsets = np.searchsorted(coord_ring, np.arange(len(rings) + 1)).tolist()
+    part_offsets = np.searchsorted(ring_part, np.arange(len(parts) + 1)).tolist()
+    ring_coords = [coords[a:b] for a, b in zip(ring_offsets[:-1], ring_offsets[1:])]
+    part_colors = colors[part_feature].tolist()
+    records = [
+        {"polygon": ring_coords[a:b], "color": color}
+        for a, b, color in zip(part_offsets[:-1], part_offsets[1:], part_colors)
+    ]
+    # ツールチップ用カラムのみ各パーツに付与する
+    for col in tooltip_cols:
+        values = tooltip_values(gdf[col])
+        for record, feature in zip(records, part_feature.tolist()):
+            record[col] = values[feature]
+    return records
+
+# 詳細度（LOD）のピラミッドを作るズームレベル（最後のレベルより拡大したときは元のジオメトリを送る）
+LOD_ZOOMS = (6, 8, 10, 12)
+
+@st.cache_resource(max_entries=16)
+def geometry_lod_pyramid(file_key, _geometry):
+    # ズームレベルごとに、画面上の1ピクセル相当の許容誤差（度）で簡略化したジオメトリを一度だけ作る
+    geometry = np.asarray(_geometry)
+    minx, miny, maxx, maxy = shapely.total_bounds(geometry)
+    lat_factor = np.cos(np.radians((miny + maxy) / 2)) if np.isfinite(miny) else 1.0
+    return {zoom: simplify_coverage(geometry, 360 / (512 * 2 ** zoom) * lat_factor) for zoom in LOD_ZOOMS}
+
+def lod_for_zoom(pyramid, zoom):
+    # 表示するズームレベル以上で最も粗いレベル（なければ None で元のジオメトリ）
+    return next((level for level in sorted(pyramid) if level >= zoom), None)
+
+def report_layer_payload(file_name, layer_json):
+    # レイヤーごとの送信データ量をサイドバーに表示する
+    nbytes = len(layer_json)
+    st.sidebar.caption(f"{file_name} の送信データ量: {nbytes / 1024:,.0f} KB")
+
+# カラーマップの選択肢
+CMAP_CHOICES = ["terrain", "Reds", "Blues", "Greens", "cividis", "magma", "viridis", "twilight", "cool", "coolwarm", "spring", "summer", "autumn", "winter"]
+# ポイントデータの表示方法（"自動" はサンプル上限を超えると六角形で集約表示）
+DISPLAY_MODES = ["自動", "ポイント", "集約(グリッド)", "集約(六角形)"]
+AGGREGATION_STATS = {"件数": "count", "平均": "mean", "最大": "max"}
+
+def zoom_for_extent(extent):
+    # 表示範囲（度）からズームレベルを決める
+    if extent < 0.1:
+        return 15
+    elif extent < 1:
+        return 10
+    return 5
+
+def cell_size_for_zoom(zoom, lat):
+    # 画面上でおよそ40ピクセルになる集約セルの大きさ（m）
+    return float(156543.03392 * np.cos(np.radians(lat)) / (2 ** zoom) * 40)
+
+# 表示範囲の外側に含める余白（表示範囲の幅・高さに対する割合）と、表示範囲の計算に使う地図の大きさ（ピクセル）
+VIEWPORT_MARGIN = 0.25
+VIEWPORT_SIZE_PX = (1200, 700)
+
+@st.cache_resource(max_entries=32)
+def point_index(file_key, _lon, _lat):
+    # 表の緯度経度の索引（Point を作ると100万点で数百MBになるため、経度で並べ替えた行番号を持つ）
+    lon = pd.to_numeric(pd.Series(_lon), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(pd.Series(_lat), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    order = valid[np.argsort(lon[valid], kind="stable")]
+    lon = lon[order]
+    lat = lat[order]
+    bounds = (lon[0], lat.min(), lon[-1], lat.max()) if len(order) else None
+    return {"order": order, "lon": lon, "lat": lat, "bounds": bounds}
+
+@st.cache_resource(max_entries=32)
+def geometry_index(file_key, _geometry):
+    # ジオメトリの空間インデックス（STRtree）をデータセットごとに一度だけ作り、全体の境界も保持する
+    geometry = np.asarray(_geometry)
+    bounds = tuple(shapely.total_bounds(geometry)) if len(geometry) else None
+    return {"tree": shapely.STRtree(geometry), "bounds": bounds}
+
+def dataset_spatial_index(file_info, dataset):
+    # ベクターデータの空間インデックス（表は緯度経度の列、GeoDataFrame はジオメトリから作る）
+    file_key = file_info.get("cache_key", file_info.get("name"))
+    if is_point_table(dataset):
+        lat_col = file_info.get("lat_col", "lat")
+        lon_col = file_info.get("lon_col", "lon")
+        if lat_col not in dataset.columns or lon_col not in dataset.columns:
+            return None
+        positions, _ = load_table_columns(file_info, [lon_col, lat_col], keep_float64=(lon_col, lat_col))
+        return point_index(f"{file_key}|{lon_col}|{lat_col}", positions[lon_col], positions[lat_col])
+    if isinstance(dataset, gpd.GeoDataFrame):
+        return geometry_index(file_key, dataset.geometry.values)
+    return None
+
+def features_in_view(index, view_box):
+    # 表示範囲（minx, miny, maxx, maxy）と交差する地物の行番号を昇順で返す
+    minx, miny, maxx, maxy = view_box
+    if "tree" in index:
+        return np.sort(index["tree"].query(shapely.box(minx, miny, maxx, maxy), predicate="intersects"))
+    # 経度で並べ替えてあるので、経度の範囲は二分探索で切り出し、緯度だけを比較する
+    start = np.searchsorted(index["lon"], minx, side="left")
+    stop = np.searchsorted(index["lon"], maxx, side="right")
+    lat = index["lat"][start:stop]
+    return np.sort(index["order"][start:stop][(lat >= miny) & (lat <= maxy)])
+
+def viewport_bounds(center_lat, center_lon, zoom, margin=VIEWPORT_MARGIN):
+    # 中心とズームレベルから、余白を含めた表示範囲（経度・緯度）を求める（deck.gl は世界全体の幅が 512 × 2^zoom ピクセル）
+    width, height = VIEWPORT_SIZE_PX
+    deg_per_px = 360 / (512 * 2 ** zoom)
+    half_lon = width / 2 * deg_per_px * (1 + 2 * margin)
+    half_lat = height / 2 * deg_per_px * np.cos(np.radians(center_lat)) * (1 + 2 * margin)
+    return (
+        max(center_lon - half_lon, -180.0), max(center_lat - half_lat, -90.0),
+        min(center_lon + half_lon, 180.0), min(center_lat + half_lat, 90.0),
+    )
+
+def view_for_bounds(bounds_list):
+    # 各データセットの境界をまとめた範囲から、地図の中心とズームレベルを決める
+    bounds_list = [b for b in bounds_list if b is not None and np.isfinite(b).all()]
+    if not bounds_list:
+        return 36, 138, 5
+    bounds = np.array(bounds_list, dtype=np.float64)
+    minx, miny = bounds[:, 0].min(), bounds[:, 1].min()
+    maxx, maxy = bounds[:, 2].max(), bounds[:, 3].max()
+    return float((miny + maxy) / 2), float((minx + maxx) / 2), zoom_for_extent(max(maxx - minx, maxy - miny))
+
+def viewport_controls(bounds_list):
+    # 地図の表示範囲をサイドバーで指定する（"全体" の場合は表示範囲を None で返す）
+    center_lat, center_lon, zoom = view_for_bounds(bounds_list)
+    st.sidebar.subheader("地図の表示範囲")
+    mode = st.sidebar.radio("表示範囲", ["全体", "範囲を指定"], horizontal=True, key="viewport_mode")
+    if mode == "全体":
+        return None, (center_lat, center_lon, zoom)
+    center_lat = st.sidebar.number_input("中心の緯度", -85.0, 85.0, float(center_lat), format="%.5f", key="viewport_lat")
+    center_lon = st.sidebar.number_input("中心の経度", -180.0, 180.0, float(center_lon), format="%.5f", key="viewport_lon")
+    zoom = st.sidebar.slider("ズームレベル", 1, 20, int(zoom), key="viewport_zoom")
+    view_box = viewport_bounds(center_lat, center_lon, zoom)
+    st.sidebar.caption(
+        f"経度 {view_box[0]:.4f}〜{view_box[2]:.4f}、緯度 {view_box[1]:.4f}〜{view_box[3]:.4f}（余白を含む）の地物だけを送信"
+    )
+    return view_box, (center_lat, center_lon, zoom)
+
+def aggregate_points(lon, lat, values=None, mode="grid", cell_size_m=500.0):
+    # 全点を一括でグリッド（正方形）または六角形のセルに割り当て、セルごとの件数・平均・最大を求める
+    lon = pd.to_numeric(pd.Series(lon), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(pd.Series(lat), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    lon = lon[valid]
+    lat = lat[valid]
+    if len(lon) == 0:
+        return pd.DataFrame(columns=["lon", "lat", "count", "mean", "max"])
+    # 中心付近の緯度で度をメートルに換算した平面座標で集計する
+    lon0 = float(lon.mean())
+    lat0 = float(lat.mean())
+    m_per_deg_lat = 111320.0
+    m_per_deg_lon = 111320.0 * np.cos(np.radians(lat0))
+    x = (lon - lon0) * m_per_deg_lon / cell_size_m
+    y = (lat - lat0) * m_per_deg_lat / cell_size_m
+    if mode == "hex":
+        # 頂点が上向きの六角形（外接円の半径 = cell_size_m）の軸座標に丸める
+        q = np.sqrt(3) / 3 * x - y / 3
+        r = 2 / 3 * y
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        i = rq.astype(np.int64)
+        j = rr.astype(np.int64)
+    else:
+        i = np.floor(x).astype(np.int64)
+        j = np.floor(y).astype(np.int64)
+    # セル番号を1つの整数にまとめて一意化する
+    j_span = j.max() - j.min() + 1
+    keys = (i - i.min()) * j_span + (j - j.min())
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    ci = unique_keys // j_span + i.min()
+    cj = unique_keys % j_span + j.min()
+    if mode == "hex":
+        cx = np.sqrt(3) * ci + np.sqrt(3) / 2 * cj
+        cy = 1.5 * cj
+    else:
+        cx = ci + 0.5
+        cy = cj + 0.5
+    n_cells = len(unique_keys)
+    result = pd.DataFrame({
+        "lon": lon0 + cx * cell_size_m / m_per_deg_lon,
+        "lat": lat0 + cy * cell_size_m / m_per_deg_lat,
+        "count": np.bincount(inverse, minlength=n_cells),
+    })
+    if values is not None:
+        vals = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)[valid]
+        has_val = np.isfinite(vals)
+        val_count = np.bincount(inverse[has_val], minlength=n_cells)
+        val_sum = np.bincount(inverse[has_val], weights=vals[has_val], minlength=n_cells)
+        val_max = np.full(n_cells, -np.inf)
+        np.maximum.at(val_max, inverse[has_val], vals[has_val])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["mean"] = np.where(val_count > 0, val_sum / val_count, np.nan)
+        result["max"] = np.where(val_count > 0, val_max, np.nan)
+    return result
+
+@st.cache_resource(max_entries=64)
+def cached_aggregate_points(file_key, value_col, mode, cell_size_m, _lon, _lat, _values):
+    # ファイル・集計カラム・セル形状・セルサイズごとに集計結果を使い回す
+    return aggregate_points(_lon, _lat, _values, mode, cell_size_m)
+
+def aggregation_controls_and_layer(file_name, file_key, lon, lat, values, value_col, display_mode, cmap_choice):
+    # 集約表示の設定（集計値・カラーマップ・ズームレベル）をサイドバーに表示し、ColumnLayer の JSON を返す
+    mode = "grid" if display_mode == "集約(グリッド)" else "hex"
+    stat_options = ["平均", "最大", "件数"] if values is not None else ["件数"]
+    stat_label = st.sidebar.selectbox("集約セルの色分けに用いる値", stat_options, key=f"agg_stat_{file_name}")
+    stat = AGGREGATION_STATS[stat_label]
+    if cmap_choice is None:
+        cmap_choice = st.sidebar.selectbox("カラーマップを選択", CMAP_CHOICES, index=CMAP_CHOICES.index("Reds"), key=f"agg_cmap_{file_name}")
+    lon_arr = pd.to_numeric(pd.Series(lon), errors="coerce")
+    lat_arr = pd.to_numeric(pd.Series(lat), errors="coerce")
+    extent = max(lon_arr.max() - lon_arr.min(), lat_arr.max() - lat_arr.min())
+    zoom = st.sidebar.slider("集約のズームレベル", 1, 18, zoom_for_extent(extent), key=f"agg_zoom_{file_name}")
+    cell_size_m = round(cell_size_for_zoom(zoom, lat_arr.mean()), 1)
+    agg = cached_aggregate_points(file_key, value_col, mode, cell_size_m, lon, lat, values)
+    st.sidebar.caption(f"{file_name}: {len(lon):,}点を{len(agg):,}セル（{cell_size_m:,.0f} m）に集約")
+
+    def build():
+        layer_data = pd.DataFrame({
+            "lon": agg["lon"].round(6),
+            "lat": agg["lat"].round(6),
+            "count": agg["count"],
+            "color": map_values_to_colors(agg[stat], cmap_choice).tolist(),
+        })
+        if values is not None:
+            layer_data["mean"] = tooltip_values(agg["mean"].round(3))
+            layer_data["max"] = tooltip_values(agg["max"].round(3))
+        return pdk.Layer(
+            "ColumnLayer",
+            data=layer_data,
+            get_position=["lon", "lat"],
+            get_fill_color="color",
+            # 正方形は4頂点を45度回転、六角形は頂点を上向きにする
+            disk_resolution=4 if mode == "grid" else 6,
+            radius=cell_size_m / np.sqrt(2) if mode == "grid" else cell_size_m,
+            angle=45 if mode == "grid" else 90,
+            extruded=False,
+            pickable=True,
+            auto_highlight=True,
+        )
+
+    return memoized_layer(("aggregate", file_key, value_col, mode, cell_size_m, stat, cmap_choice), build)
 
 def display_dashboard():
     # すべてのエントリを統合
@@ -454,6 +2133,17 @@ def display_dashboard():
     # st.sidebar.write("all_entries:")
     # st.sidebar.write(all_entries)
 
+    # ゾーン統計・空間結合・最寄り施設までの距離（計算した列は下の色分け・グラフの設定ですぐに選べる）
+    zonal_statistics_controls(all_entries)
+    spatial_join_controls(all_entries)
+    accessibility_controls(all_entries)
+
+    # 地図（レイヤーの設定を含む）とグラフは、中のウィジェットを変更したときにその部分だけを再実行する
+    map_panel(all_entries)
+    chart_panel(all_entries)
+
+@st.fragment
+def map_panel(all_entries):
     # レイヤーパネル
     st.sidebar.subheader("表示するファイルにチェック")
     layer_visibility = {}
@@ -464,65 +2154,78 @@ def display_dashboard():
         file_name = file_info.get("name", "")
         layer_visibility[file_name] = st.sidebar.checkbox(f"{file_name} を表示", value=True)
 
+    # レイヤーパネルで非表示になっているものを除く
+    visible_entries = [fi for fi in all_entries if not fi.get("name", "") or layer_visibility.get(fi.get("name", ""), True)]
+
+    # ベクターデータの空間インデックスを作り、その境界から地図の表示範囲を決める
+    spatial_indexes = {}
+    all_bounds = []
+    for file_info in visible_entries:
+        dataset = dataset_preview(file_info)
+        try:
+            index = dataset_spatial_index(file_info, dataset)
+        except Exception:
+            # 読み込みエラーは各レイヤーの生成時に表示する
+            index = None
+        if index is not None:
+            spatial_indexes[file_info.get("name", "")] = index
+            all_bounds.append(index["bounds"])
+        elif isinstance(dataset, dict) and "bounds" in dataset:
+            (bounds_left, bounds_bottom), (bounds_right, bounds_top) = dataset["bounds"]
+            all_bounds.append((bounds_left, bounds_bottom, bounds_right, bounds_top))
+    view_box, (center_lat, center_lon, zoom_level) = viewport_controls(all_bounds)
+    view_key = "" if view_box is None else "|view:" + ",".join(f"{v:.5f}" for v in view_box)
+    # 1時刻1ファイルの GeoTIFF は先頭のファイルの位置に1つのレイヤーとしてまとめて表示する
+    # 各ファイルのフレームはそのファイルで指定されたバンドを使う
+    stack_names = raster_stack_controls(visible_entries)
+    stack_frames = []
+    try:
+        for name in stack_names:
+            fi = next(fi for fi in visible_entries if fi.get("name") == name)
+            preview = dataset_preview(fi)
+            stack_frames.append((preview["path"], parse_band(fi.get("band", 1), preview["band_count"])))
+    except ValueError as e:
+        st.sidebar.error(f"時系列にまとめるTIFF {name} のバンド指定エラー: {e}")
+        stack_names, stack_frames = [], []
+
     # --- Pydeck 用：大容量地理空間ファイルの表示 ---
-    map_layers = []
-    all_lat = []
-    all_lon = []
+    # 各レイヤーは memoized_layer で入力ごとに一度だけ作り、作成時の JSON を Deck の送信に使う
+    layer_jsons = []
+    all_tooltip_cols = []
     # CSV・GeoJSON で、緯度・経度の情報が存在するものを対象とする
-    for file_info in all_entries:
-        fname = file_info.get("name", "")
-        # レイヤーパネルで非表示になっている場合はスキップ
-        if fname and not layer_visibility.get(fname, True):
-            continue
-        file_name = fname
+    for file_info in visible_entries:
+        file_name = file_info.get("name", "")
         ext = os.path.splitext(file_name)[1].lower()
         st.sidebar.write(f"選択されたファイル{file_name}")
-        # CSVの場合：プレビューは file_info["preview"]（サンプリング済みであることを想定）
-        if ext == ".csv":
+        # 共有データセットを取得（セッションにはキーのみ保持）
+        dataset = dataset_preview(file_info)
+        # CSV・Parquet・Arrowの表の場合：プレビューは先頭チャンクのみで、必要な列は load_table_columns で読み込む
+        if is_point_table(dataset):
             try:
-                df = file_info.get("preview", None)
+                df_head = dataset
                 lat_col = file_info.get("lat_col", "lat")
                 lon_col = file_info.get("lon_col", "lon")
                 # st.sidebar.write(f"lat_col: {lat_col} lon_col: {lon_col}")
-                if df is not None:
-                    st.sidebar.write(df.describe())
-                    # 大きなデータの場合はサンプルを抽出
+                if df_head is not None:
+                    # 統計量は必要な列を読み込んだ後に表示する
+                    stats_box = st.sidebar.empty()
+                    # 表示方法（集約表示では全点を使い、ポイント表示では大きなデータをサンプル）
                     num = 130000
-                    if len(df) > num:
-                        df_sample = df.sample(n=num, random_state=42)
-                        st.sidebar.warning(f"{file_name}を{num}行にサンプル済み")
-                    else:
-                        df_sample = df
-                if lat_col in df_sample.columns and lon_col in df_sample.columns:
-                    all_lat.extend(df_sample[lat_col].dropna().tolist())
-                    all_lon.extend(df_sample[lon_col].dropna().tolist())
-                    # 属性カラムによる色分け
-                    columns_list = df_sample.columns.tolist() + [None]
+                    display_mode = st.sidebar.selectbox("表示方法", DISPLAY_MODES, key=f"display_mode_{file_name}")
+                if lat_col in df_head.columns and lon_col in df_head.columns:
+                    # 属性カラムによる色分け（列の一覧はヘッダーから取得）
+                    columns_list = df_head.columns.tolist() + [None]
                     color_attr = st.sidebar.selectbox(f"色分けに用いるカラム", columns_list, format_func=lambda x: "None" if x is None else x, index=len(columns_list)-1)
-                    if color_attr and color_attr in df_sample.columns:
+                    if color_attr and color_attr in df_head.columns:
                         # プルダウンでカラーマップを選択
                         cmap_choice = st.sidebar.selectbox(
                             "カラーマップを選択",
-                            ["terrain", "Reds", "Blues", "Greens", "cividis", "magma", "viridis", "twilight", "cool", "coolwarm", "spring", "summer", "autumn", "winter"],
+                            CMAP_CHOICES,
                             key=f"cmap_{file_info.get('name')}"
                         )
-                        cmap = plt.get_cmap(cmap_choice)
-                        filled_vals = df_sample[color_attr].fillna(0)
-                        unique_vals = filled_vals.unique()
-                        if np.issubdtype(unique_vals.dtype, np.number):
-                            norm = mcolors.Normalize(vmin=unique_vals.min(), vmax=unique_vals.max())
-                            df_sample["get_color"] = df_sample[color_attr].apply(
-                                lambda x: [int(c*255) for c in cmap(norm(x))[:3]] + [160]
-                            )
-                        else:
-                            categories = sorted(unique_vals)
-                            n = len(categories)
-                            mapping = {cat: cmap(i/(n-1) if n>1 else 0.5) for i, cat in enumerate(categories)}
-                            df_sample["get_color"] = df_sample[color_attr].apply(
-                                lambda x: [int(c*255) for c in mapping[x][:3]] + [160]
-                            )
-                        get_color_expr = "get_color"
+                        get_color_expr = "color"
                     else:
+                        color_attr = None
                         color_choice = st.sidebar.selectbox(
                             "カラーを選択",
                             ["Red", "Green", "Blue", "Purple", "Yellow", "Orange", "Black", "White"],
@@ -540,6 +2243,33 @@ def display_dashboard():
                             "White": [255, 255, 255, 160]
                         }
                         get_color_expr = color_dict.get(color_choice, [200, 30, 0, 160])
+                        cmap_choice = None
+                    # ツールチップに表示するカラム
+                    tooltip_cols = st.sidebar.multiselect(
+                        "ツールチップに表示するカラム", df_head.columns.tolist(), key=f"tooltip_{file_name}"
+                    )
+                    all_tooltip_cols.extend(tooltip_cols)
+                    # 緯度経度（空間インデックスと共有）と、色分け・ツールチップに使う列だけを読み込む
+                    df, csv_stats = load_table_columns(file_info, [lon_col, lat_col], keep_float64=(lon_col, lat_col))
+                    attr_cols = [c for c in dict.fromkeys([color_attr] + tooltip_cols) if c and c not in (lon_col, lat_col)]
+                    if attr_cols:
+                        attrs, attr_stats = load_table_columns(file_info, attr_cols)
+                        df = pd.concat([df, attrs], axis=1)
+                        csv_stats = pd.concat([csv_stats, attr_stats], axis=1)
+                    stats_box.write(csv_stats)
+                    # 表示範囲が指定されていれば、範囲内の点だけを間引かずに使う
+                    df_view = df
+                    if view_box is not None and file_name in spatial_indexes:
+                        df_view = df.iloc[features_in_view(spatial_indexes[file_name], view_box)]
+                        st.sidebar.caption(f"{file_name}: 表示範囲内 {len(df_view):,} / {len(df):,} 行")
+                    aggregate = display_mode.startswith("集約") or (display_mode == "自動" and len(df_view) > num)
+                    if aggregate and display_mode == "自動":
+                        display_mode = "集約(六角形)"
+                    if not aggregate and len(df_view) > num:
+                        df_sample = df_view.sample(n=num, random_state=42)
+                        st.sidebar.warning(f"{file_name}を{num}行にサンプル済み")
+                    else:
+                        df_sample = df_view
                     # サイズ
                     radius = st.sidebar.text_input(f"半径", value=10, key=f"radius_key_{file_name}")
                     # アイコン表示かポイント表示かを選択
@@ -560,34 +2290,79 @@ def display_dashboard():
                     #     )
                     #     map_layers.append(icon_layer)
                     # else:
-                    csv_layer = pdk.Layer(
-                        "ScatterplotLayer",
-                        data=df_sample,
-                        get_position=[lon_col, lat_col],
-                        get_fill_color=get_color_expr,
-                        get_radius=radius,
-                        pickable=True,
-                        auto_highlight=True,
-                    )
-                    map_layers.append(csv_layer)
+                    if aggregate:
+                        # 全点をセルに集約して表示する
+                        values = df_sample[color_attr] if color_attr and pd.api.types.is_numeric_dtype(df_sample[color_attr]) else None
+                        layer_json = aggregation_controls_and_layer(
+                            file_name, f"{dataset_key(file_info)}{view_key}|{lon_col}|{lat_col}", df_sample[lon_col], df_sample[lat_col],
+                            values, color_attr if values is not None else None, display_mode, cmap_choice,
+                        )
+                        all_tooltip_cols.extend(["count", "mean", "max"] if values is not None else ["count"])
+                    else:
+                        def build_csv_layer():
+                            if color_attr and df_view is not df:
+                                # 色の範囲は表示範囲に関わらずデータ全体で決める（行番号は読み込み時の連番）
+                                colors = map_values_to_colors(df[color_attr], cmap_choice)[df_sample.index.to_numpy()]
+                            else:
+                                colors = map_values_to_colors(df_sample[color_attr], cmap_choice) if color_attr else None
+                            # 描画に必要な列だけを送信する
+                            layer_data = point_layer_frame(df_sample[lon_col], df_sample[lat_col], colors, df_sample[tooltip_cols])
+                            return pdk.Layer(
+                                "ScatterplotLayer",
+                                data=layer_data,
+                                get_position=["lon", "lat"],
+                                get_fill_color=get_color_expr,
+                                get_radius=radius,
+                                pickable=True,
+                                auto_highlight=True,
+                            )
+
+                        layer_json = memoized_layer(
+                            ("points", dataset_key(file_info) + view_key, (lat_col, lon_col), len(df_sample), color_attr, cmap_choice,
+                             str(get_color_expr), tuple(tooltip_cols), radius),
+                            build_csv_layer,
+                        )
+                    layer_jsons.append(layer_json)
+                    report_layer_payload(file_name, layer_json)
                 else:
+                    stats_box.write(df_head.describe())
                     st.sidebar.warning(f"CSVファイル {file_name} に指定された緯度/経度カラムが見つかりません。")
             except Exception as e:
                 st.sidebar.error(f"CSVファイル {file_name} のマップレイヤー生成エラー: {e}")
-        # GeoJSONの場合
-        elif ext == ".geojson":
+        # GeoJSON・GeoParquetの場合
+        elif isinstance(dataset, gpd.GeoDataFrame):
             try:
-                gdf = file_info.get("preview", None)
+                gdf = dataset
                 if gdf is not None:
                     st.sidebar.write(gdf.describe())
-                    # 大きなデータの場合はサンプルを抽出
+                    # 大きなデータの場合はサンプルを抽出（ポイントは集約表示なら全点を使う）
                     num = 50000
-                    if len(gdf) > num:
-                        gdf_sample = gdf.sample(n=num, random_state=42)
+                    is_point = gdf.geometry.geom_type.iloc[0] == "Point"
+                    aggregate = False
+                    use_vector_tiles = False
+                    tile_url = tile_server_url()
+                    if not is_point and tile_url:
+                        # ポリゴンはベクタータイルで配信すれば全件を表示できる（タイルサーバーを使うため、選んだ場合のみ）
+                        polygon_mode = st.sidebar.radio(
+                            "ポリゴンの表示方法", ["ポリゴン", "ベクタータイル"], index=0,
+                            horizontal=True, key=f"polygon_mode_{file_name}",
+                        )
+                        use_vector_tiles = polygon_mode == "ベクタータイル"
+                    if is_point:
+                        display_mode = st.sidebar.selectbox("表示方法", DISPLAY_MODES, key=f"display_mode_{file_name}")
+                        aggregate = display_mode.startswith("集約") or (display_mode == "自動" and len(gdf) > num)
+                        if aggregate and display_mode == "自動":
+                            display_mode = "集約(六角形)"
+                    # 表示範囲が指定されていれば、範囲と交差する地物だけを間引かずに使う（ベクタータイルはタイルごとに絞り込まれる）
+                    rows = None
+                    if view_box is not None and not use_vector_tiles and file_name in spatial_indexes:
+                        rows = features_in_view(spatial_indexes[file_name], view_box)
+                        st.sidebar.caption(f"{file_name}: 表示範囲内 {len(rows):,} / {len(gdf):,} 件")
+                    n_view = len(gdf) if rows is None else len(rows)
+                    if not aggregate and not use_vector_tiles and n_view > num:
+                        rows = np.sort(np.random.default_rng(42).choice(np.arange(len(gdf)) if rows is None else rows, num, replace=False))
                         st.sidebar.warning(f"{file_name}を{num}行にサンプル済み")
-                    else:
-                        gdf_sample = gdf
-                    geojson_data = gdf_sample.__geo_interface__
+                    gdf_sample = gdf if rows is None else gdf.iloc[rows]
                     # 属性カラムによる色分け
                     columns_list = gdf_sample.columns.tolist() + [None]
                     color_attr = st.sidebar.selectbox(f"色分けに用いるカラム", columns_list, format_func=lambda x: "None" if x is None else x, index=len(columns_list)-1)
@@ -595,24 +2370,16 @@ def display_dashboard():
                         # プルダウンでカラーマップを選択
                         cmap_choice = st.sidebar.selectbox(
                             "カラーマップを選択",
-                            ["terrain", "Reds", "Blues", "Greens", "cividis", "magma", "viridis", "twilight", "cool", "coolwarm", "spring", "summer", "autumn", "winter"],
+                            CMAP_CHOICES,
                             key=f"cmap_{file_info.get('name')}"
                         )
-                        cmap = plt.get_cmap(cmap_choice)
-                        filled_vals = gdf_sample[color_attr].fillna(0)
-                        unique_vals = filled_vals.unique()
-                        if np.issubdtype(unique_vals.dtype, np.number):
-                            norm = mcolors.Normalize(vmin=unique_vals.min(), vmax=unique_vals.max())
-                            # 各フィーチャーに対して、色を計算し、properties に "get_color" として保存
-                            for feature in geojson_data["features"]:
-                                if color_attr in feature["properties"]:
-                                    val = feature["properties"][color_attr]
-                                    if val is None:
-                                        feature["properties"]["get_color"] = [200, 30, 0, 160]
-                                        continue
-                                    color = cmap(norm(val))  # RGBA (0～1)
-                                    # 0～255 に変換し、alpha を固定(例: 160)
-                                    feature["properties"]["get_color"] = [int(255 * color[i]) for i in range(3)] + [160]
+                        def layer_colors():
+                            if view_box is not None and rows is not None:
+                                # 色の範囲は表示範囲に関わらずデータ全体で決める
+                                return map_values_to_colors(gdf[color_attr], cmap_choice)[rows]
+                            return map_values_to_colors(gdf_sample[color_attr], cmap_choice)
+                        color_choice = None
+                        color_key = f"{color_attr}|{cmap_choice}"
                     else:
                         # color_attrがなければ全てにデフォルト色を設定
                         color_choice = st.sidebar.selectbox(
@@ -631,17 +2398,29 @@ def display_dashboard():
                             "Black": [0, 0, 0, 160],
                             "White": [255, 255, 255, 160]
                         }
-                        get_color_expr = color_dict.get(color_choice, [200, 30, 0, 160])
-                        for feature in geojson_data["features"]:
-                            feature["properties"]["get_color"] = get_color_expr
-                    # 座標の中心は gdf の全体境界から計算
-                    bounds = gdf_sample.total_bounds  # [minx, miny, maxx, maxy]
-                    center_lat = (bounds[1] + bounds[3]) / 2
-                    center_lon = (bounds[0] + bounds[2]) / 2
-                    all_lat.append(center_lat)
-                    all_lon.append(center_lon)
+                        get_color_expr = color_dict.get(color_choice, NAN_COLOR)
+
+                        def layer_colors():
+                            return np.tile(np.array(get_color_expr, dtype=np.uint8), (len(gdf_sample), 1))
+                        cmap_choice = None
+                        color_key = color_choice
+                    # ツールチップに表示するカラム
+                    tooltip_cols = st.sidebar.multiselect(
+                        "ツールチップに表示するカラム",
+                        [col for col in gdf_sample.columns if col != gdf_sample.geometry.name],
+                        key=f"tooltip_{file_name}",
+                    )
+                    all_tooltip_cols.extend(tooltip_cols)
                     # ジオメトリの種類によって処理を分ける
-                    if gdf_sample.geometry.geom_type.iloc[0] == "Point":
+                    if is_point and aggregate:
+                        # 全点をセルに集約して表示する
+                        values = gdf_sample[color_attr] if color_attr and pd.api.types.is_numeric_dtype(gdf_sample[color_attr]) else None
+                        layer_json = aggregation_controls_and_layer(
+                            file_name, dataset_key(file_info) + view_key, gdf_sample.geometry.x, gdf_sample.geometry.y,
+                            values, color_attr if values is not None else None, display_mode, cmap_choice,
+                        )
+                        all_tooltip_cols.extend(["count", "mean", "max"] if values is not None else ["count"])
+                    elif is_point:
                         # if st.button("アイコンで表示", key=f"icon_button_{file_name}"):
                         #     # アイコンのアトラス（1枚の画像に複数のアイコンが含まれる画像）と、アイコンのマッピング情報を設定
                         #     icon_atlas = "./icon-atlas.png"
@@ -662,25 +2441,65 @@ def display_dashboard():
                         # CSVの場合にはポイントのサイズ
                         radius = st.sidebar.text_input(f"半径", value=30, key=f"radius_key_{file_name}")
                         # Pointの場合にはScatterplotLayer
-                        geojson_layer = pdk.Layer(
-                            "ScatterplotLayer",
-                            data=gdf_sample,
-                            get_position="geometry.coordinates",
-                            get_fill_color="properties.get_color",
-                            get_radius=radius,
-                            pickable=True,
-                            auto_highlight=True,
+                        def build_point_layer():
+                            # 単色の場合は色を列として送らず定数で指定する
+                            point_colors = layer_colors() if color_attr else None
+                            layer_data = point_layer_frame(gdf_sample.geometry.x, gdf_sample.geometry.y, point_colors, gdf_sample[tooltip_cols])
+                            return pdk.Layer(
+                                "ScatterplotLayer",
+                                data=layer_data,
+                                get_position=["lon", "lat"],
+                                get_fill_color="color" if color_attr else get_color_expr,
+                                get_radius=radius,
+                                pickable=True,
+                                auto_highlight=True,
+                            )
+
+                        layer_json = memoized_layer(
+                            ("points", dataset_key(file_info) + view_key, (file_info.get("lat_col"), file_info.get("lon_col")), len(gdf_sample),
+                             color_key, tuple(tooltip_cols), radius),
+                            build_point_layer,
+                        )
+                    elif use_vector_tiles:
+                        # 全ポリゴンをベクタータイルとして配信する
+                        source_id = vector_tile_source_id(
+                            dataset_key(file_info), gdf_sample, layer_colors, color_key, tooltip_cols, view_box, zoom_level
+                        )
+                        layer_json = memoized_layer(
+                            ("vector_tiles", tile_url, source_id), lambda: vector_tile_layer(tile_url, source_id)
                         )
-                        map_layers.append(geojson_layer)
                     else:
-                        geojson_layer = pdk.Layer(
-                            "GeoJsonLayer",
-                            data=geojson_data,
-                            get_fill_color="properties.get_color",
-                            pickable=True,
-                            auto_highlight=True,
+                        # 表示するズームレベルに合った詳細度のジオメトリを選ぶ
+                        pyramid = geometry_lod_pyramid(file_info.get("cache_key", file_name), gdf.geometry.values)
+                        lod_zoom = lod_for_zoom(pyramid, zoom_level)
+                        original = np.asarray(gdf_sample.geometry.values)
+                        levels = {level: geoms if rows is None else geoms[rows] for level, geoms in pyramid.items()}
+                        vertex_counts = [
+                            f"{'▶' if level == lod_zoom else ''}z{level}: {shapely.get_num_coordinates(geoms).sum():,}"
+                            for level, geoms in levels.items()
+                        ]
+                        vertex_counts.append(f"{'▶' if lod_zoom is None else ''}元: {shapely.get_num_coordinates(original).sum():,}")
+                        st.sidebar.caption(f"{file_name} の頂点数（▶ が送信するレベル）: " + "、".join(vertex_counts))
+                        # ポリゴンは座標配列を直接 PolygonLayer に渡す（設定ごとにキャッシュ）
+                        def build_polygon_layer():
+                            polygon_records = polygon_layer_records(
+                                gdf_sample, layer_colors(), tooltip_cols, geometry=None if lod_zoom is None else levels[lod_zoom]
+                            )
+                            return pdk.Layer(
+                                "PolygonLayer",
+                                data=polygon_records,
+                                get_polygon="polygon",
+                                get_fill_color="color",
+                                pickable=True,
+                                auto_highlight=True,
+                            )
+
+                        layer_json = memoized_layer(
+                            ("polygons", dataset_key(file_info) + view_key, len(gdf_sample), color_key, tuple(tooltip_cols), lod_zoom),
+                            build_polygon_layer,
                         )
-                        map_layers.append(geojson_layer)
+                    layer_jsons.append(layer_json)
+                    report_layer_payload(file_name, layer_json)
                 else:
                     st.sidebar.warning(f"GeoJSONファイル {file_name} の読み込みに失敗しました。")
             except Exception as e:
@@ -688,61 +2507,114 @@ def display_dashboard():
         # TIFFの場合
         elif ext in [".tiff", ".tif"]:
             try:
-                preview = file_info.get("preview", None)
+                preview = dataset
+                if file_name in stack_names[1:]:
+                    # 時系列にまとめたファイルは先頭のファイルのレイヤーで表示する
+                    continue
                 if preview is not None:
-                    img_array = preview.get("img_array", None)
-                    bounds = preview.get("bounds", None)
-                    if img_array is not None:
-                        img_url = numpy_array_to_data_uri(img_array)
-                        img_url_ = f'{img_url}'
-                    if bounds is not None:
-                        bounds_left = bounds[0][0]
-                        bounds_bottom = bounds[0][1]
-                        bounds_right = bounds[1][0]
-                        bounds_top = bounds[1][1]
-                # st.write(f"{img_url_}") # debug
-                # BitmapLayerを作成
-                # bitmap_layer = pdk.Layer(
-                #     "BitmapLayer",
-                #     data=None,
-                #     image=img_url_,
-                #     bounds=[[bounds_left, bounds_bottom], [bounds_right, bounds_top]]
-                # )
-                # map_layers.append(bitmap_layer)
-                # st.write(f"TIFFファイル {file_name} をマップレイヤーに追加しました。")
-                st.sidebar.warning(f"TIFFファイル {file_name} には対応していません。")
+                    # 時系列：まとめた複数のファイル、または日時の付いた複数のバンド
+                    frames = []
+                    if stack_names and file_name == stack_names[0]:
+                        frames = stack_frames
+                        labels = [
+                            parse_timestamp(name).strftime("%Y-%m-%d %H:%M") if parse_timestamp(name) is not None else name
+                            for name in stack_names
+                        ]
+                        st.sidebar.write(f"時系列: {len(frames)} ファイル")
+                    elif preview["band_count"] > 1:
+                        timestamps = raster_band_timestamps(preview["path"], file_version(preview["path"]))
+                        if st.sidebar.checkbox(
+                            "バンドを時刻として切り替える", value=any(ts is not None for ts in timestamps), key=f"time_bands_{file_name}"
+                        ):
+                            frames = [(preview["path"], band) for band in range(1, preview["band_count"] + 1)]
+                            labels = [
+                                ts.strftime("%Y-%m-%d %H:%M") if ts is not None else f"バンド{band}"
+                                for band, ts in zip(range(1, preview["band_count"] + 1), timestamps)
+                            ]
+                    if frames:
+                        # 選択中の時刻のフレームだけを（表示範囲が指定されていればその範囲で）読み込む
+                        frame_path, band, raster = time_series_frame(file_name, frames, labels, view_box)
+                        data_min, data_max = stack_value_range(tuple(frames), tuple(file_version(path) for path, _ in frames))
+                        range_key = f"range_{file_name}_stack"
+                    else:
+                        # 指定されたバンドのみを（表示範囲が指定されていればその範囲で）表示解像度で読み込む
+                        band = parse_band(file_info.get("band", 1), preview["band_count"])
+                        frame_path = preview["path"]
+                        raster = read_raster_band(frame_path, band, view_bounds=view_box, version=file_version(frame_path))
+                        if view_box is None:
+                            data_min = float(np.nanmin(raster["img_array"])) if np.isfinite(raster["img_array"]).any() else np.nan
+                            data_max = float(np.nanmax(raster["img_array"])) if np.isfinite(raster["img_array"]).any() else np.nan
+                        else:
+                            # 表示範囲を動かしても色の対応が変わらないよう、値の範囲はバンド全体から求める
+                            data_min, data_max = stack_value_range(((frame_path, band),), (file_version(frame_path),))
+                        range_key = f"range_{file_name}_{band}"
+                    img_array = raster["img_array"]
+                    if not np.isfinite(img_array).any() or not np.isfinite(data_min):
+                        st.sidebar.warning(f"TIFFファイル {file_name} のバンド{band}に有効な値がありません。")
+                        continue
+                    # カラーマップと色分けの値の範囲
+                    cmap_choice = st.sidebar.selectbox("カラーマップを選択", CMAP_CHOICES, key=f"cmap_{file_name}")
+                    data_min = round(data_min, 2)
+                    data_max = round(data_max, 2)
+                    if data_max > data_min:
+                        vmin, vmax = st.sidebar.slider(
+                            "色分けの値の範囲", data_min, data_max, (data_min, data_max), key=range_key
+                        )
+                    else:
+                        vmin, vmax = data_min, data_max
+                    (bounds_left, bounds_bottom), (bounds_right, bounds_top) = raster["bounds"]
+                    # 画像1枚で表示するか、ズームに応じたタイルで表示するか
+                    # （タイルはタイルサーバーにブラウザから届く場合のみ選べる）
+                    tile_url = tile_server_url()
+                    raster_mode = "画像"
+                    if tile_url:
+                        raster_mode = st.sidebar.radio("ラスタの表示方法", ["画像", "タイル"], horizontal=True, key=f"raster_mode_{file_name}")
+                    if raster_mode == "タイル":
+                        layer_json = compact_json(raster_tile_layer(tile_url, frame_path, band, cmap_choice, vmin, vmax, preview["bounds"]))
+                    else:
+                        image_cache = frame_image_url if frames else raster_image_url
+                        if frames:
+                            image_args = (frame_path, file_version(frame_path), band, view_box, cmap_choice, vmin, vmax, img_array)
+                        else:
+                            image_args = (frame_path, band, view_box, cmap_choice, vmin, vmax, file_version(frame_path))
+                        img_url = image_cache(*image_args)
+                        if not touch_image_url(img_url):
+                            # 上限を超えて削除された画像は書き出し直す
+                            image_cache.clear()
+                            img_url = image_cache(*image_args)
+                        layer_json = memoized_layer(
+                            ("raster", img_url, bounds_left, bounds_bottom, bounds_right, bounds_top),
+                            lambda: pdk.Layer(
+                                "BitmapLayer",
+                                data=None,
+                                image=pdk.types.String(img_url),
+                                bounds=[bounds_left, bounds_bottom, bounds_right, bounds_top],
+                            ),
+                        )
+                    layer_jsons.append(layer_json)
+                    report_layer_payload(file_name, layer_json)
+                else:
+                    st.sidebar.warning(f"TIFFファイル {file_name} の読み込みに失敗しました。")
             except Exception as e:
                 st.sidebar.error(f"TIFFファイル {file_name} の読み込みエラー: {e}")
 
-    # 自動で中心とズームレベルを設定
-    if all_lat and all_lon:
-        center_lat = sum(all_lat) / len(all_lat)
-        center_lon = sum(all_lon) / len(all_lon)
-        lat_extent = max(all_lat) - min(all_lat)
-        lon_extent = max(all_lon) - min(all_lon)
-        extent = max(lat_extent, lon_extent)
-        if extent < 0.1:
-            zoom_level = 15
-        elif extent < 1:
-            zoom_level = 10
-        else:
-            zoom_level = 5
-    else:
-        center_lat, center_lon, zoom_level = 36, 138, 5
-
-    if map_layers:
-        deck_chart = pdk.Deck(
+    if layer_jsons:
+        deck_chart = CompactDeck(
             initial_view_state=pdk.ViewState(
                 latitude=center_lat,
                 longitude=center_lon,
                 zoom=zoom_level,
             ),
-            layers=map_layers,
             map_style="mapbox://styles/mapbox/light-v9",
+            tooltip=tooltip_spec(list(dict.fromkeys(all_tooltip_cols))),
+            layer_json=layer_jsons,
         )
+        st.pydeck_chart(deck_chart, use_container_width=True)
     else:
-        deck_chart = None
+        st.info("表示する地図レイヤーがありません。")
 
+@st.fragment
+def chart_panel(all_entries):
     # --- Plotly 用：複数ファイルのグラフ作成 ---
     # Plotly 用グラフ用変数を初期化
     plotly_fig = None
@@ -757,7 +2629,7 @@ def display_dashboard():
         file_choice = st.sidebar.selectbox("ファイルを選択", options=file_options)
         # 選択された file_info を取得
         file_info = next(fi for fi in all_entries if fi.get("name") == file_choice)
-        df = file_info.get("preview", None)
+        df = dataset_preview(file_info)
         if df is None:
             st.error("選択されたファイルのプレビューがありません。")
         elif isinstance(df, pd.DataFrame) or isinstance(df, gpd.GeoDataFrame):
@@ -768,74 +2640,98 @@ def display_dashboard():
             default_index = len(cols) - 1
             col1 = st.sidebar.selectbox("1つ目のカラムを選択", options=cols, key="plot_col1", index=default_index)
             col2 = st.sidebar.selectbox("2つ目のカラムを選択(オプション)", options=cols, key="plot_col2", index=default_index)
+            # 数値カラムの区分方法（積み上げ縦棒グラフ・円グラフ）
+            classify_method = CLASSIFY_METHODS[
+                st.sidebar.selectbox("数値の区分方法", options=list(CLASSIFY_METHODS), key="classify_method")
+            ]
+            # 選択したカラムのデータを取得（CSVは選択した列だけを読み込む）
+            schema_df = df
+            df = file_frame(file_info, [col1, col2])
             # グラフ作成
             if graph_type == "散布図":
                 try:
-                    df_numeric = df[[col1, col2]].apply(pd.to_numeric, errors="coerce")
-                    plotly_fig = px.scatter(df_numeric, x=col1, y=col2, title="散布図")
+                    x_values = pd.to_numeric(df[col1], errors="coerce").to_numpy(dtype=np.float64)
+                    y_values = pd.to_numeric(df[col2], errors="coerce").to_numpy(dtype=np.float64)
+                    if len(df) <= SCATTER_DENSITY_THRESHOLD:
+                        plotly_fig = px.scatter(x=x_values, y=y_values, labels={"x": col1, "y": col2}, title="散布図")
+                    else:
+                        # 行数が多い場合はサーバー側で 2 次元ヒストグラムを作り、密度として表示する
+                        x_full, y_full = finite_range(x_values), finite_range(y_values)
+                        if x_full is None or y_full is None:
+                            raise ValueError("数値として扱えるデータがありません。")
+                        st.sidebar.caption(f"{len(df):,} 行のため密度表示にしています。範囲を絞ると点で表示します。")
+                        x_range = st.sidebar.slider(f"{col1} の表示範囲", min_value=x_full[0], max_value=x_full[1], value=x_full, key=f"scatter_x_{file_choice}_{col1}")
+                        y_range = st.sidebar.slider(f"{col2} の表示範囲", min_value=y_full[0], max_value=y_full[1], value=y_full, key=f"scatter_y_{file_choice}_{col2}")
+                        numeric_cols = [c for c in schema_df.columns if c not in (col1, col2) and pd.api.types.is_numeric_dtype(schema_df[c])]
+                        weight_col = st.sidebar.selectbox("重み付けするカラム(オプション)", options=[None] + numeric_cols, key=f"scatter_w_{file_choice}")
+                        log_scale = st.sidebar.checkbox("対数スケールで表示", value=True, key="scatter_log")
+                        weights = None
+                        if weight_col is not None:
+                            weights = pd.to_numeric(file_frame(file_info, [weight_col])[weight_col], errors="coerce").to_numpy(dtype=np.float64)
+                        grid, n_in_range = cached_density_grid(
+                            dataset_key(file_info), col1, col2, weight_col, tuple(x_range), tuple(y_range),
+                            SCATTER_DENSITY_BINS, x_values, y_values, weights
+                        )
+                        if n_in_range <= SCATTER_DENSITY_THRESHOLD and weight_col is None:
+                            # 表示範囲内の点が少なければ、実際の点で描画する
+                            in_range = (x_values >= x_range[0]) & (x_values <= x_range[1]) & (y_values >= y_range[0]) & (y_values <= y_range[1])
+                            plotly_fig = px.scatter(x=x_values[in_range], y=y_values[in_range], labels={"x": col1, "y": col2}, title="散布図")
+                        else:
+                            plotly_fig = density_scatter_figure(col1, col2, x_range, y_range, "散布図（密度表示）", grid, log_scale, weight_col)
                 except Exception as e:
                     st.error(f"散布図作成エラー: {e}")
             elif graph_type == "積み上げ縦棒グラフ":
                 try:
-                    # col1 のグループ（文字列のシリーズ）を取得
-                    group1 = group_by_range(df[col1], max_categories=5)[1]
+                    # col1 の区分番号と区分名を取得し、サーバー側で件数を集計する
+                    codes1, labels1 = chart_categories(df[col1], max_categories=5, method=classify_method, role="col1")
                     if col2 is not None:
-                        # col2 も指定されている場合は、両方のグループのクロス集計を行い積み上げグラフを作成
-                        group2 = group_by_range(df[col2], max_categories=5)[1]
-                        ctab = pd.crosstab(group1, group2)
+                        # col2 も指定されている場合は、両方の区分のクロス集計を行い積み上げグラフを作成
+                        codes2, labels2 = chart_categories(df[col2], max_categories=5, method=classify_method, role="col2")
+                        ctab = count_table(codes1, len(labels1), codes2, len(labels2))
                         fig = go.Figure()
-                        for cat in ctab.columns:
+                        for j, cat in enumerate(labels2):
                             fig.add_trace(go.Bar(
-                                x=ctab.index,
-                                y=ctab[cat],
-                                name=str(cat)
+                                x=labels1,
+                                y=ctab[:, j],
+                                name=cat
                             ))
                         fig.update_layout(barmode='stack', title="積み上げ縦棒グラフ")
                     else:
                         # col2 が None の場合は、col1 のカウントを単一の棒グラフで表示
-                        counts = group1.value_counts().sort_index()
+                        counts = count_table(codes1, len(labels1))
                         fig = go.Figure(data=[go.Bar(
-                            x=counts.index,
-                            y=counts.values
+                            x=labels1,
+                            y=counts
                         )])
                         fig.update_layout(title=f"{col1} の分布")
+                    fig.update_xaxes(type="category", categoryorder="array", categoryarray=labels1)
                     plotly_fig = fig
                 except Exception as e:
                     st.error(f"積み上げ縦棒グラフ作成エラー: {e}")
             elif graph_type == "円グラフ":
                 try:
-                    # col1 のグループ（文字列のシリーズ）を取得
-                    group1 = group_by_range(df[col1], max_categories=5)[1]
+                    # 区分ごとの件数だけを Plotly に渡す
+                    codes1, labels1 = chart_categories(df[col1], max_categories=5, method=classify_method, role="col1")
                     if col2 is not None:
-                        group2 = group_by_range(df[col2], max_categories=5)[1]
-                        plotly_fig1 = px.pie(df, names=group1, title=f"{col1} の分布")
-                        plotly_fig2 = px.pie(df, names=group2, title=f"{col2} の分布")
+                        codes2, labels2 = chart_categories(df[col2], max_categories=5, method=classify_method, role="col2")
+                        plotly_fig1 = pie_chart(labels1, count_table(codes1, len(labels1)), f"{col1} の分布")
+                        plotly_fig2 = pie_chart(labels2, count_table(codes2, len(labels2)), f"{col2} の分布")
                     else:
                         # col2 が None の場合は、col1 の分布のみ表示
-                        plotly_fig = px.pie(df, names=group1, title=f"{col1} の分布")
+                        plotly_fig = pie_chart(labels1, count_table(codes1, len(labels1)), f"{col1} の分布")
                 except Exception as e:
                     st.error(f"円グラフ作成エラー: {e}")
         else:
             st.error("選択されたファイルは適切な形式ではありません。")
 
-    # --- 上下レイアウトで表示 ---
-    top_container = st.container()
-    bottom_container = st.container()
-    
-    with top_container:
-        if deck_chart is not None:
-            st.pydeck_chart(deck_chart, use_container_width=True)
-        else:
-            st.info("表示する地図レイヤーがありません。")
-    
-    with bottom_container:
-        if plotly_fig is not None:
-            st.plotly_chart(plotly_fig, use_container_width=True)
-        elif plotly_fig1 is not None and plotly_fig2 is not None:
-            st.plotly_chart(plotly_fig1, use_container_width=True)
-            st.plotly_chart(plotly_fig2, use_container_width=True)
-        else:
-            st.info("表示するグラフデータがありません。")
+    # --- 地図の下に表示 ---
+    if plotly_fig is not None:
+        st.plotly_chart(plotly_fig, use_container_width=True)
+    elif plotly_fig1 is not None and plotly_fig2 is not None:
+        st.plotly_chart(plotly_fig1, use_container_width=True)
+        st.plotly_chart(plotly_fig2, use_container_width=True)
+    else:
+        st.info("表示するグラフデータがありません。")
 
 def main():
     st.title("高解像度熱中症リスクダッシュボード by HITS")
@@ -0,0 +1,27 @@
+import os
+import sys
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# リポジトリ直下のモジュール（jobs.py など）を import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def write_geotiff(tmp_path):
+    # 配列（バンド, 行, 列）を経緯度の GeoTIFF として書き出し、パスを返す
+    def write(name, data, left=139.7, top=35.7, res=0.001, crs="EPSG:4326", nodata=None, descriptions=None):
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        path = str(tmp_path / name)
+        with rasterio.open(
+            path, "w", driver="GTiff", width=data.shape[2], height=data.shape[1], count=data.shape[0],
+            dtype="float32", crs=crs, transform=from_origin(left, top, res, res), nodata=nodata,
+        ) as dst:
+            dst.write(data)
+            for band, description in enumerate(descriptions or [], start=1):
+                dst.set_band_description(band, description)
+        return path
+    return write
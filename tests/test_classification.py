@@ -0,0 +1,18 @@
+import numpy as np
+from classification import ckmeans_breaks, classify_numeric
+
+def test_ckmeans_finds_natural_groups():
+    x = np.array([1.0, 1.1, 1.2, 5.0, 5.1, 9.0, 9.2, 9.3])
+    assert ckmeans_breaks(x, np.ones(len(x)), 3) == [2, 4, 7]
+
+def test_classify_numeric_methods():
+    values = np.random.default_rng(0).gamma(4.0, 7.0, 10_000)
+    values[:10] = np.nan
+    for method in ("jenks", "quantile", "equal"):
+        codes, labels = classify_numeric(values, 5, method)
+        assert len(labels) == 5
+        assert (codes[:10] == -1).all()
+        assert set(np.unique(codes[10:])) == set(range(5))
+        # 区分番号の順に値が大きくなる
+        maxima = [values[codes == c].max() for c in range(5)]
+        assert maxima == sorted(maxima)
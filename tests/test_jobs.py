@@ -0,0 +1,55 @@
+import time
+import pytest
+from jobs import JobCancelled, JobExecutor
+
+def slow_sum(n, step=0.05, progress=None):
+    # n 回に分けて少しずつ足す（ワーカープロセスから import される）
+    total = 0
+    for i in range(n):
+        time.sleep(step)
+        total += i
+        if progress:
+            progress(i + 1, n)
+    return total
+
+@pytest.fixture
+def executor():
+    executor = JobExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+def test_same_key_shares_one_job_and_reports_progress(executor):
+    first = executor.submit(("sum", 30), slow_sum, 30, owner="a:chart")
+    second = executor.submit(("sum", 30), slow_sum, 30, owner="b:chart")
+    assert first is second
+    seen = []
+    while not first.done():
+        seen.append(executor.progress(("sum", 30)))
+        time.sleep(0.2)
+    assert first.result() == sum(range(30))
+    assert any(done > 0 and total == 30 for done, total in seen)
+    assert executor.stats()["deduplicated"] == 1
+
+def test_completed_result_is_reused(executor):
+    assert executor.submit(("sum", 5), slow_sum, 5).result() == sum(range(5))
+    again = executor.submit(("sum", 5), slow_sum, 5)
+    assert again.done() and again.result() == sum(range(5))
+    assert executor.stats()["submitted"] == 1
+
+def test_superseded_job_is_cancelled(executor):
+    old = executor.submit(("sum", 200), slow_sum, 200, owner="a:chart")
+    time.sleep(1.5)
+    new = executor.submit(("sum", 10), slow_sum, 10, owner="a:chart")
+    with pytest.raises(JobCancelled):
+        old.result()
+    assert new.result() == sum(range(10))
+    assert executor.stats()["cancelled"] == 1
+
+def test_released_key_requested_again_starts_fresh_job(executor):
+    # A → B → A と切り替えても、取り消した A の Future を返さない
+    a = executor.submit(("sum", 200), slow_sum, 200, owner="a:chart")
+    time.sleep(1.5)
+    executor.submit(("sum", 3), slow_sum, 3, owner="a:chart")
+    again = executor.submit(("sum", 200), slow_sum, 200, 0.001, owner="a:chart")
+    assert again is not a
+    assert again.result() == sum(range(200))
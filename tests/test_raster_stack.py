@@ -0,0 +1,67 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import rasterio
+from raster_stack import FrameCache, band_timestamps, parse_timestamp, read_frame, value_range
+
+def test_parse_timestamp():
+    assert parse_timestamp("wbgt_20240801_13.tif") == pd.Timestamp(2024, 8, 1, 13)
+    assert parse_timestamp("2024-08-01T13:30") == pd.Timestamp(2024, 8, 1, 13, 30)
+    assert parse_timestamp("wbgt.tif") is None
+
+def test_band_timestamps_from_descriptions(write_geotiff):
+    path = write_geotiff("hourly.tif", np.zeros((2, 4, 4)), descriptions=["2024-08-01T12:00", "2024-08-01T13:00"])
+    with rasterio.open(path) as src:
+        assert band_timestamps(src) == [pd.Timestamp(2024, 8, 1, 12), pd.Timestamp(2024, 8, 1, 13)]
+
+def test_read_frame_view_bounds(write_geotiff):
+    data = np.arange(100 * 100, dtype=np.float32).reshape(100, 100)
+    path = write_geotiff("grid.tif", data)
+    with rasterio.open(path) as src:
+        frame = read_frame(src, 1, max_size=1024, view_bounds=(139.71, 35.65, 139.72, 35.66))
+    assert frame["img_array"].shape == (10, 10)
+    np.testing.assert_allclose(frame["bounds"], [[139.71, 35.65], [139.72, 35.66]])
+    np.testing.assert_array_equal(frame["img_array"], data[40:50, 10:20])
+
+def test_value_range_covers_all_frames(write_geotiff):
+    first = write_geotiff("a.tif", np.full((8, 8), 20.0))
+    second = write_geotiff("b.tif", np.full((8, 8), 30.0))
+    assert value_range([(first, 1), (second, 1)]) == (20.0, 30.0)
+
+def test_prefetched_frames_are_hits(write_geotiff):
+    path = write_geotiff("stack.tif", np.arange(6, dtype=np.float32)[:, None, None] * np.ones((6, 32, 32)))
+    frames = [(path, band) for band in range(1, 7)]
+    cache = FrameCache(max_frames=4)
+    try:
+        for i, (frame_path, band) in enumerate(frames):
+            frame = cache.get(frame_path, band)
+            assert frame["img_array"][0, 0] == band - 1
+            cache.prefetch(frames[i + 1:i + 3])
+            time.sleep(0.1)
+        stats = cache.stats()
+        assert stats["misses"] == 1 and stats["hits"] == 5
+        assert stats["frames"] <= 4
+    finally:
+        cache.shutdown()
+
+def test_rewritten_file_is_read_again(write_geotiff):
+    path = write_geotiff("frame.tif", np.full((8, 8), 1.0))
+    cache = FrameCache(max_frames=4)
+    try:
+        assert np.nanmax(cache.get(path, 1)["img_array"]) == 1.0
+        stat = os.stat(path)
+        write_geotiff("frame.tif", np.full((8, 8), 2.0))
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        assert np.nanmax(cache.get(path, 1)["img_array"]) == 2.0
+    finally:
+        cache.shutdown()
+
+def test_read_frame_outside_raster_is_empty(write_geotiff):
+    path = write_geotiff("grid.tif", np.ones((100, 100)))
+    utm = write_geotiff("utm.tif", np.ones((100, 100)), left=380000, top=3950000, res=30, crs="EPSG:32654")
+    for frame_path in (path, utm):
+        with rasterio.open(frame_path) as src:
+            frame = read_frame(src, 1, view_bounds=(135.0, 34.0, 135.1, 34.1))
+        assert not np.isfinite(frame["img_array"]).any()
+        np.testing.assert_allclose(frame["bounds"], [[135.0, 34.0], [135.1, 34.1]])
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pydeck as pdk
+import shapely
+import streamlit_app
+from streamlit_app import (
+    accessibility_summary, aggregate_points, compact_frame, load_accessibility,
+    map_values_to_colors, memoized_layer, points_in_polygons, read_table_columns, spatial_join_statistics,
+)
+
+def test_unchanged_layer_is_not_reserialized():
+    streamlit_app.get_layer_json_cache.clear()
+    builds = []
+    def build(name, radius):
+        def make():
+            builds.append((name, radius))
+            return pdk.Layer("ScatterplotLayer", data=[{"lon": 139.7, "lat": 35.6}], get_position=["lon", "lat"], get_radius=radius)
+        return make
+    first = memoized_layer(("points", "a", 100), build("a", 100))
+    memoized_layer(("points", "b", 100), build("b", 100))
+    # もう一方のレイヤーの半径だけを変更する
+    again = memoized_layer(("points", "a", 100), build("a", 100))
+    memoized_layer(("points", "b", 200), build("b", 200))
+    assert again is first
+    assert builds == [("a", 100), ("b", 100), ("b", 200)]
+
+def test_layer_json_cache_is_bounded_by_size(monkeypatch):
+    streamlit_app.get_layer_json_cache.clear()
+    monkeypatch.setattr(streamlit_app, "LAYER_JSON_CACHE_MAX_MB", 1)
+    data = [{"lon": 139.7 + i * 1e-6, "lat": 35.6} for i in range(10_000)]
+    for i in range(5):
+        memoized_layer(("points", i), lambda: pdk.Layer("ScatterplotLayer", data=data, get_position=["lon", "lat"]))
+    cache = streamlit_app.get_layer_json_cache()
+    assert cache["nbytes"] <= 1024 * 1024
+    assert cache["nbytes"] == sum(len(v) for v in cache["entries"].values())
+    assert ("points", 4) in cache["entries"] and ("points", 0) not in cache["entries"]
+
+def test_prune_cache_dir_removes_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(streamlit_app, "DISK_CACHE_MIN_AGE_S", 60)
+    now = time.time()
+    def write(name, age, size=400 * 1024):
+        path = tmp_path / name
+        path.write_bytes(b"x" * size)
+        os.utime(path, (now - age, now - age))
+        return str(path)
+    oldest = write("a.csv", 300)
+    write("a.csv.part", 300)
+    kept = write("b.csv", 200)
+    used = write("c.csv", 100)
+    recent = write("d.csv", 10)
+    # 使われた時刻（atime）だけを更新しても版（mtime）は変わらない
+    mtime = os.stat(used).st_mtime_ns
+    streamlit_app.touch_cache_file(used)
+    assert os.stat(used).st_mtime_ns == mtime
+    streamlit_app.prune_cache_dir(str(tmp_path), 1, keep=[kept])
+    assert sorted(os.listdir(tmp_path)) == ["b.csv", "c.csv", "d.csv"]
+    # 上限を超えていても最近使われた・書き込まれたファイルは残す
+    streamlit_app.prune_cache_dir(str(tmp_path), 0)
+    assert sorted(os.listdir(tmp_path)) == ["c.csv", "d.csv"] and os.path.exists(recent)
+
+def test_evicted_dataset_removes_spill_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(streamlit_app, "INGEST_CACHE_MAX_MB", 1)
+    spill = tmp_path / "spill.pkl"
+    spill.write_bytes(b"x")
+    registry = {"entries": OrderedDict(), "nbytes": 0, "lock": threading.Lock()}
+    for key, path in (("old", str(spill)), ("new", None)):
+        registry["entries"][key] = {"value": np.zeros(1), "nbytes": 1024 * 1024, "spill_path": path, "name": key, "sessions": set()}
+        registry["nbytes"] += 1024 * 1024
+    assert streamlit_app.evict_over_budget(registry, keep="new") == []
+    assert list(registry["entries"]) == ["new"] and not spill.exists()
+
+def test_aggregate_points_counts_add_up():
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(139.75, 139.85, 5000)
+    lat = rng.uniform(35.60, 35.70, 5000)
+    values = rng.uniform(20, 35, 5000)
+    # 座標が欠損した点は集計から除く
+    lon[:10] = np.nan
+    for mode in ("grid", "hex"):
+        cells = aggregate_points(lon, lat, values, mode, cell_size_m=500.0)
+        assert cells["count"].sum() == 4990
+        assert cells["count"].min() > 0 and len(cells) < 4990
+        np.testing.assert_allclose((cells["mean"] * cells["count"]).sum(), values[10:].sum())
+        assert cells["max"].max() == values[10:].max() and (cells["max"] >= cells["mean"]).all()
+        # セルの中心は経緯度の範囲内
+        assert cells["lon"].between(139.74, 139.86).all() and cells["lat"].between(35.59, 35.71).all()
+    assert aggregate_points([np.nan], [np.nan]).empty
+
+def test_map_values_to_colors():
+    lut = streamlit_app.get_colormap_lut("viridis")
+    colors = map_values_to_colors(pd.Series([0.0, 5.0, 10.0, np.nan]), "viridis")
+    assert colors.dtype == np.uint8 and colors.shape == (4, 4)
+    np.testing.assert_array_equal(colors[:3], lut[[0, 128, 255]])
+    assert colors[3].tolist() == streamlit_app.NAN_COLOR
+    # 値が1種類なら中央の色、カテゴリ値は並べ替えた順に両端から割り当てる
+    np.testing.assert_array_equal(map_values_to_colors([7, 7], "viridis"), lut[[128, 128]])
+    categories = map_values_to_colors(pd.Series(["b", "a", None, "c"]), "viridis")
+    np.testing.assert_array_equal(categories[[1, 0, 3]], lut[[0, 128, 255]])
+    assert categories[2].tolist() == streamlit_app.NAN_COLOR
+
+def test_streamed_csv_columns_and_stats_match_pandas(tmp_path, monkeypatch):
+    monkeypatch.setattr(streamlit_app, "CSV_BLOCK_SIZE", 64 * 1024)
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "lon": rng.uniform(139.7, 139.9, 20_000), "lat": rng.uniform(35.5, 35.7, 20_000),
+        "wbgt": rng.normal(28, 3, 20_000).round(1), "name": rng.choice(["a", "b"], 20_000),
+    })
+    df.loc[::97, "wbgt"] = np.nan
+    path = str(tmp_path / "points.csv")
+    df.to_csv(path, index=False)
+    frame, stats = read_table_columns(path, "csv", ["lon", "lat", "wbgt"], keep_float64=["lon", "lat"])
+    assert list(frame.columns) == ["lon", "lat", "wbgt"]
+    assert frame["lon"].dtype == np.float64 and frame["wbgt"].dtype == np.float32
+    np.testing.assert_array_equal(frame["lon"], df["lon"])
+    np.testing.assert_allclose(frame["wbgt"], df["wbgt"], rtol=1e-6)
+    expected = df[["lon", "lat", "wbgt"]].describe().loc[["count", "mean", "std", "min", "max"]]
+    pd.testing.assert_frame_equal(stats, expected, check_exact=False, rtol=1e-9)
+    # 先頭チャンクと型が合わない行があれば一括で読み直し、数値の列だけ集計する
+    df["wbgt"] = df["wbgt"].astype(object)
+    df.loc[19_999, "wbgt"] = "欠測"
+    df.to_csv(path, index=False)
+    frame, stats = read_table_columns(path, "csv", ["lon", "wbgt"])
+    assert frame["wbgt"].iloc[-1] == "欠測"
+    pd.testing.assert_frame_equal(stats, expected[["lon"]], check_exact=False, rtol=1e-9)
+
+def test_compact_frame_keeps_values():
+    gdf = gpd.GeoDataFrame({
+        "count": np.arange(1000, dtype=np.int64),
+        "wbgt": np.round(np.linspace(20, 35, 1000), 1),
+        "huge": np.linspace(0, 1, 1000) * 1e39,
+        "id": 1e10 + np.arange(1000, dtype=np.float64),
+        "code": [str(13100 + i % 3) for i in range(1000)],
+        "zip": ["0123456"] * 1000,
+        "ward": ["江東区"] * 999 + [None],
+        "lon": np.linspace(139.7, 139.9, 1000),
+    }, geometry=gpd.points_from_xy(np.linspace(139.7, 139.9, 1000), np.full(1000, 35.6)), crs="EPSG:4326")
+    compacted = compact_frame(gdf, keep_float64=["lon"])
+    dtypes = compacted.dtypes.astype(str).to_dict()
+    assert dtypes["count"] == "int16" and dtypes["wbgt"] == "float32" and dtypes["code"] == "int16"
+    # float32 に収まらない値・2**24 を超える整数値・指定した列は float64 のまま、先頭が0のコードは文字列のまま
+    assert dtypes["huge"] == dtypes["id"] == dtypes["lon"] == "float64"
+    assert dtypes["zip"] == dtypes["ward"] == "category" and isinstance(compacted, gpd.GeoDataFrame)
+    for col in ("count", "wbgt", "huge", "id", "lon"):
+        np.testing.assert_allclose(compacted[col].astype(np.float64), gdf[col], rtol=1e-6)
+    assert compacted["code"].astype(str).tolist() == gdf["code"].tolist()
+    assert compacted["zip"].tolist() == gdf["zip"].tolist() and compacted["ward"].isna().sum() == 1
+    assert compact_frame(compacted, keep_float64=["lon"]) is compacted
+
+def test_spatial_join_matches_sjoin():
+    rng = np.random.default_rng(0)
+    boxes = [shapely.box(139.70 + 0.01 * i, 35.60, 139.71 + 0.01 * i, 35.61) for i in range(10)]
+    polygons = gpd.GeoSeries(boxes + [shapely.box(139.725, 35.60, 139.745, 35.61)], crs="EPSG:4326")
+    lon = rng.uniform(139.69, 139.81, 3000)
+    lat = rng.uniform(35.59, 35.62, 3000)
+    lon[:5] = np.nan
+    values = pd.DataFrame({"pop": rng.integers(0, 100, 3000).astype(float)})
+    assignment = points_in_polygons(lon, lat, shapely.STRtree(polygons.values), chunk_size=700)
+    assert (assignment[:5] == -1).all()
+    points = gpd.GeoDataFrame(values, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326").iloc[5:]
+    joined = gpd.sjoin(points, gpd.GeoDataFrame(geometry=polygons), predicate="intersects")
+    # 重なったポリゴンに含まれる点は番号の小さいポリゴンに割り当てる
+    expected = joined.groupby(level=0)["index_right"].min().reindex(range(3000), fill_value=-1)
+    assert joined.index.duplicated().any() and not (assignment == 10).any()
+    np.testing.assert_array_equal(assignment, expected.to_numpy())
+    result = spatial_join_statistics(assignment, len(polygons), values)
+    grouped = values["pop"].groupby(assignment).agg(["count", "sum", "mean", "max"]).reindex(range(len(polygons)))
+    grouped[["count", "sum"]] = grouped[["count", "sum"]].fillna(0)
+    np.testing.assert_array_equal(result["count"], grouped["count"])
+    np.testing.assert_allclose(result[["pop_sum", "pop_mean", "pop_max"]], grouped[["sum", "mean", "max"]])
+
+def test_accessibility_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    mesh = gpd.GeoDataFrame(
+        {"pop": rng.integers(0, 500, 100).astype(float)},
+        geometry=[shapely.box(139.78 + 0.0025 * (i % 10), 35.64 + 0.0025 * (i // 10), 139.7825 + 0.0025 * (i % 10), 35.6425 + 0.0025 * (i // 10))
+                  for i in range(100)],
+        crs="EPSG:4326",
+    )
+    facilities = gpd.GeoDataFrame(
+        {"name": [f"f{i}" for i in range(8)]},
+        geometry=gpd.points_from_xy(rng.uniform(139.78, 139.805, 8), rng.uniform(35.64, 35.665, 8)), crs="EPSG:4326",
+    )
+    entries = {}
+    for name, gdf in (("mesh", mesh), ("shelters", facilities)):
+        path = str(tmp_path / f"{name}.geojson")
+        gdf.to_file(path, driver="GeoJSON")
+        entries[name] = {"source": "folder", "name": f"{name}.geojson", "path": path, "dataset_path": path, "cache_key": f"test:{path}"}
+    spec = {"kind": "access", "key": f"test-access:{tmp_path}", "prefix": "acc", "points": entries["shelters"], "id_col": "name", "k": 3, "radius": 300}
+    result = load_accessibility(entries["mesh"], spec)
+    # 同じ UTM 座標系で全組み合わせの距離を求めた結果と一致する
+    crs = mesh.estimate_utm_crs()
+    centroids = mesh.geometry.to_crs(crs).centroid
+    sites = facilities.geometry.to_crs(crs)
+    dist = np.hypot(centroids.x.to_numpy()[:, None] - sites.x.to_numpy(), centroids.y.to_numpy()[:, None] - sites.y.to_numpy())
+    nearest = np.sort(dist, axis=1)
+    np.testing.assert_allclose(result["acc_dist_m"], nearest[:, 0])
+    np.testing.assert_allclose(result["acc_dist_k3_m"], nearest[:, 2])
+    assert result["acc_id"].tolist() == facilities["name"].to_numpy()[dist.argmin(axis=1)].tolist()
+    np.testing.assert_array_equal(result["acc_within_300m"], (dist <= 300).sum(axis=1))
+    summary = accessibility_summary(result, spec, mesh, ["pop"]).iloc[0]
+    pop = mesh["pop"].to_numpy()
+    assert np.isclose(summary["人口加重平均距離(m)"], (pop * nearest[:, 0]).sum() / pop.sum())
+    assert np.isclose(summary["半径300m以内に施設がある割合(%)"], pop[nearest[:, 0] <= 300].sum() / pop.sum() * 100)
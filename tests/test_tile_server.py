@@ -0,0 +1,124 @@
+import gzip
+import io
+import os
+import time
+import http.client
+import numpy as np
+import pytest
+import geopandas as gpd
+import mapbox_vector_tile
+import shapely
+from PIL import Image
+from tile_server import EMPTY_TILE_PNG, RasterTileRenderer, TileCache, VectorGeometry, VectorTileSource, start_tile_server, tiles_for_bounds
+
+def gray_lut():
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    lut[:, 0] = np.arange(256)
+    lut[:, 3] = 255
+    return lut
+
+def test_render_and_cache_tiles(write_geotiff, tmp_path):
+    path = write_geotiff("wbgt.tif", np.full((100, 100), 30.0))
+    renderer = RasterTileRenderer(TileCache(disk_dir=str(tmp_path / "tiles")))
+    layer_id = renderer.register(path, 1, gray_lut(), 20.0, 40.0)
+    (z, x, y), = [t for t in tiles_for_bounds(139.72, 35.62, 139.72, 35.62, 14)]
+    png = renderer.render(layer_id, z, x, y)
+    rgba = np.asarray(Image.open(io.BytesIO(png)))
+    assert rgba.shape == (256, 256, 4)
+    assert rgba[..., 3].max() == 255 and abs(int(rgba[..., 0].max()) - 128) <= 1
+    assert renderer.render(layer_id, z, x, y) is png
+    assert os.path.exists(tmp_path / "tiles" / layer_id / str(z) / str(x) / f"{y}.png")
+    # ラスタの外は透明なタイル
+    assert renderer.render(layer_id, 14, 0, 0) == EMPTY_TILE_PNG
+    assert renderer.render("unknown", z, x, y) is None
+
+def test_rewritten_file_gets_new_layer_id(write_geotiff):
+    path = write_geotiff("wbgt.tif", np.full((100, 100), 25.0))
+    renderer = RasterTileRenderer(TileCache())
+    first = renderer.register(path, 1, gray_lut(), 20.0, 40.0)
+    stat = os.stat(path)
+    write_geotiff("wbgt.tif", np.full((100, 100), 35.0))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert renderer.register(path, 1, gray_lut(), 20.0, 40.0) != first
+
+def test_registered_layers_are_bounded(write_geotiff):
+    path = write_geotiff("wbgt.tif", np.full((10, 10), 30.0))
+    renderer = RasterTileRenderer(TileCache(), max_layers=3)
+    first = renderer.register(path, 1, gray_lut(), 20.0, 40.0)
+    for vmax in (41.0, 42.0):
+        renderer.register(path, 1, gray_lut(), 20.0, vmax)
+    # 使われたレイヤーは残り、最も古いものから外れる
+    renderer.render(first, 14, 0, 0)
+    renderer.register(path, 1, gray_lut(), 20.0, 43.0)
+    assert len(renderer.layers) == 3 and first in renderer.layers
+    assert renderer.register(path, 1, gray_lut(), 20.0, 41.0) in renderer.layers
+
+def test_server_keeps_connection_alive(write_geotiff):
+    path = write_geotiff("wbgt.tif", np.full((100, 100), 30.0))
+    server, renderer = start_tile_server("127.0.0.1", 0)
+    try:
+        layer_id = renderer.register(path, 1, gray_lut(), 20.0, 40.0)
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        statuses = []
+        for url in (f"/tiles/{layer_id}/14/14551/6452.png", "/tiles/unknown/14/0/0.png", "/terrain/1/0/0.png"):
+            conn.request("GET", url)
+            response = conn.getresponse()
+            response.read()
+            statuses.append(response.status)
+        assert statuses == [200, 404, 200]
+        conn.close()
+    finally:
+        server.shutdown()
+
+def test_vector_tiles(tmp_path):
+    gdf = gpd.GeoDataFrame(
+        {"name": ["a", None]},
+        geometry=[shapely.box(139.70, 35.60, 139.71, 35.61), shapely.box(139.71, 35.60, 139.72, 35.61)],
+        crs="EPSG:4326",
+    )
+    geometry = VectorGeometry(gdf, detail_zoom=12)
+    colors = [[255, 0, 0, 160], [0, 0, 255, 160]]
+    source = VectorTileSource(geometry, colors, ["name"], mbtiles_path=str(tmp_path / "layer.mbtiles"))
+    (z, x, y), = tiles_for_bounds(139.705, 35.605, 139.715, 35.605, 13)
+    features = mapbox_vector_tile.decode(gzip.decompress(source.tile(z, x, y)))["layer"]["features"]
+    assert sorted((f["properties"]["r"], f["properties"].get("name")) for f in features) == [(0, None), (255, "a")]
+    # 詳細ズーム以上は元のジオメトリを使い、簡略化したレベルは詳細ズーム未満だけ持つ
+    source.tile(10, *tiles_for_bounds(139.705, 35.605, 139.705, 35.605, 10)[0][1:])
+    assert sorted(geometry.levels) == [10, 12]
+    assert geometry.levels[12].result()[0] is geometry.geoms
+    # 2回目は MBTiles から返す
+    assert source._read_mbtiles(z, x, y) is not None
+
+def test_vector_sources_share_geometry_and_unregister(tmp_path):
+    gdf = gpd.GeoDataFrame(geometry=[shapely.box(139.70 + i * 0.01, 35.60, 139.71 + i * 0.01, 35.61) for i in range(20)], crs="EPSG:4326")
+    geometry = VectorGeometry(gdf)
+    np.testing.assert_allclose(geometry.bounds, (139.70, 35.60, 139.90, 35.61))
+    renderer = RasterTileRenderer(TileCache())
+    red = VectorTileSource(geometry, np.full((20, 4), 200))
+    blue = VectorTileSource(geometry, np.full((20, 4), 50), mbtiles_path=str(tmp_path / "blue.mbtiles"))
+    renderer.register_vector_source("red", red)
+    renderer.register_vector_source("blue", blue)
+    assert red.geometry is blue.geometry
+    assert blue.precompute(*geometry.bounds, range(10, 15), max_tiles=5) == 5
+    renderer.unregister_vector_source("blue")
+    assert "blue" not in renderer.vector_sources and blue.closed
+    assert blue.precompute(*geometry.bounds, range(10, 15)) == 0
+
+@pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS=1 で実行する")
+def test_benchmark_tiles_per_second(write_geotiff):
+    # キャッシュなし（cold）とキャッシュあり（warm）のタイル生成速度を表示する
+    # RUN_BENCHMARKS=1 python -m pytest -s tests/test_tile_server.py -k benchmark
+    data = np.random.default_rng(0).uniform(20, 35, (2000, 2000))
+    path = write_geotiff("wbgt.tif", data, left=139.75, top=35.70, res=0.0001)
+    renderer = RasterTileRenderer(TileCache(max_tiles=100000))
+    layer_id = renderer.register(path, 1, gray_lut(), 20.0, 35.0)
+    tiles = [t for z in (12, 13, 14, 15) for t in tiles_for_bounds(139.75, 35.50, 139.95, 35.70, z)]
+    rates = {}
+    for label in ("cold", "warm"):
+        start = time.perf_counter()
+        for z, x, y in tiles:
+            renderer.render(layer_id, z, x, y)
+        elapsed = time.perf_counter() - start
+        rates[label] = len(tiles) / elapsed
+        print(f"{label}: {len(tiles)} tiles in {elapsed:.2f} s ({rates[label]:,.1f} tiles/s)")
+    assert rates["warm"] > rates["cold"]
@@ -0,0 +1,172 @@
+import os
+import gzip
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from url_ingest import UrlDownloader
+
+def make_handler(root, fail_after=None, compress=None):
+    # 静的ファイルサーバー（ETag / Last-Modified / Range / If-Range に対応）
+    # fail_after を指定すると、各ファイルの最初の応答だけそのバイト数で接続を切る
+    # compress="negotiate" なら Accept-Encoding に gzip があるとき、"always" なら常に gzip で返す（Range は圧縮後の位置）
+    failed = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path = os.path.join(root, self.path.lstrip("/"))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            stat = os.stat(path)
+            with open(path, "rb") as f:
+                body = f.read()
+            encoded = compress == "always" or (compress == "negotiate" and "gzip" in self.headers.get("Accept-Encoding", ""))
+            if encoded:
+                body = gzip.compress(body, mtime=0)
+            etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-gz" if encoded else ""}"'
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            start = 0
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if range_header and (if_range is None or if_range in (etag, last_modified)):
+                start = int(range_header.split("=")[1].split("-")[0])
+            size = len(body)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206 if start else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(size - start))
+            if encoded:
+                self.send_header("Content-Encoding", "gzip")
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            self.end_headers()
+            end = size
+            if fail_after is not None and self.path not in failed:
+                failed.add(self.path)
+                end = min(size, start + fail_after)
+            for offset in range(start, end, 64 * 1024):
+                self.wfile.write(body[offset:min(end, offset + 64 * 1024)])
+
+    return Handler
+
+@pytest.fixture
+def source(tmp_path):
+    # 配信するファイルを置いたディレクトリ（fail_after を決めてからサーバーを起動する）
+    root = tmp_path / "source"
+    root.mkdir()
+    servers = []
+
+    def serve(fail_after=None, compress=None):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(str(root), fail_after, compress))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield root, serve
+    for server in servers:
+        server.shutdown()
+
+@pytest.fixture
+def downloader(tmp_path):
+    downloader = UrlDownloader(str(tmp_path / "cache"), max_workers=4, chunk_size=64 * 1024)
+    yield downloader
+    downloader.shutdown()
+
+def write_files(root, n_files, size):
+    contents = []
+    for i in range(n_files):
+        data = os.urandom(size)
+        (root / f"file{i}.bin").write_bytes(data)
+        contents.append(data)
+    return contents
+
+def test_parallel_download_resumes_and_revalidates(source, downloader):
+    root, serve = source
+    size = 1024 * 1024
+    contents = write_files(root, 4, size)
+    base = serve(fail_after=size // 3)
+    urls = [f"{base}/file{i}.bin" for i in range(4)]
+    # 最初の応答は途中で切れるので、続きから取得し直す
+    results = [future.result() for future in [downloader.submit(url) for url in urls]]
+    assert [r.status for r in results] == ["resumed"] * 4
+    for result, data in zip(results, contents):
+        with open(result.path, "rb") as f:
+            assert f.read() == data
+    # 2回目は ETag で再検証して変更なし
+    results = [future.result() for future in [downloader.submit(url) for url in urls]]
+    assert [r.status for r in results] == ["revalidated"] * 4
+
+def leave_partial(downloader, url, extra=b""):
+    # 取得済みの本文を、完了の記録前に途切れた取得途中の本文（.part）に戻す
+    body_path, part_path, _ = downloader.cache.paths(url)
+    os.replace(body_path, part_path)
+    with open(part_path, "ab") as f:
+        f.write(extra)
+    meta = downloader.cache.load_meta(url)
+    meta["complete"] = False
+    downloader.cache.save_meta(url, meta)
+
+def test_full_partial_file_completes_on_416(source, downloader):
+    root, serve = source
+    contents = write_files(root, 1, 256 * 1024)
+    url = f"{serve()}/file0.bin"
+    downloader.submit(url).result()
+    leave_partial(downloader, url)
+    result = downloader.submit(url).result()
+    assert (result.status, result.status_code) == ("resumed", 416)
+    with open(result.path, "rb") as f:
+        assert f.read() == contents[0]
+    assert downloader.submit(url).result().status == "revalidated"
+
+def test_oversized_partial_file_restarts(source, downloader):
+    root, serve = source
+    contents = write_files(root, 1, 256 * 1024)
+    url = f"{serve()}/file0.bin"
+    downloader.submit(url).result()
+    leave_partial(downloader, url, extra=b"garbage")
+    result = downloader.submit(url).result()
+    assert result.status == "downloaded"
+    with open(result.path, "rb") as f:
+        assert f.read() == contents[0]
+
+def write_text_file(root, n_lines):
+    # 圧縮の効く CSV
+    data = "".join(f"{i},{i * 0.5},35.{i % 1000:03d},139.{i % 777:03d}\n" for i in range(n_lines)).encode()
+    (root / "points.csv").write_bytes(data)
+    return data
+
+def test_resume_with_gzip_capable_server(source, downloader):
+    # 圧縮しない本文を要求するので、途切れても保存した本文の大きさから正しく再開できる
+    root, serve = source
+    data = write_text_file(root, 50_000)
+    url = f"{serve(fail_after=len(data) // 3, compress='negotiate')}/points.csv"
+    result = downloader.submit(url).result()
+    assert result.status == "resumed"
+    with open(result.path, "rb") as f:
+        assert f.read() == data
+
+def test_gzip_only_server_restarts_instead_of_resuming(source, downloader):
+    # 常に圧縮して返すサーバーで途切れた場合は、圧縮後の位置が分からないので最初から取り直す
+    root, serve = source
+    data = write_text_file(root, 50_000)
+    url = f"{serve(fail_after=len(gzip.compress(data)) // 3, compress='always')}/points.csv"
+    result = downloader.submit(url).result()
+    assert result.status == "downloaded"
+    with open(result.path, "rb") as f:
+        assert f.read() == data
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from zonal_stats import count_windows, label_grid, zonal_statistics
+
+def exact_statistics(raster_path, band, zones, percentiles=(50, 90)):
+    # ポリゴンごとに全解像度のマスクを作って直接求める
+    rows = []
+    with rasterio.open(raster_path) as src:
+        data = src.read(band, masked=True).filled(np.nan).astype(np.float64)
+        for geom in zones.to_crs(src.crs).values:
+            mask = rasterize([(geom, 1)], out_shape=data.shape, transform=src.transform, fill=0, dtype="uint8").astype(bool)
+            values = data[mask & np.isfinite(data)]
+            row = {"count": len(values), "sum": values.sum(), "mean": values.mean() if len(values) else np.nan,
+                   "min": values.min() if len(values) else np.nan, "max": values.max() if len(values) else np.nan}
+            for q in percentiles:
+                row[f"p{q:g}"] = np.percentile(values, q) if len(values) else np.nan
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+def test_count_windows():
+    assert count_windows(1024, 1024, 512) == 4
+    assert count_windows(1025, 1, 512) == 3
+
+def test_block_statistics_match_exact(write_geotiff, tmp_path):
+    data = np.random.default_rng(0).uniform(20, 35, (300, 300)).astype(np.float32)
+    data[:10, :10] = -9999
+    path = write_geotiff("wbgt.tif", data, nodata=-9999)
+    zones = gpd.GeoSeries(
+        [shapely.box(139.71, 35.5, 139.8, 35.6), shapely.box(139.82, 35.45, 139.95, 35.55), shapely.box(139.7, 35.65, 139.75, 35.7),
+         shapely.box(141.0, 36.0, 141.1, 36.1)],
+        crs="EPSG:4326",
+    )
+    calls = []
+    result = zonal_statistics(path, 1, zones, "zones", cache_dir=str(tmp_path / "labels"), block_size=128,
+                              progress=lambda done, total: calls.append((done, total)))
+    exact = exact_statistics(path, 1, zones)
+    np.testing.assert_array_equal(result["count"], exact["count"])
+    for col in ("sum", "mean", "min", "max"):
+        np.testing.assert_allclose(result[col], exact[col], rtol=1e-6)
+    # パーセンタイルはヒストグラムのビン幅程度の誤差を許す
+    for col in ("p50", "p90"):
+        np.testing.assert_allclose(result[col], exact[col], atol=15 / 1024 * 2)
+    assert result.loc[3, "count"] == 0 and np.isnan(result.loc[3, "mean"])
+    assert calls and calls[-1][0] == calls[-1][1]
+    # 2回目は焼き付け済みのラベルを使う
+    again = zonal_statistics(path, 1, zones, "zones", cache_dir=str(tmp_path / "labels"), block_size=128)
+    pd.testing.assert_frame_equal(result, again)
+
+def test_concurrent_label_grids_do_not_share_temp_file(write_geotiff, tmp_path):
+    path = write_geotiff("wbgt.tif", np.full((300, 300), 30.0))
+    zones = [shapely.box(139.71, 35.5, 139.8, 35.6), shapely.box(139.82, 35.45, 139.95, 35.55)]
+    label_path = str(tmp_path / "labels" / "zones.npy")
+    with rasterio.open(path) as src, ThreadPoolExecutor(4) as pool:
+        grids = list(pool.map(lambda _: np.array(label_grid(zones, src, label_path, block_size=64)), range(4)))
+    for grid in grids:
+        np.testing.assert_array_equal(grid, grids[0])
+    assert set(np.unique(grids[0])) == {0, 1, 2}
+    assert os.listdir(tmp_path / "labels") == ["zones.npy"]
@@ -0,0 +1,410 @@
+import os
+import math
+import gzip
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import shapely
+import mapbox_vector_tile
+import rasterio
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds as transform_from_bounds
+from rasterio.vrt import WarpedVRT
+from PIL import Image
+
+# GeoTIFF を Web メルカトルの XYZ タイル（/{z}/{x}/{y}.png）として、
+# GeoDataFrame を Mapbox Vector Tile（/{z}/{x}/{y}.pbf）として配信するローカルサーバー
+# Streamlit アプリからはプロセス内のスレッドとして起動する（外部サービスは使わない）
+
+TILE_SIZE = 256
+WEB_MERCATOR = CRS.from_epsg(3857)
+WEB_MERCATOR_HALF = 20037508.342789244
+
+def tile_bounds(z, x, y):
+    # タイル番号から Web メルカトル座標の範囲（left, bottom, right, top）を求める
+    size = 2 * WEB_MERCATOR_HALF / (2 ** z)
+    left = -WEB_MERCATOR_HALF + x * size
+    top = WEB_MERCATOR_HALF - y * size
+    return left, top - size, left + size, top
+
+def apply_lut(img_array, lut, vmin, vmax):
+    # 値の範囲 [vmin, vmax] を参照テーブル（256, 4）で RGBA(uint8) に変換する（欠損値は透明）
+    valid = np.isfinite(img_array)
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    idx = np.zeros(img_array.shape, dtype=np.intp)
+    idx[valid] = np.clip(((img_array[valid] - vmin) * scale).round(), 0, 255)
+    rgba = lut[idx]
+    rgba[~valid] = 0
+    return rgba
+
+def encode_png(rgba):
+    buffer = BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def simplify_coverage(geoms, tolerance):
+    # 隣り合うポリゴンの共有辺が食い違わないよう、ポリゴンをまとめてカバレッジとして簡略化する
+    # （重なりがあるなどカバレッジとして扱えない場合は、地物ごとにトポロジーを保って簡略化する）
+    geoms = np.asarray(geoms)
+    polygonal = np.isin(shapely.get_type_id(geoms), (3, 6))
+    if polygonal.any() and shapely.coverage_is_valid(geoms[polygonal]):
+        simplified = geoms.copy()
+        simplified[polygonal] = shapely.coverage_simplify(geoms[polygonal], tolerance)
+        simplified[~polygonal] = shapely.simplify(geoms[~polygonal], tolerance, preserve_topology=True)
+        return simplified
+    return shapely.simplify(geoms, tolerance, preserve_topology=True)
+
+def flat_terrain_png():
+    # 標高0m（Terrarium 形式で RGB = 128, 0, 0）のタイル（TerrainLayer の下地用）
+    rgb = np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+    rgb[..., 0] = 128
+    buffer = BytesIO()
+    Image.fromarray(rgb, mode="RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+EMPTY_TILE_PNG = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+FLAT_TERRAIN_PNG = flat_terrain_png()
+
+class TileCache:
+    # メモリ上のタイルの LRU（ディスク保存先を指定すると PNG を永続化する）
+    def __init__(self, max_tiles=4096, disk_dir=None):
+        self.max_tiles = max_tiles
+        self.disk_dir = disk_dir
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _disk_path(self, key):
+        layer_id, z, x, y = key
+        return os.path.join(self.disk_dir, layer_id, str(z), str(x), f"{y}.png")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    png = f.read()
+                self.put(key, png, persist=False)
+                return png
+        return None
+
+    def put(self, key, png, persist=True):
+        with self.lock:
+            self.tiles[key] = png
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        if persist and self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.part"
+            with open(tmp_path, "wb") as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+
+class RasterTileRenderer:
+    # 登録されたラスタ（パス・バンド・カラーマップ・値の範囲）からタイルを切り出す
+    def __init__(self, cache, max_layers=256):
+        self.cache = cache
+        # 登録されたラスタの設定の LRU（値の範囲やカラーマップを変えるたびに増えるため上限を設ける）
+        self.layers = OrderedDict()
+        self.max_layers = max_layers
+        self.layers_lock = threading.Lock()
+        self.vector_sources = {}
+        self.local = threading.local()
+
+    def register(self, path, band, lut, vmin, vmax, lut_name=""):
+        # 設定ごとに異なるレイヤーIDを割り当てる（カラーマップを変えると別URLになる）
+        # ファイルの更新時刻とサイズも含め、同じパスのファイルが置き換えられたら別のタイルとして作り直す
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = f"{os.path.abspath(path)}|{version[0]}|{version[1]}|{band}|{lut_name}|{vmin}|{vmax}"
+        layer_id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        with self.layers_lock:
+            self.layers[layer_id] = {"path": path, "version": version, "band": band, "lut": lut, "vmin": vmin, "vmax": vmax}
+            self.layers.move_to_end(layer_id)
+            while len(self.layers) > self.max_layers:
+                self.layers.popitem(last=False)
+        return layer_id
+
+    def register_vector_source(self, source_id, source):
+        # ベクタータイルの生成元（VectorTileSource）を登録する
+        self.vector_sources[source_id] = source
+        return source_id
+
+    def unregister_vector_source(self, source_id):
+        # 使われなくなった生成元を外し、事前生成を止める（ジオメトリなどのメモリを解放できるようにする）
+        source = self.vector_sources.pop(source_id, None)
+        if source is not None:
+            source.closed = True
+
+    def _open(self, path, version, overview_level):
+        # スレッドごとにデータセットを開いたままにする（rasterio のハンドルはスレッド間で共有しない）
+        handles = getattr(self.local, "handles", None)
+        if handles is None:
+            handles = self.local.handles = {}
+        key = (path, version, overview_level)
+        if key not in handles:
+            if overview_level is None:
+                handles[key] = rasterio.open(path)
+            else:
+                handles[key] = rasterio.open(path, overview_level=overview_level)
+        return handles[key]
+
+    def _overview_level(self, path, version, band, z, y):
+        # タイルの解像度を下回らない範囲で、最も粗いオーバービューを選ぶ
+        src = self._open(path, version, None)
+        factors = src.overviews(band)
+        if not factors or src.crs is None:
+            return None
+        src_res = src.res[0]
+        if src.crs.is_geographic:
+            src_res *= 111320.0
+        # タイル中心の緯度でメルカトルの縮尺を補正した地上解像度（m/ピクセル）
+        lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / 2 ** z))))
+        tile_res = 2 * WEB_MERCATOR_HALF / (2 ** z) / TILE_SIZE * math.cos(math.radians(lat))
+        level = None
+        for i, factor in enumerate(factors):
+            if src_res * factor <= tile_res:
+                level = i
+        return level
+
+    def render(self, layer_id, z, x, y):
+        key = (layer_id, z, x, y)
+        png = self.cache.get(key)
+        if png is not None:
+            return png
+        with self.layers_lock:
+            layer = self.layers.get(layer_id)
+            if layer is not None:
+                self.layers.move_to_end(layer_id)
+        if layer is None:
+            return None
+        overview_level = self._overview_level(layer["path"], layer["version"], layer["band"], z, y)
+        src = self._open(layer["path"], layer["version"], overview_level)
+        left, bottom, right, top = tile_bounds(z, x, y)
+        transform = transform_from_bounds(left, bottom, right, top, TILE_SIZE, TILE_SIZE)
+        with WarpedVRT(
+            src,
+            crs=WEB_MERCATOR,
+            transform=transform,
+            width=TILE_SIZE,
+            height=TILE_SIZE,
+            resampling=Resampling.bilinear,
+            src_nodata=src.nodata,
+            nodata=np.nan,
+            dtype="float32",
+        ) as vrt:
+            data = vrt.read(layer["band"], masked=True)
+        img_array = data.astype(np.float32).filled(np.nan)
+        if not np.isfinite(img_array).any():
+            png = EMPTY_TILE_PNG
+        else:
+            png = encode_png(apply_lut(img_array, layer["lut"], layer["vmin"], layer["vmax"]))
+        self.cache.put(key, png)
+        return png
+
+# MVT の座標分解能とタイル境界の余白（タイル幅に対する割合）
+MVT_EXTENT = 4096
+MVT_BUFFER = 1 / 64
+
+class VectorGeometry:
+    # GeoDataFrame の Web メルカトルのジオメトリと、詳細ズーム未満のズームごとに簡略化したジオメトリ・空間インデックス
+    # データセットごとに1つ作り、色分けやツールチップのカラムが異なるタイル生成元（VectorTileSource）で共有する
+    # 詳細ズーム以上は元のジオメトリと1つの空間インデックスを使う
+    def __init__(self, gdf, detail_zoom=12):
+        if gdf.crs is None:
+            gdf = gdf.set_crs(epsg=4326)
+        self.gdf = gdf
+        self.geoms = np.asarray(gdf.geometry.to_crs(epsg=3857).values)
+        self.detail_zoom = detail_zoom
+        # 経緯度の範囲（lon_min, lat_min, lon_max, lat_max）
+        self.bounds = rasterio.warp.transform_bounds(WEB_MERCATOR, "EPSG:4326", *shapely.total_bounds(self.geoms))
+        # ズーム -> (ジオメトリ, 空間インデックス) の Future（作成中のズームは他のスレッドがその完了を待つ）
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def level(self, z):
+        # ズーム z の1ピクセル相当の許容誤差でトポロジーを保ったまま簡略化する（詳細ズーム以上は元のジオメトリ）
+        # 簡略化はロックの外で行い、作成中のズーム以外のタイル生成を止めない
+        z = min(z, self.detail_zoom)
+        with self.lock:
+            level = self.levels.get(z)
+            build = level is None
+            if build:
+                level = self.levels[z] = Future()
+        if build:
+            try:
+                if z >= self.detail_zoom:
+                    geoms = self.geoms
+                else:
+                    geoms = simplify_coverage(self.geoms, 2 * WEB_MERCATOR_HALF / (2 ** z) / TILE_SIZE)
+                level.set_result((geoms, shapely.STRtree(geoms)))
+            except Exception as e:
+                with self.lock:
+                    self.levels.pop(z, None)
+                level.set_exception(e)
+        return level.result()
+
+    def attribute_values(self, col, idx):
+        # 地物番号 idx の属性値（欠損は None）
+        values = self.gdf[col].iloc[idx]
+        return values.astype(object).where(values.notna(), None).tolist()
+
+class VectorTileSource:
+    # 共有のジオメトリ（VectorGeometry）と地物ごとの色（RGBA）・ツールチップのカラムから MVT を生成する
+    # 生成したタイルは MBTiles（SQLite）に保存し、次回以降はそこから返す
+    def __init__(self, geometry, colors, attributes=(), mbtiles_path=None, layer_name="layer"):
+        self.geometry = geometry
+        self.colors = np.asarray(colors, dtype=np.uint8)
+        self.attributes = tuple(attributes)
+        self.layer_name = layer_name
+        # タイルサーバーから外されたら事前生成を止める
+        self.closed = False
+        self.mbtiles_path = mbtiles_path
+        if mbtiles_path:
+            os.makedirs(os.path.dirname(os.path.abspath(mbtiles_path)), exist_ok=True)
+            with sqlite3.connect(mbtiles_path) as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, "
+                    "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+                )
+                conn.execute("INSERT OR REPLACE INTO metadata VALUES ('format', 'pbf')")
+                conn.execute("INSERT OR REPLACE INTO metadata VALUES ('name', ?)", (layer_name,))
+
+    def _read_mbtiles(self, z, x, y):
+        if not self.mbtiles_path:
+            return None
+        with sqlite3.connect(self.mbtiles_path) as conn:
+            row = conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2 ** z - 1 - y),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write_mbtiles(self, z, x, y, data):
+        if not self.mbtiles_path:
+            return
+        with sqlite3.connect(self.mbtiles_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, data))
+
+    def tile(self, z, x, y):
+        # gzip 圧縮した MVT を返す（MBTiles の行番号は TMS 方式で y を反転）
+        data = self._read_mbtiles(z, x, y)
+        if data is not None:
+            return data
+        geoms, tree = self.geometry.level(z)
+        left, bottom, right, top = tile_bounds(z, x, y)
+        margin = (right - left) * MVT_BUFFER
+        clip_box = (left - margin, bottom - margin, right + margin, top + margin)
+        idx = tree.query(shapely.box(*clip_box))
+        clipped = shapely.clip_by_rect(geoms[idx], *clip_box)
+        keep = ~shapely.is_empty(clipped)
+        idx = idx[keep]
+        clipped = clipped[keep]
+        # 詳細ズーム未満では色のみ、詳細ズーム以上ではタイル内の地物の属性も含める
+        attributes = {}
+        if z >= self.geometry.detail_zoom:
+            attributes = {col: self.geometry.attribute_values(col, idx) for col in self.attributes}
+        features = []
+        for k, (geom, i) in enumerate(zip(clipped, idx.tolist())):
+            r, g, b, a = self.colors[i].tolist()
+            properties = {"r": r, "g": g, "b": b, "a": a}
+            for col, values in attributes.items():
+                if values[k] is not None:
+                    properties[col] = values[k]
+            features.append({"geometry": geom, "properties": properties})
+        pbf = mapbox_vector_tile.encode(
+            [{"name": self.layer_name, "features": features}],
+            default_options={"quantize_bounds": (left, bottom, right, top), "extents": MVT_EXTENT},
+        )
+        data = gzip.compress(pbf)
+        self._write_mbtiles(z, x, y, data)
+        return data
+
+    def precompute(self, lon_min, lat_min, lon_max, lat_max, zooms, max_tiles=256):
+        # 指定した範囲・ズームのタイルを事前に生成して MBTiles に保存する（多くても max_tiles 枚、外されたら止める）
+        tiles = [t for z in zooms for t in tiles_for_bounds(lon_min, lat_min, lon_max, lat_max, z)][:max_tiles]
+        count = 0
+        for z, x, y in tiles:
+            if self.closed:
+                break
+            self.tile(z, x, y)
+            count += 1
+        return count
+
+def make_handler(renderer):
+    class TileRequestHandler(BaseHTTPRequestHandler):
+        # /tiles/{layer_id}/{z}/{x}/{y}.png、/mvt/{source_id}/{z}/{x}/{y}.pbf と /terrain/{z}/{x}/{y}.png を返す
+        # HTTP/1.1 で接続を保ち、ブラウザの同じ接続からの続くタイル要求では同じスレッドのデータセットを使い回す
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            content_type = "image/png"
+            encoding = None
+            try:
+                if len(parts) == 4 and parts[0] == "terrain":
+                    body = FLAT_TERRAIN_PNG
+                elif len(parts) == 5 and parts[0] == "tiles" and parts[4].endswith(".png"):
+                    z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-4])
+                    body = renderer.render(parts[1], z, x, y)
+                elif len(parts) == 5 and parts[0] == "mvt" and parts[4].endswith(".pbf"):
+                    z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-4])
+                    source = renderer.vector_sources.get(parts[1])
+                    body = source.tile(z, x, y) if source is not None else None
+                    content_type = "application/x-protobuf"
+                    encoding = "gzip"
+                else:
+                    body = None
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return TileRequestHandler
+
+def start_tile_server(host="127.0.0.1", port=8765, max_tiles=4096, disk_dir=None):
+    # タイルサーバーをデーモンスレッドで起動し、(サーバー, レンダラー) を返す
+    renderer = RasterTileRenderer(TileCache(max_tiles=max_tiles, disk_dir=disk_dir))
+    server = ThreadingHTTPServer((host, port), make_handler(renderer))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="tile-server", daemon=True)
+    thread.start()
+    return server, renderer
+
+def tiles_for_bounds(lon_min, lat_min, lon_max, lat_max, z):
+    # 経緯度の範囲を覆うタイル番号の一覧
+    def tile_xy(lon, lat):
+        n = 2 ** z
+        x = int((lon + 180.0) / 360.0 * n)
+        lat_rad = math.radians(lat)
+        y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+    x0, y0 = tile_xy(lon_min, lat_max)
+    x1, y1 = tile_xy(lon_max, lat_min)
+    return [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# URL のファイルをディスク上の HTTP キャッシュに取得する
+# ・スレッドプール（同時実行数に上限あり）で並行に取得し、接続は requests.Session で使い回す
+# ・本文はチャンクごとにキャッシュディレクトリの一時ファイル（.part）へ書き込む（メモリに溜めない）
+# ・転送が途切れた場合は Range リクエストで続きから再開する
+#   （Range の位置は保存した本文の大きさなので、圧縮しない本文を要求する。それでも圧縮して返すサーバーからは最初から取り直す）
+# ・取得済みのファイルは ETag / Last-Modified で再検証し、変更がなければ再取得しない
+# Streamlit アプリからは UrlDownloader を 1 つだけ作り、全セッションで共有する
+
+CHUNK_SIZE = 1024 * 1024
+# 続きから取得し直す対象とする通信エラー
+TRANSFER_ERRORS = (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout)
+
+class DownloadResult:
+    def __init__(self, url, path, status, status_code, nbytes):
+        self.url = url
+        self.path = path
+        # "downloaded"（新規取得）, "resumed"（途中から再開）, "revalidated"（304 で変更なし）, "cached"（再検証できずキャッシュを使用）
+        self.status = status
+        self.status_code = status_code
+        self.nbytes = nbytes
+
+class HttpCache:
+    # URL ごとに本文（<sha>.<拡張子>）、取得途中の本文（.part）、検証用ヘッダー（<sha>.json）を保存する
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def paths(self, url):
+        # 本文は URL と同じ拡張子で保存する（読み込み時に形式を判定できるように）
+        base = os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+        suffix = os.path.splitext(urlsplit(url).path)[1]
+        return f"{base}{suffix}", f"{base}{suffix}.part", f"{base}.json"
+
+    def load_meta(self, url):
+        _, _, meta_path = self.paths(url)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_meta(self, url, meta):
+        _, _, meta_path = self.paths(url)
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+def validators(response):
+    # 再検証・再開に使うヘッダー
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+class UrlDownloader:
+    def __init__(self, cache_dir, max_workers=4, chunk_size=CHUNK_SIZE, retries=3, timeout=30):
+        self.cache = HttpCache(cache_dir)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        # 本文の大きさと Range・Content-Length の位置を一致させるため、圧縮しない本文を要求する
+        self.session.headers["Accept-Encoding"] = "identity"
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="url-ingest")
+        # 同じ URL を同時に取得しないためのロック
+        self.url_locks = {}
+        self.url_locks_lock = threading.Lock()
+
+    def submit(self, url, progress=None):
+        # 取得をスレッドプールに登録し、Future（結果は DownloadResult）を返す
+        # progress(取得済みバイト数, 全体のバイト数または None) はワーカースレッドから呼ばれる
+        return self.executor.submit(self.fetch, url, progress)
+
+    def url_lock(self, url):
+        with self.url_locks_lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def fetch(self, url, progress=None):
+        with self.url_lock(url):
+            body_path, part_path, _ = self.cache.paths(url)
+            meta = self.cache.load_meta(url)
+            headers = {}
+            # 取得済みなら条件付きリクエストで再検証する
+            if os.path.exists(body_path) and meta.get("complete"):
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+                try:
+                    response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+                except requests.ConnectionError:
+                    # 接続できない場合はキャッシュをそのまま使う
+                    return DownloadResult(url, body_path, "cached", None, os.path.getsize(body_path))
+                if response.status_code == 304:
+                    response.close()
+                    if progress:
+                        progress(os.path.getsize(body_path), os.path.getsize(body_path))
+                    return DownloadResult(url, body_path, "revalidated", 304, os.path.getsize(body_path))
+                try:
+                    return self.stream_to_cache(url, response, meta, resumed=False, progress=progress)
+                except TRANSFER_ERRORS:
+                    return self.download(url, self.cache.load_meta(url), progress)
+            return self.download(url, meta, progress)
+
+    def download(self, url, meta, progress):
+        # 途中まで取得済みの本文があれば、同じ内容であることを If-Range で確認して続きから取得する
+        _, part_path, _ = self.cache.paths(url)
+        last_error = None
+        for _ in range(self.retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {}
+            validator = meta.get("etag") or meta.get("last_modified")
+            if offset and meta.get("encoded"):
+                # 圧縮された転送の途中までの本文は、圧縮後の位置が分からないため捨てる
+                os.remove(part_path)
+                offset = 0
+            if offset and validator:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = validator
+            try:
+                response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+                if response.status_code == 416 and offset:
+                    response.close()
+                    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                    if total == str(offset):
+                        # 最後まで書き込んだ後に途切れていた場合は、途中までの本文をそのまま完成とする
+                        if progress:
+                            progress(offset, offset)
+                        return self.finish(url, meta, offset, "resumed", 416)
+                    # 全体の大きさと合わない場合は、途中までの本文を捨てて最初から取り直す
+                    os.remove(part_path)
+                    continue
+                return self.stream_to_cache(url, response, meta, resumed=response.status_code == 206, progress=progress)
+            except TRANSFER_ERRORS as e:
+                last_error = e
+                meta = self.cache.load_meta(url)
+        raise last_error
+
+    def stream_to_cache(self, url, response, meta, resumed, progress):
+        body_path, part_path, _ = self.cache.paths(url)
+        response.raise_for_status()
+        if resumed:
+            offset = os.path.getsize(part_path)
+            start = int(response.headers.get("Content-Range", "bytes 0-").split()[1].split("-")[0])
+            if start != offset:
+                # 要求した位置と異なる範囲が返ってきた場合は最初から取り直す
+                response.close()
+                os.remove(part_path)
+                return self.download(url, {}, progress)
+        else:
+            offset = 0
+            meta = {"url": url, **validators(response)}
+        # 圧縮して返された場合、Content-Length は圧縮後の大きさなので全体の大きさには使わない
+        meta["encoded"] = response.headers.get("Content-Encoding", "identity").lower() != "identity"
+        meta["complete"] = False
+        self.cache.save_meta(url, meta)
+        length = response.headers.get("Content-Length")
+        total = offset + int(length) if length is not None and not meta["encoded"] else None
+        done = offset
+        with response, open(part_path, "ab" if resumed else "wb") as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+        if total is not None and done < total:
+            raise requests.exceptions.ChunkedEncodingError(f"{url}: {done}/{total} バイトで転送が途切れました")
+        return self.finish(url, meta, done, "resumed" if resumed else "downloaded", response.status_code)
+
+    def finish(self, url, meta, size, status, status_code):
+        # 取得し終えた本文（.part）をキャッシュの本文にする
+        body_path, part_path, _ = self.cache.paths(url)
+        os.replace(part_path, body_path)
+        meta["complete"] = True
+        meta["size"] = size
+        self.cache.save_meta(url, meta)
+        return DownloadResult(url, body_path, status, status_code, size)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,192 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+import shapely
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+# ポリゴンごとに GeoTIFF の画素値を集計する（ゾーン統計）
+# ・ポリゴンはラスタの格子に一度だけ焼き付け、画素ごとのポリゴン番号（ラベル）をディスク上の配列に保存して使い回す
+# ・ラスタはブロック（既定 1024×1024 画素）ごとに読み、np.bincount でポリゴン番号ごとに集計する（メモリ使用量はブロックの大きさで決まる）
+# ・パーセンタイルはポリゴンごとのヒストグラムから求める（ビン幅程度の誤差がある）
+# ・人口メッシュを指定すると、メッシュの人口を画素に等分した重みで、重み付き平均とポリゴン内の人口を求める
+
+BLOCK_SIZE = 1024
+HISTOGRAM_BINS = 1024
+# ポリゴン数 × ビン数の上限（ポリゴンが多い場合はビン数を減らす）
+MAX_HISTOGRAM_CELLS = 2 ** 24
+
+def iter_windows(width, height, block_size=BLOCK_SIZE):
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+def count_windows(width, height, block_size=BLOCK_SIZE):
+    return -(-width // block_size) * -(-height // block_size)
+
+def window_slices(window):
+    return slice(window.row_off, window.row_off + window.height), slice(window.col_off, window.col_off + window.width)
+
+def grid_key(src):
+    # ラスタの格子（大きさ・座標変換・座標系）を表す文字列
+    return f"{src.width}x{src.height}|{tuple(src.transform)[:6]}|{src.crs}"
+
+def label_grid(geoms, src, path, block_size=BLOCK_SIZE, progress=None):
+    # ポリゴン（ラスタと同じ座標系）を格子に焼き付け、画素ごとのポリゴン番号（1始まり、0は範囲外）を path に保存する
+    # 重なっている画素は後のポリゴンの番号になる
+    # progress(処理済みブロック数, ブロック数) は焼き付けるときだけ呼ばれる
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        geoms = np.asarray(geoms)
+        tree = shapely.STRtree(geoms)
+        # 同じラベルを別のプロセス・スレッドが同時に焼き付けても混ざらないよう、一時ファイルは呼び出しごとに別の名前にする
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=f"{os.path.basename(path)}.",
+                                         suffix=".part.npy", delete=False) as tmp:
+            tmp_path = tmp.name
+        try:
+            grid = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int32, shape=(src.height, src.width))
+            n_windows = count_windows(src.width, src.height, block_size)
+            for i, window in enumerate(iter_windows(src.width, src.height, block_size)):
+                transform = window_transform(window, src.transform)
+                left, top = transform * (0, 0)
+                right, bottom = transform * (window.width, window.height)
+                hits = tree.query(shapely.box(min(left, right), min(top, bottom), max(left, right), max(top, bottom)), predicate="intersects")
+                if len(hits):
+                    grid[window_slices(window)] = rasterize(
+                        ((geoms[i], int(i) + 1) for i in np.sort(hits)),
+                        out_shape=(window.height, window.width), transform=transform, fill=0, dtype="int32",
+                    )
+                if progress:
+                    progress(i + 1, n_windows)
+            grid.flush()
+            del grid
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return np.load(path, mmap_mode="r")
+
+def label_grid_path(cache_dir, zone_key, src):
+    return os.path.join(cache_dir, f"{hashlib.sha256(f'{zone_key}|{grid_key(src)}'.encode()).hexdigest()}.npy")
+
+def histogram_percentiles(hist, count, percentiles, vmin, width):
+    # ポリゴンごとのヒストグラム（ポリゴン数, ビン数）から、ビン内を線形補間してパーセンタイルを求める
+    cum = np.cumsum(hist, axis=1)
+    result = {}
+    for q in percentiles:
+        target = q / 100 * count
+        idx = np.minimum((cum >= target[:, None]).argmax(axis=1), hist.shape[1] - 1)
+        rows = np.arange(len(hist))
+        below = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+        in_bin = hist[rows, idx]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(in_bin > 0, (target - below) / in_bin, 0.0)
+        result[f"p{q:g}"] = np.where(count > 0, vmin + (idx + np.clip(frac, 0, 1)) * width, np.nan)
+    return result
+
+def zonal_statistics(raster_path, band, zones, zone_key, percentiles=(50, 90), weight_zones=None, weight_values=None,
+                     weight_key=None, cache_dir=None, block_size=BLOCK_SIZE, progress=None):
+    # zones（GeoSeries）ごとに画素数・合計・平均・最小・最大・パーセンタイルを求め、zones と同じ並びの DataFrame を返す
+    # weight_zones / weight_values（人口メッシュと各メッシュの人口）を渡すと weighted_mean（人口で重み付けした平均）と weight_sum（ポリゴン内の人口）も求める
+    # progress(処理済みブロック数, 全体のブロック数) で、ラベルの焼き付けと各回の読み込みの進み具合を知らせる
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "wbgt_zonal_labels")
+    n = len(zones)
+    with rasterio.open(raster_path) as src:
+        n_windows = count_windows(src.width, src.height, block_size)
+        n_passes = 2 + bool(percentiles) + 2 * (weight_zones is not None)
+        done = [0]
+
+        def advance(step=1):
+            done[0] += step
+            if progress:
+                progress(done[0], n_windows * n_passes)
+
+        def stage(offset):
+            # ラベルの焼き付けの進捗を全体の進捗に換算する
+            return None if progress is None else (lambda i, total: progress(offset + i, n_windows * n_passes))
+
+        labels = label_grid(zones.to_crs(src.crs).values, src, label_grid_path(cache_dir, zone_key, src), block_size, stage(done[0]))
+        advance(n_windows)
+        if weight_zones is not None:
+            weight_labels = label_grid(
+                weight_zones.to_crs(src.crs).values, src, label_grid_path(cache_dir, weight_key, src), block_size, stage(done[0])
+            )
+            advance(n_windows)
+            # メッシュの人口をメッシュ内の画素数で割り、画素ごとの重みにする
+            pixels = np.zeros(len(weight_zones) + 1, dtype=np.int64)
+            for window in iter_windows(src.width, src.height, block_size):
+                pixels += np.bincount(np.asarray(weight_labels[window_slices(window)]).ravel(), minlength=len(pixels))
+                advance()
+            values = np.concatenate([[0.0], np.nan_to_num(np.asarray(weight_values, dtype=np.float64))])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                pixel_weight = np.where(pixels > 0, values / pixels, 0.0)
+            weight_sum = np.zeros(n + 1)
+            weighted_total = np.zeros(n + 1)
+            weighted_value = np.zeros(n + 1)
+        count = np.zeros(n + 1, dtype=np.int64)
+        total = np.zeros(n + 1)
+        vmin = np.full(n + 1, np.inf)
+        vmax = np.full(n + 1, -np.inf)
+
+        def read_block(window):
+            # ブロック内で値のある、いずれかのポリゴンに含まれる画素のラベルと値
+            data = src.read(band, window=window, masked=True)
+            block_labels = np.asarray(labels[window_slices(window)])
+            values = data.filled(np.nan).astype(np.float64)
+            valid = (block_labels > 0) & np.isfinite(values)
+            return block_labels, valid, values
+
+        for window in iter_windows(src.width, src.height, block_size):
+            block_labels, valid, values = read_block(window)
+            advance()
+            if weight_zones is not None:
+                inside = block_labels > 0
+                weights = pixel_weight[np.asarray(weight_labels[window_slices(window)])]
+                weight_sum += np.bincount(block_labels[inside], weights=weights[inside], minlength=n + 1)
+                weighted_total += np.bincount(block_labels[valid], weights=weights[valid], minlength=n + 1)
+                weighted_value += np.bincount(block_labels[valid], weights=weights[valid] * values[valid], minlength=n + 1)
+            block_labels = block_labels[valid]
+            values = values[valid]
+            if len(values) == 0:
+                continue
+            count += np.bincount(block_labels, minlength=n + 1)
+            total += np.bincount(block_labels, weights=values, minlength=n + 1)
+            np.minimum.at(vmin, block_labels, values)
+            np.maximum.at(vmax, block_labels, values)
+
+        has_values = count > 0
+        result = pd.DataFrame({
+            "count": count[1:],
+            "sum": total[1:],
+            "mean": np.where(has_values, total / np.maximum(count, 1), np.nan)[1:],
+            "min": np.where(has_values, vmin, np.nan)[1:],
+            "max": np.where(has_values, vmax, np.nan)[1:],
+        })
+        if percentiles and has_values[1:].any():
+            # 2回目の読み込みで、全体の最小～最大を等分したヒストグラムをポリゴンごとに作る
+            lo = float(vmin[has_values].min())
+            hi = float(vmax[has_values].max())
+            bins = int(np.clip(MAX_HISTOGRAM_CELLS // (n + 1), 16, HISTOGRAM_BINS))
+            width = (hi - lo) / bins if hi > lo else 1.0
+            hist = np.zeros((n + 1) * bins, dtype=np.int64)
+            for window in iter_windows(src.width, src.height, block_size):
+                block_labels, valid, values = read_block(window)
+                advance()
+                idx = np.clip(((values[valid] - lo) / width).astype(np.int64), 0, bins - 1)
+                hist += np.bincount(block_labels[valid].astype(np.int64) * bins + idx, minlength=len(hist))
+            for name, column in histogram_percentiles(hist.reshape(n + 1, bins)[1:], count[1:], percentiles, lo, width).items():
+                result[name] = column
+        elif percentiles:
+            for q in percentiles:
+                result[f"p{q:g}"] = np.nan
+            advance(n_windows)
+        if weight_zones is not None:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result["weighted_mean"] = np.where(weighted_total > 0, weighted_value / weighted_total, np.nan)[1:]
+            result["weight_sum"] = weight_sum[1:]
+    return result